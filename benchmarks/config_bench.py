@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+
+# Measures the Python that runs at every reconfig: loading a rosdistro index,
+# building the RosDistroOracle and configuring each type of builder. The index
+# is synthetic and served from file:// URLs, each size runs in its own process
+# so peak memory is comparable, and the results are printed as JSON.
+
+from __future__ import print_function
+import sys
+import os
+import gc
+import json
+import time
+import random
+import shutil
+import cProfile
+import resource
+import argparse
+import tempfile
+import subprocess
+
+import yaml
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+## @brief Version of the JSON output, change it when the format changes
+FORMAT_VERSION = 1
+## @brief The phases measured, in order
+PHASES = ['index', 'oracle', 'debbuilders', 'branch_debbuilders', 'testbuilders', 'docbuilders']
+
+PACKAGE_XML = '''<?xml version="1.0"?>
+<package format="2">
+  <name>%s</name>
+  <version>1.0.0</version>
+  <description>Synthetic package</description>
+  <maintainer email="dev@example.com">Developer</maintainer>
+  <license>BSD</license>
+  <buildtool_depend>catkin</buildtool_depend>
+%s</package>
+'''
+
+## @brief Write a synthetic rosdistro index
+##
+## Repositories are spread over depth layers, and each package depends on
+## fanout packages of the layer below, so depth is the length of the longest
+## dependency chain between repositories.
+## @param path Directory to write the index to
+## @param packages Total number of packages
+## @param packages_per_repo Number of packages in each repository
+## @param depth Number of layers of repositories
+## @param fanout Number of dependencies of each package
+## @param rosdistro Name of the ROS distribution
+## @param seed Seed of the random dependencies
+## @returns The file:// URL of the index
+def generate_index(path, packages, packages_per_repo=5, depth=5, fanout=3, rosdistro='kinetic', seed=0):
+    rnd = random.Random(seed)
+    repos = max(packages // packages_per_repo, 1)
+    layers = [list() for _ in range(min(depth, repos))]
+    repositories = dict()
+    release_xmls = dict()
+    source_xmls = dict()
+    for r in range(repos):
+        name = 'repo%d' % r
+        layer = r * len(layers) // repos
+        url = 'file://%s/git/%s.git' % (path, name)
+        pkgs = ['%s_pkg%d' % (name, p) for p in range(packages_per_repo)]
+        repositories[name] = {
+            'release': {'packages': pkgs, 'url': url, 'version': '1.0.0-0',
+                        'tags': {'release': 'release/%s/{package}/{version}' % rosdistro}},
+            'source': {'type': 'git', 'url': url, 'version': 'master'},
+            'doc': {'type': 'git', 'url': url, 'version': 'master'}}
+        source_xmls[name] = {'_ref': '0' * 40}
+        for i, pkg in enumerate(pkgs):
+            depends = set()
+            if layer > 0:
+                below = layers[layer - 1]
+                depends.update(rnd.sample(below, min(fanout, len(below))))
+            if i > 0:
+                depends.add(pkgs[i - 1])
+            xml = PACKAGE_XML % (pkg, ''.join('  <depend>%s</depend>\n' % d for d in sorted(depends)))
+            release_xmls[pkg] = xml
+            source_xmls[name][pkg] = [pkg, xml]
+        layers[layer].extend(pkgs)
+
+    distribution = {'type': 'distribution', 'version': 1, 'repositories': repositories,
+                    'release_platforms': {'ubuntu': ['xenial', 'bionic']}}
+    cache = {'type': 'cache', 'version': 2, 'name': rosdistro, 'distribution_file': [distribution],
+             'release_package_xmls': release_xmls, 'source_repo_package_xmls': source_xmls}
+    targets = {'_config': {'apt_mirrors': ['http://localhost/ubuntu DISTRO main universe',
+                                           'file:///var/www/building/ubuntu DISTRO main'],
+                           'apt_keys': ['http://localhost/key.asc']},
+               'ubuntu': {'xenial': {'amd64': None, 'i386': None}, 'bionic': {'amd64': None}}}
+    def build_file(build_type):
+        return {'type': build_type, 'version': 1, 'targets': targets, 'jenkins_url': 'http://localhost',
+                'doc_tag_index_repository': {'type': 'git', 'url': 'file:///tmp/doc-tags', 'version': 'master'}}
+
+    d = os.path.join(path, rosdistro)
+    if not os.path.isdir(d):
+        os.makedirs(d)
+    files = [('distribution.yaml', distribution), ('distribution-cache.yaml', cache),
+             ('release-build.yaml', build_file('release-build')),
+             ('source-build.yaml', build_file('source-build')),
+             ('doc-build.yaml', build_file('doc-build'))]
+    for filename, data in files:
+        with open(os.path.join(d, filename), 'w') as f:
+            yaml.safe_dump(data, f)
+    index = {'type': 'index', 'version': 2, 'distributions': {rosdistro: {
+        'distribution': rosdistro+'/distribution.yaml',
+        'distribution_cache': rosdistro+'/distribution-cache.yaml',
+        'release_builds': [rosdistro+'/release-build.yaml'],
+        'source_builds': [rosdistro+'/source-build.yaml'],
+        'doc_builds': [rosdistro+'/doc-build.yaml']}}}
+    with open(os.path.join(path, 'index.yaml'), 'w') as f:
+        yaml.safe_dump(index, f)
+    return 'file://' + os.path.join(path, 'index.yaml')
+
+## @brief Measure one phase
+##
+## Python 2 cannot count allocations, so the objects left tracked by the garbage
+## collector are reported instead. maxrss_kb is the peak of the process so far.
+## @param results Dictionary of phase name -> measurements, updated
+## @param profile_dir If set, a cProfile dump of the phase is written there
+## @returns The result of function
+def measure(results, name, profile_dir, function, *args, **kwargs):
+    gc.collect()
+    objects = len(gc.get_objects())
+    profile = cProfile.Profile() if profile_dir else None
+    start = time.time()
+    cpu = time.clock()
+    if profile:
+        result = profile.runcall(function, *args, **kwargs)
+        profile.dump_stats(os.path.join(profile_dir, name+'.prof'))
+    else:
+        result = function(*args, **kwargs)
+    cpu = time.clock() - cpu
+    wall = time.time() - start
+    results[name] = {'wall_s': round(wall, 4),
+                     'cpu_s': round(cpu, 4),
+                     'objects': len(gc.get_objects()) - objects,
+                     'maxrss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+    return result
+
+## @brief Run all the phases on an index, in this process
+def run(url, profile_dir=None):
+    from rosdistro import get_index
+    from buildbot_ros_cfg.distro import RosDistroOracle, debbuilders_from_rosdistro, \
+        branch_debbuilders_from_rosdistro, testbuilders_from_rosdistro, docbuilders_from_rosdistro
+
+    phases = dict()
+    index = measure(phases, 'index', profile_dir, get_index, url)
+    dist_names = list(index.distributions.keys())
+    oracle = measure(phases, 'oracle', profile_dir, RosDistroOracle, index, dist_names)
+    generators = [('debbuilders', debbuilders_from_rosdistro, {'lazy': True, 'rebuild_rdepends': True}),
+                  ('branch_debbuilders', branch_debbuilders_from_rosdistro, {'lazy': True, 'rebuild_rdepends': True}),
+                  ('testbuilders', testbuilders_from_rosdistro, {}),
+                  ('docbuilders', docbuilders_from_rosdistro, {})]
+    builders = dict()
+    for name, generator, kwargs in generators:
+        c = {'builders': [], 'schedulers': [], 'change_source': [], 'status': []}
+        for dist in dist_names:
+            measure(phases, name, profile_dir, generator, c, oracle, dist, ['rosbuilder1'], **kwargs)
+        builders[name] = len(c['builders'])
+    for name in builders:
+        phases[name]['builders'] = builders[name]
+    return phases
+
+## @brief Run one size in a child process
+## @returns The result of the child, as a dictionary
+def run_child(args, packages):
+    path = tempfile.mkdtemp(prefix='config-bench-')
+    try:
+        url = generate_index(path, packages, args.packages_per_repo, args.depth, args.fanout, seed=args.seed)
+        command = [sys.executable, os.path.realpath(__file__), '--child', url]
+        if args.profile:
+            profile_dir = os.path.join(args.profile, str(packages))
+            if not os.path.isdir(profile_dir):
+                os.makedirs(profile_dir)
+            command += ['--profile', profile_dir]
+        output = subprocess.check_output(command)
+    finally:
+        shutil.rmtree(path)
+    return json.loads(output.decode('utf8').strip().splitlines()[-1])
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description='Benchmark rosdistro loading and builder configuration')
+    parser.add_argument('--packages', type=int, nargs='+', default=[100, 1000],
+                        help='total number of packages, one run for each (up to 10000, which is slow)')
+    parser.add_argument('--packages-per-repo', type=int, default=5)
+    parser.add_argument('--depth', type=int, default=5, help='layers of repositories')
+    parser.add_argument('--fanout', type=int, default=3, help='dependencies of each package')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--profile', help='directory for the cProfile dumps of each phase')
+    parser.add_argument('--output', help='write the JSON here rather than to stdout')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run(args.child, args.profile), sort_keys=True))
+        exit(0)
+
+    results = list()
+    for packages in args.packages:
+        phases = run_child(args, packages)
+        results.append({'packages': packages,
+                        'repositories': max(packages // args.packages_per_repo, 1),
+                        'phases': phases})
+        print('%6d packages: %s' % (packages, ', '.join('%s %.2fs' % (p, phases[p]['wall_s']) for p in PHASES)),
+              file=sys.stderr)
+    report = {'benchmark': 'config',
+              'version': FORMAT_VERSION,
+              'python': '%d.%d.%d' % sys.version_info[:3],
+              'parameters': {'packages_per_repo': args.packages_per_repo, 'depth': args.depth,
+                             'fanout': args.fanout, 'seed': args.seed},
+              'results': results}
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text+'\n')
+    else:
+        print(text)
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+
+# Measures what the log policy (scripts/log-policy.py) saves on the master: a
+# synthetic build log is sent as is, then through the policy for a step that
+# succeeds and one that fails. For each, the bytes the master receives and
+# writes to the log file, and the size of the log once compressed (bz2, like
+# buildbot does when the step finishes), are printed as JSON.
+
+from __future__ import print_function
+import sys
+import os
+import bz2
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+from buildbot_ros_cfg.log_policy import LOG_HEAD, LOG_TAIL
+
+## @brief Version of the JSON output, change it when the format changes
+FORMAT_VERSION = 1
+## @brief Output of a compiler, repeated to make the log
+NOISE = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'testbuild_corpus', 'compiler_noise.log')
+
+## @brief Write a build log
+## @param path The file to write
+## @param size_mb Approximate size, in megabytes
+def generate_log(path, size_mb):
+    with open(NOISE) as f:
+        block = f.read()
+    with open(path, 'w') as f:
+        for _ in range(max(size_mb * 1024 * 1024 // len(block), 1)):
+            f.write(block)
+
+## @brief Run a command like a step, reading its output like the master does
+## @returns Dictionary of the bytes sent, their compressed size and the wall time
+def run_step(command):
+    start = time.time()
+    proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    compressor = bz2.BZ2Compressor()
+    sent = 0
+    stored = 0
+    while True:
+        chunk = proc.stdout.read(64 * 1024)
+        if not chunk:
+            break
+        sent += len(chunk)
+        stored += len(compressor.compress(chunk))
+    stored += len(compressor.flush())
+    proc.wait()
+    wall = time.time() - start
+    # the master writes the log as it comes, then reads it back to compress it
+    return {'sent_bytes': sent,
+            'stored_bytes': stored,
+            'master_io_bytes': 2 * sent + stored,
+            'wall_s': round(wall, 3),
+            'returncode': proc.returncode}
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description='Measure what the log policy saves on the master')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100], help='sizes of the logs in MB')
+    parser.add_argument('--head', type=int, default=LOG_HEAD)
+    parser.add_argument('--tail', type=int, default=LOG_TAIL)
+    parser.add_argument('--output', help='write the JSON here rather than to stdout')
+    args = parser.parse_args()
+
+    policy = [sys.executable, os.path.join(ROOT, 'scripts', 'log-policy.py'), str(args.head), str(args.tail)]
+    results = list()
+    workdir = tempfile.mkdtemp(prefix='log-policy-bench-')
+    try:
+        for size in args.sizes:
+            path = os.path.join(workdir, 'build-%d.log' % size)
+            generate_log(path, size)
+            cases = {'full': run_step(['cat', path]),
+                     'success': run_step(policy + ['cat', path]),
+                     'failure': run_step(policy + ['sh', '-c', 'cat "$0"; exit 1', path])}
+            os.remove(path)
+            for name in ['success', 'failure']:
+                for key in ['sent_bytes', 'stored_bytes', 'master_io_bytes']:
+                    cases[name][key.replace('_bytes', '_ratio')] = round(float(cases[name][key]) / cases['full'][key], 4)
+            results.append({'size_mb': size, 'cases': cases})
+            print('%5d MB: success sends %.2f%% (stores %.2f%%), failure sends %.2f%%, wall %.2fs -> %.2fs' %
+                  (size, 100 * cases['success']['sent_ratio'], 100 * cases['success']['stored_ratio'],
+                   100 * cases['failure']['sent_ratio'], cases['full']['wall_s'], cases['success']['wall_s']),
+                  file=sys.stderr)
+    finally:
+        shutil.rmtree(workdir)
+
+    report = {'benchmark': 'log_policy',
+              'version': FORMAT_VERSION,
+              'python': '%d.%d.%d' % sys.version_info[:3],
+              'parameters': {'head': args.head, 'tail': args.tail},
+              'results': results}
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text+'\n')
+    else:
+        print(text)
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+
+# Measures a poll of GitPRPoller with many tracked pull requests: the GitHub
+# API is faked with pages of synthetic pull requests, and the master accepts
+# changes without a database, so what is left is the poller itself. A poll
+# where no pull request has a new head and one where all of them do are timed,
+# as well as the revision lookup alone compared to scanning all the heads like
+# the poller used to. Each size runs in its own process, results are printed
+# as JSON.
+
+from __future__ import print_function
+import sys
+import os
+import json
+import time
+import argparse
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+## @brief Version of the JSON output, change it when the format changes
+FORMAT_VERSION = 1
+## @brief The cases measured, in order
+CASES = ['unchanged', 'updated']
+
+## @brief A pull request like the GitHub API lists them
+def pull_request(number, sha, updated_at):
+    repo = {'name': 'repo', 'owner': {'login': 'user%d' % number},
+            'ssh_url': 'git@github.com:user%d/repo.git' % number}
+    return {'number': number, 'state': 'open', 'updated_at': updated_at,
+            'base': {'ref': 'master', 'sha': '0' * 40},
+            'head': {'sha': sha, 'ref': 'feature-%d' % number, 'repo': repo}}
+
+## @brief Fake of the GitHub API, serving the open pull requests by pages
+class FakeGitHub(object):
+    def __init__(self, per_page):
+        self.per_page = per_page
+        self.pages = list()
+        self.requests = 0
+
+    def open(self, prs):
+        prs = sorted(prs, key=lambda pr: pr['updated_at'], reverse=True)
+        self.pages = [json.dumps(prs[i:i + self.per_page]) for i in range(0, max(len(prs), 1), self.per_page)]
+
+    def get(self, url, params=None, headers=None):
+        self.requests += 1
+        page = int(url.rsplit('page=', 1)[1]) if 'page=' in url else 1
+        links = {'next': {'url': 'https://api.github.com/fake?page=%d' % (page + 1)}} \
+            if page < len(self.pages) else {}
+        return FakeResponse(self.pages[page - 1], links)
+
+class FakeResponse(object):
+    def __init__(self, text, links):
+        self.status_code = 200
+        self.headers = {}
+        self.text = text
+        self.links = links
+
+    def json(self):
+        return json.loads(self.text)
+
+class FakeBotMaster(object):
+    builders = {}
+
+class FakeMaster(object):
+    def __init__(self):
+        self.changes = 0
+        self.botmaster = FakeBotMaster()
+
+    def addChange(self, **kwargs):
+        from twisted.internet import defer
+        self.changes += 1
+        return defer.succeed(None)
+
+## @brief Run a poll, everything it waits for is already there so it finishes at once
+def run_poll(poller):
+    failures = list()
+    d = poller.poll()
+    d.addErrback(failures.append)
+    if failures:
+        failures[0].raiseException()
+
+## @brief Time a poll
+def measure(poller, github, master):
+    requests_before, changes_before = github.requests, master.changes
+    start = time.time()
+    cpu = time.clock()
+    run_poll(poller)
+    return {'wall_s': round(time.time() - start, 4),
+            'cpu_s': round(time.clock() - cpu, 4),
+            'requests': github.requests - requests_before,
+            'changes': master.changes - changes_before}
+
+## @brief Measure the polls of one size, in this process
+## @param tracked Number of open pull requests
+## @param history Number of heads of closed pull requests remembered as well
+def run(tracked, history, per_page, lookups):
+    from twisted.internet import defer
+    from buildbot_ros_cfg import git_pr_poller
+
+    github = FakeGitHub(per_page)
+    git_pr_poller.requests.get = github.get
+    # the listing runs in a thread of the reactor, here it is timed with the rest of the poll
+    git_pr_poller.threads.deferToThread = defer.maybeDeferred
+    master = FakeMaster()
+    poller = git_pr_poller.GitPRPoller('git@github.com:owner/repo.git', 'bench', branch='master', token='token')
+    poller.master = master
+    poller.getState = lambda name, default=None: defer.succeed(default)
+    poller.setState = lambda name, value: defer.succeed(None)
+
+    for number in range(history):
+        poller._set_head('user%d/repo/closed-%d' % (number, number), 'c%039d' % number)
+    prs = [pull_request(n, 'a%039d' % n, '2020-01-01T00:00:00Z') for n in range(tracked)]
+    github.open(prs)
+    # first poll, to track the open pull requests
+    run_poll(poller)
+
+    cases = dict()
+    # the cursor is reset so every pull request is looked at, like after a restart
+    poller.cursor = None
+    cases['unchanged'] = measure(poller, github, master)
+    poller.cursor = None
+    github.open([pull_request(n, 'b%039d' % n, '2020-01-02T00:00:00Z') for n in range(tracked)])
+    cases['updated'] = measure(poller, github, master)
+
+    # the revision lookup alone, for revisions that are not known
+    revs = ['d%039d' % n for n in range(lookups)]
+    start = time.time()
+    found = sum(1 for rev in revs if rev in poller.seenRevs)
+    indexed = time.time() - start
+    heads = dict(poller.lastRevs)
+    start = time.time()
+    found += sum(1 for rev in revs if rev in heads.values())
+    scanned = time.time() - start
+    assert found == 0
+    return {'heads': len(poller.lastRevs),
+            'cases': cases,
+            'lookup': {'lookups': lookups,
+                       'indexed_us': round(1e6 * indexed / lookups, 3),
+                       'scan_us': round(1e6 * scanned / lookups, 3)}}
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the polls of GitPRPoller')
+    parser.add_argument('--tracked', type=int, nargs='+', default=[100, 1000],
+                        help='number of open pull requests, one run for each')
+    parser.add_argument('--history', type=int, default=5000, help='heads of closed pull requests remembered')
+    parser.add_argument('--per-page', type=int, default=100)
+    parser.add_argument('--lookups', type=int, default=1000, help='revisions looked up alone')
+    parser.add_argument('--output', help='write the JSON here rather than to stdout')
+    parser.add_argument('--child', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        print(json.dumps(run(args.child, args.history, args.per_page, args.lookups), sort_keys=True))
+        exit(0)
+
+    results = list()
+    for tracked in args.tracked:
+        output = subprocess.check_output([sys.executable, os.path.realpath(__file__), '--child', str(tracked),
+                                          '--history', str(args.history), '--per-page', str(args.per_page),
+                                          '--lookups', str(args.lookups)])
+        result = json.loads(output.decode('utf8').strip().splitlines()[-1])
+        result['tracked'] = tracked
+        results.append(result)
+        print('%6d pull requests: %s, lookup %.2fus (scan %.2fus)' %
+              (tracked, ', '.join('%s %.3fs' % (c, result['cases'][c]['wall_s']) for c in CASES),
+               result['lookup']['indexed_us'], result['lookup']['scan_us']),
+              file=sys.stderr)
+    report = {'benchmark': 'pr_poller',
+              'version': FORMAT_VERSION,
+              'python': '%d.%d.%d' % sys.version_info[:3],
+              'parameters': {'history': args.history, 'per_page': args.per_page, 'lookups': args.lookups},
+              'results': results}
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text+'\n')
+    else:
+        print(text)
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+# Measures the time and memory it takes to configure debbuilders, with eager
+# and lazy factories. Each mode runs in its own process so RSS is comparable.
+
+from __future__ import print_function
+import sys
+import os
+import json
+import time
+import resource
+import argparse
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+## @brief Configure the builders of a synthetic distro, like master.cfg does
+## @returns The Buildmasterconfig dictionary
+def configure(args, lazy):
+    from buildbot_ros_cfg.ros_deb_master import ros_branch_build
+    c = {'builders': [], 'schedulers': [], 'change_source': [], 'status': []}
+    for r in range(args.repos):
+        packages = ['repo%d_pkg%d' % (r, p) for p in range(args.packages)]
+        for code_name in args.code_names:
+            for arch in args.arches:
+                ros_branch_build(c, 'repo%d' % r, packages, 'file:///tmp/repo%d' % r, 'master',
+                                 code_name, arch, 'kinetic', ['rosbuilder1'],
+                                 'deb http://localhost/ubuntu %s main |' % code_name, [],
+                                 lazy=lazy)
+    return c
+
+## @brief Run one mode, in this process
+def run(args, lazy):
+    start = time.time()
+    c = configure(args, lazy)
+    config_time = time.time() - start
+    # a reconfig runs master.cfg again, while the old config (c) is still alive;
+    # maxrss_kb is the peak, so it includes both
+    start = time.time()
+    configure(args, lazy)
+    reconfig_time = time.time() - start
+    return {'mode': 'lazy' if lazy else 'eager',
+            'builders': len(c['builders']),
+            'steps': sum(len(b.factory.steps) for b in c['builders']),
+            'config_seconds': round(config_time, 3),
+            'reconfig_seconds': round(reconfig_time, 3),
+            'maxrss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description='Benchmark debbuilder configuration')
+    parser.add_argument('--repos', type=int, default=200)
+    parser.add_argument('--packages', type=int, default=5, help='packages per repository')
+    parser.add_argument('--code-names', nargs='+', default=['xenial', 'bionic'])
+    parser.add_argument('--arches', nargs='+', default=['amd64', 'i386'])
+    parser.add_argument('--mode', choices=['eager', 'lazy', 'both'], default='both')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run(args, args.mode == 'lazy')))
+        exit(0)
+
+    modes = ['eager', 'lazy'] if args.mode == 'both' else [args.mode]
+    results = list()
+    for mode in modes:
+        command = [sys.executable, os.path.realpath(__file__), '--child', '--mode', mode,
+                   '--repos', str(args.repos), '--packages', str(args.packages),
+                   '--code-names'] + args.code_names + ['--arches'] + args.arches
+        output = subprocess.check_output(command)
+        results.append(json.loads(output.decode('utf8').strip().splitlines()[-1]))
+    print('%-6s %9s %9s %10s %12s %10s' % ('mode', 'builders', 'steps', 'config s', 'reconfig s', 'RSS MB'))
+    for r in results:
+        print('%-6s %9d %9d %10.2f %12.2f %10.1f' % (r['mode'], r['builders'], r['steps'], r['config_seconds'],
+                                                  r['reconfig_seconds'], r['maxrss_kb'] / 1024.0))
@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+
+# Checks and measures the handling of test output: collecting the output of
+# 'make run_tests' and parsing it (scripts/testbuild.py, in the cowbuilder),
+# then evaluating the tests from its logs (TestBuild.evaluateCommand, on the
+# master). The small logs of testbuild_corpus are checked against their
+# expected results, and large logs made from them are timed, each size in its
+# own process so peak memory is comparable.
+
+from __future__ import print_function
+import sys
+import os
+import imp
+import json
+import time
+import shutil
+import resource
+import argparse
+import tempfile
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+from buildbot.process.properties import Properties
+from buildbot.status.results import Results
+from buildbot_ros_cfg.ros_test import TestBuild
+
+## @brief Version of the JSON output, change it when the format changes
+FORMAT_VERSION = 1
+## @brief Directory of the small logs, and of their expected results
+CORPUS = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'testbuild_corpus')
+## @brief Kinds of large logs
+KINDS = ['mixed', 'noise', 'long-lines']
+## @brief The phases measured, in order
+PHASES = ['collect', 'parse', 'write', 'evaluate']
+
+def load_testbuild():
+    return imp.load_source('testbuild', os.path.join(ROOT, 'scripts', 'testbuild.py'))
+
+## @brief Stand-in for the log of a step
+class FakeLog:
+    def __init__(self, path):
+        self.path = path
+
+    def getText(self):
+        with open(self.path) as f:
+            return f.read()
+
+## @brief Stand-in for the RemoteCommand of a step
+class FakeCommand:
+    def didFail(self):
+        return False
+
+## @brief Evaluate the tests like the TestBuild step does
+## @param logs Dictionary of log name -> file, of the tests and summary logs
+## @returns The name of the result (success, warnings, ...)
+def evaluate(logs):
+    step = TestBuild(command=['true'])
+    # the properties of a step are those of its build
+    step.build = Properties()
+    step.getLog = lambda name: FakeLog(logs[name])
+    return Results[step.evaluateCommand(FakeCommand())]
+
+## @brief Write the files of the tests and summary logs, like testbuild.py does
+## @returns Dictionary of log name -> file
+def write_logs(testbuild, workdir, results, output):
+    logs = {'tests': os.path.join(workdir, 'testresults'), 'summary': os.path.join(workdir, 'testsummary')}
+    with open(logs['tests'], 'w') as f:
+        testbuild.write_test_results(f, results, output)
+    with open(logs['summary'], 'w') as f:
+        testbuild.write_test_summary(f, results)
+    return logs
+
+def summarize(results):
+    return dict((key, len(value) if isinstance(value, list) else value) for key, value in results.items())
+
+## @brief Check the logs of the corpus against their expected results
+## @returns List of (log name, expected, found) that differ
+def check_corpus(testbuild):
+    with open(os.path.join(CORPUS, 'expected.json')) as f:
+        expected = json.load(f)
+    errors = list()
+    workdir = tempfile.mkdtemp(prefix='testbuild-bench-')
+    try:
+        for name in sorted(expected.keys()):
+            with open(os.path.join(CORPUS, name)) as f:
+                output = f.read()
+            results = testbuild.parse_test_output(output.split('\n'))
+            found = dict(results)
+            found['result'] = evaluate(write_logs(testbuild, workdir, results, output))
+            wanted = dict((k, v) for k, v in expected[name].items() if k != 'notes')
+            if found != wanted:
+                errors.append((name, wanted, found))
+    finally:
+        shutil.rmtree(workdir)
+    return errors
+
+## @brief Write a large log
+## @param path The file to write
+## @param size_mb Approximate size, in megabytes
+## @param kind 'mixed' repeats all the logs of the corpus, 'noise' only has compiler
+##        output, 'long-lines' has lines of a megabyte
+## @returns Number of times the corpus was repeated (mixed only, else 0)
+def generate_log(path, size_mb, kind):
+    size = size_mb * 1024 * 1024
+    if kind == 'mixed':
+        with open(os.path.join(CORPUS, 'expected.json')) as f:
+            names = sorted(json.load(f).keys())
+        block = ''.join(open(os.path.join(CORPUS, name)).read() for name in names)
+    elif kind == 'noise':
+        block = open(os.path.join(CORPUS, 'compiler_noise.log')).read()
+    else:
+        block = 'x' * (1024 * 1024 - 1) + '\n'
+    repeat = max(size // len(block), 1)
+    with open(path, 'w') as f:
+        for _ in range(repeat):
+            f.write(block)
+    return repeat if kind == 'mixed' else 0
+
+## @brief Expected counts of a mixed log, the corpus repeated
+def expected_mixed(repeat):
+    with open(os.path.join(CORPUS, 'expected.json')) as f:
+        expected = json.load(f)
+    totals = dict()
+    for entry in expected.values():
+        for key, value in summarize(dict((k, v) for k, v in entry.items() if k not in ('notes', 'result'))).items():
+            totals[key] = totals.get(key, 0) + value * repeat
+    return totals
+
+## @brief Time the phases on one log, in this process
+## @param collect_max Largest log (MB) run through call(), it is quadratic in the size of
+##        the output. Larger logs are read directly, and the collect phase is skipped.
+def run(path, repeat, collect_max):
+    testbuild = load_testbuild()
+    size_mb = os.path.getsize(path) / (1024.0 * 1024.0)
+    phases = dict()
+
+    def measure(name, function, *args):
+        start = time.time()
+        result = function(*args)
+        wall = time.time() - start
+        phases[name] = {'wall_s': round(wall, 4),
+                        'mb_per_s': round(size_mb / wall, 2) if wall > 0 else None,
+                        'maxrss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+        return result
+
+    phases['start'] = {'maxrss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+    # what run_build_and_test does with the output of 'make run_tests'
+    if size_mb <= collect_max:
+        output = measure('collect', testbuild.call, ['cat', path], None, False, True)
+    else:
+        with open(path) as f:
+            output = f.read().decode('utf8', 'replace')
+    results = measure('parse', lambda text: testbuild.parse_test_output(text.split('\n')), output)
+    logs = measure('write', write_logs, testbuild, os.path.dirname(path), results, output)
+    del output
+    # and what the master does with the logs
+    result = measure('evaluate', evaluate, logs)
+    for name in logs.values():
+        os.remove(name)
+
+    report = {'size_mb': round(size_mb, 1), 'phases': phases, 'result': result, 'counts': summarize(results)}
+    if repeat:
+        report['correct'] = report['counts'] == expected_mixed(repeat)
+    return report
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description='Check and benchmark the parsing of test output')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1, 10, 100],
+                        help='sizes of the large logs in MB (several hundred MB is pathological, but seen)')
+    parser.add_argument('--collect-max', type=float, default=0.5,
+                        help='largest log (MB) whose output is collected like testbuild.py does, it is slow')
+    parser.add_argument('--kinds', nargs='+', choices=KINDS, default=KINDS)
+    parser.add_argument('--output', help='write the JSON here rather than to stdout')
+    parser.add_argument('--child', nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run(args.child[0], int(args.child[1]), args.collect_max), sort_keys=True))
+        exit(0)
+
+    errors = check_corpus(load_testbuild())
+    for name, wanted, found in errors:
+        print('%s: expected %s, found %s' % (name, json.dumps(wanted, sort_keys=True),
+                                             json.dumps(found, sort_keys=True)), file=sys.stderr)
+
+    results = list()
+    workdir = tempfile.mkdtemp(prefix='testbuild-bench-')
+    try:
+        for kind in args.kinds:
+            for size in args.sizes:
+                path = os.path.join(workdir, '%s-%d.log' % (kind, size))
+                repeat = generate_log(path, size, kind)
+                output = subprocess.check_output([sys.executable, os.path.realpath(__file__),
+                                                  '--child', path, str(repeat),
+                                                  '--collect-max', str(args.collect_max)])
+                os.remove(path)
+                result = json.loads(output.decode('utf8').strip().splitlines()[-1])
+                result['kind'] = kind
+                results.append(result)
+                print('%-10s %5d MB: %s' % (kind, size, ', '.join('%s %.2f MB/s' % (p, result['phases'][p]['mb_per_s'] or 0)
+                                                              for p in PHASES if p in result['phases'])),
+                      file=sys.stderr)
+    finally:
+        shutil.rmtree(workdir)
+
+    report = {'benchmark': 'testbuild',
+              'version': FORMAT_VERSION,
+              'python': '%d.%d.%d' % sys.version_info[:3],
+              'corpus_errors': [name for name, _, _ in errors],
+              'results': results}
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text+'\n')
+    else:
+        print(text)
+    exit(1 if errors else 0)
@@ -0,0 +1,117 @@
+import os
+
+from buildbot.process.properties import Interpolate, renderer
+from buildbot.steps.shell import ShellCommand, SetPropertyFromCommand
+from buildbot.steps.transfer import FileUpload
+from buildbot.steps.master import MasterShellCommand, SetProperty
+
+from helpers import success
+
+## @brief Directory on the master holding artifacts by content (must match scripts/artifact-store.py)
+ARTIFACT_STORE = 'artifacts'
+
+## @brief Get the path of an artifact in the store on the master
+## @param sha256 The checksum of the artifact
+def blob_path(sha256):
+    return os.path.join(ARTIFACT_STORE, sha256[:2], sha256)
+
+## @brief Whether an artifact is in the store on the master. Found artifacts are
+##        touched, so scripts/artifact-gc.py keeps them until they are linked.
+def _in_store(sha256):
+    try:
+        os.utime(blob_path(sha256), None)
+    except OSError:
+        return False
+    return True
+
+## @brief Create the steps to upload a set of artifacts in a single transfer. Only
+##        artifacts not already in the store are sent, all of them are then
+##        hardlinked from the store into their directory on the master.
+## @param f The BuildFactory to add steps to
+## @param name Prefix for the step names
+## @param artifacts List of (filename, master directory), filenames are relative to
+##        %(prop:workdir)s and may contain Interpolate properties
+def add_artifact_upload_steps(f, name, artifacts):
+    prop = name.replace('-', '_')+'_sha256'
+    # artifacts to upload, decided once so the steps agree if the store changes meanwhile
+    missing_prop = name.replace('-', '_')+'_missing'
+    archive = 'artifacts-upload.tar'
+    incoming = ARTIFACT_STORE+'/incoming/%(prop:buildername)s-%(prop:buildnumber)s.tar'
+
+    def checksums(rc, stdout, stderr):
+        sums = list()
+        for line in stdout.splitlines():
+            parts = line.split()
+            if len(parts) == 2:
+                sums.append([os.path.basename(parts[1].lstrip('*')), parts[0]])
+        return {prop: sums}
+
+    @renderer
+    def missing(props):
+        return sorted(set(n for n, sha in props.getProperty(prop, []) if not _in_store(sha)))
+
+    def any_missing(step):
+        return len(step.build.getProperty(missing_prop, [])) > 0
+
+    @renderer
+    def pack_command(props):
+        workdir = props.getProperty('workdir')
+        return ['tar', 'cf', os.path.join(workdir, archive), '-C', workdir] + props.getProperty(missing_prop, [])
+
+    @renderer
+    def store_command(props):
+        command = ['artifact-store.py', '--store', ARTIFACT_STORE]
+        if props.getProperty(missing_prop):
+            command += ['--archive', incoming % {'prop:buildername': props.getProperty('buildername'),
+                                                 'prop:buildnumber': props.getProperty('buildnumber')}]
+        sums = props.getProperty(prop, [])
+        for (n, sha), (_, masterdir) in zip(sums, artifacts):
+            command.append(sha+':'+os.path.join(masterdir, n))
+        return command
+
+    # Checksum everything we built
+    f.addStep(
+        SetPropertyFromCommand(
+            name = name+'-checksum',
+            command = ['sha256sum'] + [Interpolate('%(prop:workdir)s/'+a) for a, _ in artifacts],
+            extract_fn = checksums,
+            haltOnFailure = True,
+            hideStepIf = success
+        )
+    )
+    # Pack and send only what the master does not have yet
+    f.addStep(
+        SetProperty(
+            name = name+'-missing',
+            property = missing_prop,
+            value = missing,
+            hideStepIf = success
+        )
+    )
+    f.addStep(
+        ShellCommand(
+            name = name+'-pack',
+            command = pack_command,
+            doStepIf = any_missing,
+            haltOnFailure = True,
+            hideStepIf = success
+        )
+    )
+    f.addStep(
+        FileUpload(
+            name = name+'-upload',
+            slavesrc = Interpolate('%(prop:workdir)s/'+archive),
+            masterdest = Interpolate(incoming),
+            doStepIf = any_missing,
+            hideStepIf = success
+        )
+    )
+    # Store by content, and link into place
+    f.addStep(
+        MasterShellCommand(
+            name = name+'-store',
+            command = store_command,
+            haltOnFailure = True,
+            hideStepIf = success
+        )
+    )
@@ -0,0 +1,71 @@
+from buildbot.steps.shell import ShellCommand, SetPropertyFromCommand
+
+from helpers import success
+
+## @brief Default maximum size of the compiler cache of one distro/arch
+CCACHE_MAX_SIZE = '4G'
+
+## @brief Get the ccache directory on the slave (must match scripts/ccache-setup.py)
+## @param distro Ubuntu distro (for instance, 'precise')
+## @param arch Architecture (for instance, 'amd64')
+def ccache_dir(distro, arch):
+    return '/var/cache/pbuilder/ccache-'+distro+'-'+arch
+
+## @brief Convert the output of 'ccache -s' to build properties
+def ccache_properties(rc, stdout, stderr):
+    props = dict()
+    if rc != 0:
+        return props
+    hits = 0
+    for line in stdout.splitlines():
+        # ccache 3.x: 'cache hit (direct)     123'
+        if line.startswith('cache hit'):
+            hits += _first_int(line)
+        elif line.startswith('cache miss'):
+            props['ccache_misses'] = _first_int(line)
+        elif line.startswith('cache size'):
+            props['ccache_size'] = line[len('cache size'):].strip()
+        # ccache 4.x: '  Hits:   10 / 20 (50.00 %)'
+        elif line.strip().startswith('Hits:') and 'ccache_hits' not in props:
+            props['ccache_hits'] = _first_int(line)
+        elif line.strip().startswith('Misses:') and 'ccache_misses' not in props:
+            props['ccache_misses'] = _first_int(line)
+        elif line.strip().startswith('Cache size'):
+            props['ccache_size'] = line.split(':', 1)[1].strip()
+    if 'ccache_hits' not in props:
+        props['ccache_hits'] = hits
+    return props
+
+def _first_int(line):
+    for token in line.replace(':', ' ').split():
+        if token.isdigit():
+            return int(token)
+    return 0
+
+## @brief Step that creates the persistent compiler cache on the slave
+## @param distro Ubuntu distro to build for (for instance, 'precise')
+## @param arch Architecture to build for (for instance, 'amd64')
+## @param pbuilderrc If set, path of a pbuilder config file enabling the cache
+## @param max_size Maximum size of the cache
+def ccache_setup_step(distro, arch, pbuilderrc=None, max_size=CCACHE_MAX_SIZE):
+    command = ['ccache-setup.py', distro, arch, max_size]
+    if pbuilderrc:
+        command.append(pbuilderrc)
+    return ShellCommand(
+        name = 'ccache-setup',
+        command = command,
+        hideStepIf = success
+    )
+
+## @brief Step that reports the cache statistics as build properties
+## @param distro Ubuntu distro to build for (for instance, 'precise')
+## @param arch Architecture to build for (for instance, 'amd64')
+def ccache_stats_step(distro, arch):
+    return SetPropertyFromCommand(
+        name = 'ccache-stats',
+        command = ['ccache-setup.py', '--stats', distro, arch],
+        extract_fn = ccache_properties,
+        alwaysRun = True,
+        flunkOnFailure = False,
+        hideStepIf = success
+    )
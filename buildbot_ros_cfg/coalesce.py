@@ -0,0 +1,19 @@
+from buildbot.process.build import Build
+
+from rdepends import REBUILD_PROPERTY
+
+## @brief mergeRequests for debbuilds. They always build the latest commit of
+##        their repository, so any pending requests can be built at once.
+##        Rebuilds of reverse dependencies are only merged with other rebuilds,
+##        since they do not trigger anything themselves.
+def merge_debbuild_requests(builder, req1, req2):
+    return (bool(req1.properties.getProperty(REBUILD_PROPERTY)) ==
+            bool(req2.properties.getProperty(REBUILD_PROPERTY)))
+
+## @brief Build that takes the revision of the newest of its merged requests,
+##        buildbot uses the oldest one
+class NewestRevisionBuild(Build):
+    def __init__(self, requests):
+        Build.__init__(self, requests)
+        newest = max(requests, key=lambda r: (r.submittedAt, r.id))
+        self.sources = newest.mergeSourceStampsWith([r for r in requests if r is not newest])
@@ -10,9 +10,16 @@ from buildbot_ros_cfg.ros_test import ros_testbuild
 from buildbot_ros_cfg.ros_doc import ros_docbuild
 from buildbot_ros_cfg.ros_deb_master import ros_branch_build
 
-from toposort import toposort_flatten
+from toposort import toposort, toposort_flatten, CircularDependencyError
+from collections import namedtuple
 #import ros_buildfarm
 #from ros_buildfarm.config import get_release_build_files
+
+## @brief Mirrors and keys for the jobs of one build type on one Ubuntu distro
+## other_mirror is the string for cowbuilder, bind_mirrors the space separated
+## local mirrors to bind mount, and keys a tuple of apt keys
+BuildConfig = namedtuple('BuildConfig', ['other_mirror', 'bind_mirrors', 'keys'])
+
 ## @brief The Oracle tells you all you need to build stuff
 class RosDistroOracle:
     # TODO: use release file blacklist and drop those packages.
@@ -27,6 +34,10 @@ class RosDistroOracle:
 
         self.build_order = {}
         self.build_files = {}
+        self.build_configs = {}
+        self.repo_depends = {}
+        self.triggers = {}
+        self.downstream = {}
         self.ordered_packages = {}
         for dist_name in distro_names:
             self.distributions[dist_name] = get_cached_distribution(index, dist_name, allow_lazy_load = True)
@@ -67,6 +78,7 @@ class RosDistroOracle:
 
             # this gives the order of the debbuilds
             order = list()
+            self.repo_depends[dist_name] = dict()
             for repo in dist.repositories.keys():
                 if dist.repositories[repo].release_repository == None:
                     continue
@@ -80,6 +92,7 @@ class RosDistroOracle:
                         if rd not in depends:
                             depends.append(rd)
                 self._insert(repo, depends, order)
+                self.repo_depends[dist_name][repo] = [rd for rd in depends if rd != repo]
             self.build_order[dist_name]['deb_jobs'] = order
 
             self.build_files[dist_name] = dict()
@@ -96,18 +109,36 @@ class RosDistroOracle:
                     packages_depends[package] = depends
                 self.ordered_packages[dist_name][repo_name] = toposort_flatten(packages_depends)
             # TODO: this is a bit hacky, come up with a better way to get 'correct' build
-            self.build_files[dist_name]['release'] = get_release_build_files(self.index, dist_name)[0]
-            self.build_files[dist_name]['source'] = get_source_build_files(self.index, dist_name)[0]
-            self.build_files[dist_name]['doc'] = get_doc_build_files(self.index, dist_name)[0]
+            all_build_files = {'release': get_release_build_files(self.index, dist_name),
+                               'source': get_source_build_files(self.index, dist_name),
+                               'doc': get_doc_build_files(self.index, dist_name)}
+            self.build_configs[dist_name] = dict()
+            for build, build_files in all_build_files.items():
+                self.build_files[dist_name][build] = build_files[0]
+                # mirrors and keys for every code name the jobs are generated for
+                code_names = set()
+                for build_file in build_files:
+                    for os_name in build_file.get_target_os_names():
+                        code_names |= set(build_file.get_target_os_code_names(os_name))
+                mirrors, keys = self._readConfig(build, dist_name)
+                self.build_configs[dist_name][build] = dict(
+                    (code_name, self._makeBuildConfig(mirrors, keys, code_name)) for code_name in code_names)
 
             # build a list of doc jobs, all doc jobs must be released,
             # but not all released things should need to be documented
             self.build_order[dist_name]['doc_jobs'] = list()
             doc = get_doc_file(self.index, dist_name)
             for repo in order:
-                if repo in doc.repositories.keys():
+                if repo in doc.repositories:
                     self.build_order[dist_name]['doc_jobs'].append(repo)
 
+            # the job triggered after each job, and everything downstream of each repository
+            self.triggers[dist_name] = dict()
+            for jobs in ['deb_jobs', 'doc_jobs']:
+                job_order = self.build_order[dist_name][jobs]
+                self.triggers[dist_name][jobs] = dict(zip(job_order[:-1], job_order[1:]))
+            self.downstream[dist_name] = self._downstreamClosure(self.repo_depends[dist_name])
+
     ## @brief Get the order to build debian packages within a single repository
     def getOrderedPackages(self, repo_name, dist_name):
         return self.ordered_packages[dist_name][repo_name]
@@ -126,19 +157,37 @@ class RosDistroOracle:
 
     ## @brief Get the job to trigger after this one
     def getDebTrigger(self, repo_name, dist_name):
-        try:
-            i = self.build_order[dist_name]['deb_jobs'].index(repo_name)
-            return [self.build_order[dist_name]['deb_jobs'][i+1], ]
-        except:
-            return None
+        return self._getTrigger('deb_jobs', repo_name, dist_name)
 
     ## @brief Get the job to trigger after this one
     def getDocTrigger(self, repo_name, dist_name):
-        i = self.build_order[dist_name]['doc_jobs'].index(repo_name)
+        return self._getTrigger('doc_jobs', repo_name, dist_name)
+
+    ## @brief Get the repositories that depend on a repository, directly or not
+    ## @param repo_name The repository that changed
+    ## @param dist_name The ROS distribution name
+    ## @returns A frozenset of repository names, empty if nothing depends on it
+    def getDownstream(self, repo_name, dist_name):
+        return self.downstream[dist_name].get(repo_name, frozenset())
+
+    ## @brief Get the order to rebuild the downstream repositories of a repository
+    ## @param repo_name The repository that changed
+    ## @param dist_name The ROS distribution name
+    ## @returns A list of lists of repository names. Each list only depends on
+    ##          repo_name and the previous lists, so its jobs can run in parallel.
+    def getRebuildOrder(self, repo_name, dist_name):
+        downstream = self.getDownstream(repo_name, dist_name)
+        depends = dict((repo, set(self.repo_depends[dist_name][repo]) & downstream)
+                       for repo in downstream)
         try:
-            return [self.build_order[dist_name]['doc_jobs'][i+1], ]
-        except:
-            return None
+            return [sorted(level) for level in toposort(depends)]
+        except CircularDependencyError:
+            # no order can satisfy everything, rebuild in the order of the debbuilds
+            return [[repo] for repo in self.build_order[dist_name]['deb_jobs'] if repo in downstream]
+
+    ## @brief Get the repositories that a repository directly depends on
+    def getRepositoryDepends(self, repo_name, dist_name):
+        return self.repo_depends[dist_name].get(repo_name, [])
 
     ## @brief Get the job to start nightly build with
     def getNightlyDebStart(self, dist_name):
@@ -156,53 +205,114 @@ class RosDistroOracle:
     def getDistroNames(self):
         return self.distros
 
+    ## @brief Get the mirrors and keys for jobs, computed once in the constructor
+    ## @param build The type of the build, 'release', 'source', or 'doc'
+    ## @param rosdistro The rosdistro name, 'groovy'
+    ## @param distro The Ubuntu distro, 'precise'
+    ## @returns A BuildConfig
+    def getBuildConfig(self, build, rosdistro, distro):
+        try:
+            return self.build_configs[rosdistro][build][distro]
+        except KeyError:
+            # not a target of the build files, should be rare
+            mirrors, keys = self._readConfig(build, rosdistro)
+            return self._makeBuildConfig(mirrors, keys, distro)
+
     ## @brief Get the mirrors for release jobs
     ## @param build The type of the build, 'release', 'source', or 'doc'
     ## @param rosdistro The rosdistro name, 'groovy'
     ## @param distro The Ubuntu distro, 'precise'
     def getOtherMirror(self, build, rosdistro, distro):
-        build_file = self.build_files[rosdistro][build]
-        if "_config" not in build_file._targets:
-            print("No _config in %s build file -- this is probably not right." % build)
-            return ""
-        if "apt_mirrors" not in build_file._targets["_config"]:
-            print("No apt_mirrors in %s _config -- this is probably not right." % build)
-            return ""
-        #TODO: source, doc should be updated to allow this:
-        #mirrors = build_file.get_target_configuration()['apt_mirrors']
-        mirrors = build_file._targets['_config']['apt_mirrors']
-        return '\n'.join(['deb '+mirror.replace('DISTRO',distro)+' |' for mirror in mirrors])
+        return self.getBuildConfig(build, rosdistro, distro).other_mirror
 
     ## @brief Get the mirrors that need to be bind mounted
     ## @param build The type of the build, 'release', 'source', or 'doc'
     ## @param rosdistro The rosdistro name, 'groovy'
     ## @param distro The Ubuntu distro, 'precise'
     def getBindMirrors(self, build, rosdistro, distro):
-        build_file = self.build_files[rosdistro][build]
-        if "_config" not in build_file._targets:
-            print("No _config in %s build file -- this is probably not right." % build)
-            return ""
-        if "apt_mirrors" not in build_file._targets["_config"]:
-            print("No apt_mirrors in %s _config -- this is probably not right." % build)
-            return ""
-        #TODO: source, doc should be updated to allow this:
-        #mirrors = build_file.get_target_configuration()['apt_mirrors']
-        mirrors = build_file._targets['_config']['apt_mirrors']
-        return ' '.join([m[7:m.find(' ')] for m in mirrors if m.startswith('file://')])
+        return self.getBuildConfig(build, rosdistro, distro).bind_mirrors
 
     ## @brief Get the keys for release jobs
     ## @param build The type of the build, 'release', 'source', or 'doc'
     def getKeys(self, build, rosdistro):
+        try:
+            configs = self.build_configs[rosdistro][build]
+        except KeyError:
+            return list(self._readConfig(build, rosdistro)[1])
+        # keys do not depend on the Ubuntu distro
+        for config in configs.values():
+            return list(config.keys)
+        return list(self._readConfig(build, rosdistro)[1])
+
+    ## @brief Read the apt mirrors and keys from the _config of a build file
+    ## @returns Tuple of (mirrors, keys), mirrors is None if not configured
+    def _readConfig(self, build, rosdistro):
         build_file = self.build_files[rosdistro][build]
         if "_config" not in build_file._targets:
             print("No _config in %s build file -- this is probably not right." % build)
-            return []
-        if "apt_keys" not in build_file._targets["_config"]:
-            print("WARNING: No apt_keys in %s _config." % build)
-            return []
+            return None, ()
         #TODO: source, doc should be updated to allow this:
-        #return build_file.get_target_configuration()['apt_keys']
-        return build_file._targets['_config']['apt_keys']
+        #mirrors = build_file.get_target_configuration()['apt_mirrors']
+        config = build_file._targets["_config"]
+        mirrors = None
+        if "apt_mirrors" not in config:
+            print("No apt_mirrors in %s _config -- this is probably not right." % build)
+        else:
+            mirrors = tuple(config['apt_mirrors'])
+        keys = ()
+        if "apt_keys" not in config:
+            print("WARNING: No apt_keys in %s _config." % build)
+        else:
+            keys = tuple(config['apt_keys'])
+        return mirrors, keys
+
+    ## @brief Build the BuildConfig of one Ubuntu distro
+    def _makeBuildConfig(self, mirrors, keys, distro):
+        if mirrors is None:
+            return BuildConfig('', '', keys)
+        return BuildConfig('\n'.join(['deb '+mirror.replace('DISTRO',distro)+' |' for mirror in mirrors]),
+                           ' '.join([m[7:m.find(' ')] for m in mirrors if m.startswith('file://')]),
+                           keys)
+
+    def _getTrigger(self, jobs, repo_name, dist_name):
+        try:
+            return [self.triggers[dist_name][jobs][repo_name], ]
+        except KeyError:
+            return None
+
+    ## @brief Compute the downstream repositories of every repository
+    ## @param depends Dictionary of repository -> list of repositories it depends on
+    ## @returns Dictionary of repository -> frozenset of downstream repositories
+    def _downstreamClosure(self, depends):
+        dependents = dict((repo, set()) for repo in depends)
+        for repo, deps in depends.items():
+            for dep in deps:
+                dependents.setdefault(dep, set()).add(repo)
+        closure = dict()
+        try:
+            # visit dependents before the repositories they depend on,
+            # so each closure is the union of the closures of its dependents
+            order = toposort_flatten(dict((repo, set(deps)) for repo, deps in depends.items()))
+        except CircularDependencyError:
+            # run dependencies can be circular, walk the graph for each repository
+            for repo in dependents:
+                down = set()
+                todo = list(dependents[repo])
+                while todo:
+                    d = todo.pop()
+                    if d not in down:
+                        down.add(d)
+                        todo.extend(dependents[d])
+                down.discard(repo)
+                closure[repo] = frozenset(down)
+            return closure
+        for repo in reversed(order):
+            down = set()
+            for d in dependents[repo]:
+                down.add(d)
+                down |= closure[d]
+            closure[repo] = frozenset(down)
+        return closure
 
     def _insert(self, name, depends, order):
         for i in range(len(order)):
@@ -211,16 +321,26 @@ class RosDistroOracle:
                 return
         order.insert(0, name)
 
+## @brief Get the rebuild order of the downstream repositories that have a job
+def _rebuild_order(oracle, name, distro, configured):
+    levels = [[repo for repo in level if repo in configured] for level in oracle.getRebuildOrder(name, distro)]
+    return [level for level in levels if level]
+
 ## @brief Create debbuilders from release file
 ## @param c The Buildmasterconfig
 ## @param oracle The rosdistro oracle
 ## @param distro The distro to configure for ('groovy', 'hydro', etc)
 ## @param builders list of builders that this job can run on
+## @param lazy Only create the build steps when a builder first builds
+## @param rebuild_rdepends Rebuild the downstream repositories after a successful build
 ## @returns A list of debbuilder names created
-def debbuilders_from_rosdistro(c, oracle, distro, builders):
+def debbuilders_from_rosdistro(c, oracle, distro, builders, lazy = False, rebuild_rdepends = False):
     rel = get_release_file(oracle.getIndex(), distro)
     build_files = get_release_build_files(oracle.getIndex(), distro)
     jobs = list()
+    # only the jobs configured here have a debtrigger
+    configured = set(name for name in rel.repositories.keys()
+                     if rel.repositories[name].version != None and rel.repositories[name].type == 'git')
 
     for name in rel.repositories.keys():
         if rel.repositories[name].version == None:
@@ -229,9 +349,12 @@ def debbuilders_from_rosdistro(c, oracle, distro, builders):
         if rel.repositories[name].type != 'git':
             print('Cannot configure ros_debbuild for %s, as it is not a git repository' % name)
             continue
+        trigger = oracle.getDebTrigger(name, distro)
+        rdepends = _rebuild_order(oracle, name, distro, configured) if rebuild_rdepends else None
         for build_file in build_files:
             for os in build_file.get_target_os_names():
                 for code_name in build_file.get_target_os_code_names(os):
+                    config = oracle.getBuildConfig('release', distro, code_name)
                     for arch in build_file.get_target_arches(os, code_name):
                         print('Configuring ros_debbuild job for: %s_%s_%s' % (name, code_name, arch))
                         try:
@@ -247,9 +370,11 @@ def debbuilders_from_rosdistro(c, oracle, distro, builders):
                                                  distro,
                                                  rel.repositories[name].version,  # release_version
                                                  builders,
-                                                 oracle.getOtherMirror('release', distro, code_name),
-                                                 oracle.getKeys('release', distro),
-                                                 oracle.getDebTrigger(name, distro)))
+                                                 config.other_mirror,
+                                                 list(config.keys),
+                                                 trigger,
+                                                 rdepends = rdepends,
+                                                 lazy = lazy))
     return jobs
 
 ## @brief Create branch debbuilders from source file
@@ -257,11 +382,16 @@ def debbuilders_from_rosdistro(c, oracle, distro, builders):
 ## @param oracle The rosdistro oracle
 ## @param distro The distro to configure for ('groovy', 'hydro', etc)
 ## @param builders list of builders that this job can run on
+## @param lazy Only create the build steps when a builder first builds
+## @param rebuild_rdepends Rebuild the downstream repositories after a successful build
 ## @returns A list of debbuilder names created
-def branch_debbuilders_from_rosdistro(c, oracle, distro, builders):
+def branch_debbuilders_from_rosdistro(c, oracle, distro, builders, lazy = False, rebuild_rdepends = False):
     source = get_source_file(oracle.getIndex(), distro)
     build_files = get_source_build_files(oracle.getIndex(), distro)
     jobs = list()
+    # only the jobs configured here have a debtrigger
+    configured = set(name for name in source.repositories.keys()
+                     if source.repositories[name].version != None and source.repositories[name].type == 'git')
 
     for name in source.repositories.keys():
         if source.repositories[name].version == None:
@@ -270,9 +400,12 @@ def branch_debbuilders_from_rosdistro(c, oracle, distro, builders):
         if source.repositories[name].type != 'git':
             print('Cannot configure ros_debbuild for %s, as it is not a git repository' % name)
             continue
+        trigger = oracle.getDebTrigger(name, distro)
+        rdepends = _rebuild_order(oracle, name, distro, configured) if rebuild_rdepends else None
         for build_file in build_files:
             for os in build_file.get_target_os_names():
                 for code_name in build_file.get_target_os_code_names(os):
+                    config = oracle.getBuildConfig('source', distro, code_name)
                     for arch in build_file.get_target_arches(os, code_name):
                         print('Configuring ros_debbuild job for: %s_%s_%s' % (name, code_name, arch))
                         try:
@@ -288,9 +421,11 @@ def branch_debbuilders_from_rosdistro(c, oracle, distro, builders):
                                                      arch,
                                                      distro,
                                                      builders,
-                                                     oracle.getOtherMirror('source', distro, code_name),
-                                                     oracle.getKeys('source', distro),
-                                                     oracle.getDebTrigger(name, distro)))
+                                                     config.other_mirror,
+                                                     list(config.keys),
+                                                     trigger,
+                                                     rdepends = rdepends,
+                                                     lazy = lazy))
     return jobs
 
 ## @brief Create testbuilders from source file
@@ -299,8 +434,9 @@ def branch_debbuilders_from_rosdistro(c, oracle, distro, builders):
 ## @param distro The distro to configure for ('groovy', 'hydro', etc)
 ## @param builders list of builders that this job can run on
 ## @param tokens A dictionary of repo -> oauth_tokens, used for PR builders
+## @param incremental Reuse the build tree between test builds of the same branch
 ## @returns A list of debbuilder names created
-def testbuilders_from_rosdistro(c, oracle, distro, builders, tokens = None):
+def testbuilders_from_rosdistro(c, oracle, distro, builders, tokens = None, incremental = False):
     tokens = tokens or dict()
 
     source = get_source_file(oracle.getIndex(), distro)
@@ -315,6 +451,7 @@ def testbuilders_from_rosdistro(c, oracle, distro, builders, tokens = None):
             added_pr_builder = False
             for os in build_file.get_target_os_names():
                 for code_name in build_file.get_target_os_code_names(os):
+                    config = oracle.getBuildConfig('source', distro, code_name)
                     for arch in build_file.get_target_arches(os, code_name):
                         print('Configuring ros_testbuild job for: %s_%s_%s' % (name, code_name, arch))
                         jobs.append(ros_testbuild(c,
@@ -325,8 +462,9 @@ def testbuilders_from_rosdistro(c, oracle, distro, builders, tokens = None):
                                                   arch,
                                                   distro,
                                                   builders,
-                                                  oracle.getOtherMirror('source', distro, code_name),
-                                                  oracle.getKeys('source', distro),
+                                                  config.other_mirror,
+                                                  list(config.keys),
+                                                  incremental=incremental
                                                   ))
                         if not added_pr_builder:
                             try:
@@ -340,9 +478,10 @@ def testbuilders_from_rosdistro(c, oracle, distro, builders, tokens = None):
                                                           arch,
                                                           distro,
                                                           builders,
-                                                          oracle.getOtherMirror('source', distro, code_name),
-                                                          oracle.getKeys('source', distro),
-                                                          token=token
+                                                          config.other_mirror,
+                                                          list(config.keys),
+                                                          token=token,
+                                                          incremental=incremental
                                                           ))
                             except KeyError:
                                 print("Not adding Pull Request builder for %s" % name)
@@ -354,8 +493,9 @@ def testbuilders_from_rosdistro(c, oracle, distro, builders, tokens = None):
 ## @param oracle The rosdistro oracle
 ## @param distro The distro to configure for ('groovy', 'hydro', etc)
 ## @param builders list of builders that this job can run on
+## @param incremental Only regenerate and upload docs of changed packages
 ## @returns A list of debbuilder names created
-def docbuilders_from_rosdistro(c, oracle, distro, builders):
+def docbuilders_from_rosdistro(c, oracle, distro, builders, incremental = False):
     doc = get_doc_file(oracle.getIndex(), distro)
     build_files = get_doc_build_files(oracle.getIndex(), distro)
     jobs = list()
@@ -364,9 +504,11 @@ def docbuilders_from_rosdistro(c, oracle, distro, builders):
         if doc.repositories[name].type != 'git':
             print('Cannot configure ros_debbuild for %s, as it is not a git repository' % name)
             continue
+        trigger = oracle.getDocTrigger(name, distro)
         for build_file in build_files:
             for os in build_file.get_target_os_names():
                 for code_name in build_file.get_target_os_code_names(os):
+                    config = oracle.getBuildConfig('doc', distro, code_name)
                     for arch in build_file.get_target_arches(os, code_name):
                         print('Configuring ros_docbuild job for: %s_%s_%s' % (name, code_name, arch))
                         jobs.append(ros_docbuild(c,
@@ -377,7 +519,8 @@ def docbuilders_from_rosdistro(c, oracle, distro, builders):
                                                  arch,
                                                  distro,
                                                  builders,
-                                                 oracle.getOtherMirror('doc', distro, code_name),
-                                                 oracle.getKeys('doc', distro),
-                                                 oracle.getDocTrigger(name, distro)))
+                                                 config.other_mirror,
+                                                 list(config.keys),
+                                                 trigger,
+                                                 incremental = incremental))
     return jobs
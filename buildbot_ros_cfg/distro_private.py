@@ -5,26 +5,86 @@
 
 from __future__ import print_function
 from rosdistro import *
-import subprocess, sys
+from buildbot import config
+import fcntl, hashlib, os, subprocess, sys, time
+
+## @brief Default directory for the cached checkouts, relative to the master directory
+CACHE_DIR = 'rosdistro-cache'
 
 ## @brief Call a command
-def call(command):
-    helper = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, close_fds=True)
-    while True:
-        output = helper.stdout.readline().decode('utf8', 'replace')
-        if helper.returncode is not None or not output:
-            break
-    helper.wait()
+## @returns Tuple of (success, output)
+def call(command, cwd=None):
+    helper = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, close_fds=True, cwd=cwd)
+    output = helper.communicate()[0].decode('utf8', 'replace')
     if helper.returncode != 0:
         print('Failed to execute command "%s" with return code %d' % (command, helper.returncode))
-        return
+        print(output)
+        return False, output
+    return True, output
 
-## @brief Function used to get a private index, for which we need to do git+ssh checkout
-def get_private_index(url, branch = None):
-    print('Getting private rosdistro from: %s' % url)
-    call(['rm', '-rf', '/tmp/rosdistro'])
+## @brief Get the commit the remote branch points to, or None if unknown
+def remote_head(url, branch = None):
+    ok, output = call(['git', 'ls-remote', url, 'refs/heads/'+branch if branch else 'HEAD'])
+    if not ok or not output.split():
+        return None
+    return output.split()[0]
+
+## @brief Get the commit checked out in path, or None if there is no checkout
+def local_head(path):
+    if not os.path.isdir(os.path.join(path, '.git')):
+        return None
+    ok, output = call(['git', 'rev-parse', 'HEAD'], cwd=path)
+    return output.strip() if ok else None
+
+## @brief Update (or create) a shallow checkout of the rosdistro. When the
+##        remote cannot be reached, the cached checkout is used as it is.
+## @returns True if the cached checkout was used as it is
+def update_checkout(url, branch, path):
+    local = local_head(path)
+    remote = remote_head(url, branch)
+    if local is not None:
+        if remote is None:
+            print('Unable to reach %s, using the cached checkout of %s' % (url, local))
+            return True
+        if remote == local:
+            return True
+        ok, _ = call(['git', 'fetch', '--depth', '1', 'origin', branch or 'HEAD'], cwd=path)
+        if not ok:
+            print('Unable to fetch %s, using the cached checkout of %s' % (url, local))
+            return True
+        ok, _ = call(['git', 'reset', '--hard', 'FETCH_HEAD'], cwd=path)
+        if ok:
+            return False
+        print('Unable to update %s, cloning again' % path)
+    # clone next to the checkout, it is only replaced once the clone worked
+    clone = path+'.clone'
+    call(['rm', '-rf', clone])
     if branch:
-        call(['git', 'clone', '--single-branch', '-b', branch, url, '/tmp/rosdistro'])
+        ok, output = call(['git', 'clone', '--depth', '1', '--single-branch', '-b', branch, url, clone])
     else:
-        call(['git', 'clone', '--single-branch', url, '/tmp/rosdistro'])
-    return get_index( 'file:///tmp/rosdistro/index.yaml' )
+        ok, output = call(['git', 'clone', '--depth', '1', '--single-branch', url, clone])
+    if not ok:
+        call(['rm', '-rf', clone])
+        raise config.ConfigErrors(['Unable to clone the rosdistro %s: %s' % (url, output.strip())])
+    call(['rm', '-rf', path])
+    os.rename(clone, path)
+    return False
+
+## @brief Function used to get a private index, for which we need to do git+ssh checkout
+## @param url URL of the rosdistro repository
+## @param branch Branch to use, or None for the default branch
+## @param cache_dir Directory holding the cached checkouts
+def get_private_index(url, branch = None, cache_dir = CACHE_DIR):
+    print('Getting private rosdistro from: %s' % url)
+    cache_dir = os.path.abspath(cache_dir)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    path = os.path.join(cache_dir, hashlib.sha1((url+'#'+(branch or '')).encode('utf8')).hexdigest()[:12])
+    start = time.time()
+    # only one reconfig may update the checkout at a time
+    with open(path+'.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        hit = update_checkout(url, branch, path)
+        index = get_index('file://'+path+'/index.yaml')
+    print('rosdistro checkout %s in %.2fs (%s)' % ('cache hit' if hit else 'updated', time.time() - start, path))
+    return index
@@ -0,0 +1,24 @@
+import hashlib
+
+from buildbot.steps.shell import ShellCommand
+
+from helpers import success
+
+## @brief Directory on the slaves holding the bare mirrors (must be writable by the slave user)
+GIT_MIRROR_ROOT = '/var/cache/buildbot-git'
+
+## @brief Get the path of the bare mirror of a repository on the slave
+## @param url URL of the repository
+def mirror_dir(url):
+    return GIT_MIRROR_ROOT+'/'+hashlib.sha1(url.encode('utf8')).hexdigest()+'.git'
+
+## @brief Step that creates or updates the bare mirror of a repository, Git steps
+##        for the same url can then pass reference = mirror_dir(url)
+## @param url URL of the repository
+def git_mirror_step(url):
+    return ShellCommand(
+        name = 'git-mirror',
+        command = ['git-mirror.py', url, mirror_dir(url)],
+        haltOnFailure = True,
+        hideStepIf = success
+    )
@@ -19,36 +19,50 @@
 # Extraneous code has been removed (e.g. commit-related methods).
 # A modification has been added using name to allow for multiple instances.
 
+import calendar
 import itertools
 import os
 import requests
+import time
 import urllib
+from collections import OrderedDict
 from datetime import datetime
 
 from twisted.internet import defer
-from twisted.internet import utils
+from twisted.internet import threads
 from twisted.python import log
 
 from buildbot import config
 from buildbot.changes import base
 from buildbot.util.state import StateMixin
 
+from buildbot_ros_cfg.metrics import PR_CHANGE_LATENCY, PR_POLL_DURATION, PR_POLL_ERRORS
+
+# number of pull requests per page, the most GitHub allows
+PER_PAGE = 100
+# number of pull request heads remembered, the least recently updated are forgotten
+MAX_HEADS = 10000
+
 
 class GitPRPoller(base.PollingChangeSource, StateMixin):
 
     """This source will poll a remote git repo for pull requests
-    and submit changes for the PR's branches to the change master."""
+    and submit changes for the PR's branches to the change master.
+    When a pull request gets a new head, running builds of its previous
+    head on builderNames are stopped."""
 
     compare_attrs = ["repourl", "branches", "workdir",
                      "pollInterval", "gitbin", "usetimestamps",
-                     "category", "project", "pollAtLaunch"]
+                     "category", "project", "pollAtLaunch",
+                     "builderNames"]
 
     def __init__(self, repourl, name, branches=None, branch=None,
                  workdir=None, pollInterval=10 * 60,
                  gitbin='git', usetimestamps=True,
                  category=None, project=None,
                  pollinterval=-2, fetch_refspec=None,
-                 encoding='utf-8', pollAtLaunch=False, token=''):
+                 encoding='utf-8', pollAtLaunch=False, token='',
+                 builderNames=None):
 
         # for backward compatibility; the parameter used to be spelled with 'i'
         if pollinterval != -2:
@@ -62,6 +76,10 @@ class GitPRPoller(base.PollingChangeSource, StateMixin):
             project = ''
 
         self.repourl = repourl
+        if branch and branches:
+            config.error("GitPRPoller: can't specify both branch and branches")
+        elif branch:
+            branches = [branch]
         self.branches = branches
         self.encoding = encoding
         self.gitbin = gitbin
@@ -71,11 +89,21 @@ class GitPRPoller(base.PollingChangeSource, StateMixin):
         self.project = project
         self.changeCount = 0
         self.lastRev = {}
-        self.lastRevs = {}
+        # 'owner/repo/branch' -> head, least recently updated first
+        self.lastRevs = OrderedDict()
+        # head -> number of pull requests at it, to find built revisions at once
+        self.seenRevs = {}
 
         self.pull_requests = []
+        self.builderNames = builderNames or []
 
         self.auth_header = {'Authorization': 'token ' + token}
+        # base branch -> etag of the first page of its pull requests
+        self.etags = {}
+        # updated_at of the most recent pull request processed
+        self.cursor = None
+        # polls and pull requests from the webhook are processed one at a time
+        self.lock = defer.DeferredLock()
 
         if fetch_refspec is not None:
             config.error("GitPoller: fetch_refspec is no longer supported. "
@@ -90,9 +118,19 @@ class GitPRPoller(base.PollingChangeSource, StateMixin):
         d = self.getState('lastRevs', {})
 
         def setLastRevs(lastRevs):
-            self.lastRevs = lastRevs
+            # the state used to be a dict, it is now a list of pairs to keep the order
+            if isinstance(lastRevs, dict):
+                lastRevs = sorted(lastRevs.items())
+            for revkey, rev in lastRevs:
+                self._set_head(revkey, rev)
         d.addCallback(setLastRevs)
 
+        d.addCallback(lambda _: self.getState('cursor', None))
+
+        def setCursor(cursor):
+            self.cursor = cursor
+        d.addCallback(setCursor)
+
         d.addCallback(lambda _:
                       base.PollingChangeSource.startService(self))
         d.addErrback(log.err, 'while initializing GitPRPoller repository')
@@ -110,50 +148,89 @@ class GitPRPoller(base.PollingChangeSource, StateMixin):
 
     # like _getBranches but for pull requests
     def _get_pull_requests(self):
+        """
+        Get the pull requests updated since the last poll, for each of the
+        base branches (all of them if branches is not set). Pull requests
+        are listed by most recently updated, so pages are only read until
+        one older than the cursor. This blocks, it runs in a thread.
+
+        Returns the pull requests, and the etags of the first pages, to be
+        kept once the pull requests were all added.
+        """
         # get owner+repo from repo url (e.g. 'git@github.com:owner/reponame.git')
         owner_repo = (self.repourl.split(":")[1]).split(".")[0]
         url = "https://api.github.com/repos/" + owner_repo + "/pulls"
-        r = requests.get(url, headers=self.auth_header)
-        
-        # Store xtag for next use to prevent spamming GitHub
-        self.auth_header.update({'If-None-Match': r.headers['etag']})
-        log.msg("etag: %s" % r.headers['etag'])
-        log.msg(r.status_code)
-        log.msg(r.request.headers)
-
-        # Return nothing if there are no pull_requests
-        if r.status_code == 304:
-            log.msg("No changes found for %s" % owner_repo)
-            return []
-
-        prs = r.json()
 
         pr_info = []
-        # process PRs for branches
-        for pr in prs:
-            infodict = {'rev': pr['head']['sha'],
-                        'branch': pr['head']['ref'],
-                        'repo_name': pr['head']['repo']['name'],
-                        'owner': pr['head']['repo']['owner']['login'],
-                        'repo_url':  pr['head']['repo']['ssh_url'],
-                        'timestamp': pr['updated_at']}
-            pr_info.append(infodict)
-            log.msg("got info for rev %s at %s/%s/%s" % (infodict['rev'],
-                                                         infodict['owner'],
-                                                         infodict['repo_name'],
-                                                         infodict['branch']))
-        return pr_info
+        etags = {}
+        for base_branch in (self.branches or [None]):
+            params = {'state': 'open', 'sort': 'updated', 'direction': 'desc',
+                      'per_page': PER_PAGE}
+            if base_branch:
+                params['base'] = base_branch
+            # Store etag of the first page for next use to prevent spamming GitHub
+            headers = dict(self.auth_header)
+            if base_branch in self.etags:
+                headers['If-None-Match'] = self.etags[base_branch]
+            r = requests.get(url, params=params, headers=headers)
+
+            # Nothing to do if there are no new pull_requests
+            if r.status_code == 304:
+                log.msg("No changes found for %s" % owner_repo)
+                continue
+            pages = 1
+            while True:
+                if r.status_code != 200:
+                    raise EnvironmentError('listing the pull requests of %s failed: HTTP %d %s'
+                                           % (owner_repo, r.status_code, r.text[:200]))
+                if pages == 1 and 'etag' in r.headers:
+                    etags[base_branch] = r.headers['etag']
+                older = False
+                # process PRs for branches
+                for pr in r.json():
+                    if self.cursor and pr['updated_at'] < self.cursor:
+                        # this and the next ones were processed by a previous poll
+                        older = True
+                        break
+                    if not pr['head'].get('repo'):
+                        # the fork was deleted, there is nothing to build
+                        continue
+                    infodict = pull_request_info(pr)
+                    pr_info.append(infodict)
+                    log.msg("got info for rev %s at %s/%s/%s" % (infodict['rev'],
+                                                                 infodict['owner'],
+                                                                 infodict['repo_name'],
+                                                                 infodict['branch']))
+                if older or 'next' not in r.links:
+                    break
+                r = requests.get(r.links['next']['url'], headers=self.auth_header)
+                pages += 1
+            log.msg("read %d page(s) of pull requests of %s" % (pages, owner_repo))
+        return pr_info, etags
+
+    def watches(self, base_branch):
+        """
+        Whether pull requests to base_branch are built.
+        """
+        return not self.branches or base_branch in self.branches
 
     # main polling method
-    @defer.inlineCallbacks
     def poll(self):
-        # make an empty repository
-        yield self._dovccmd('init', ['--bare', self.workdir])
+        return self.lock.run(self._poll)
+
+    @defer.inlineCallbacks
+    def _poll(self):
+        start = time.time()
 
         # grab pull request information
-        pull_requests = yield self._get_pull_requests()
+        try:
+            pull_requests, etags = yield threads.deferToThread(self._get_pull_requests)
+        except Exception:
+            PR_POLL_ERRORS.inc(repository=self.repourl)
+            raise
 
         revs = {}
+        failed = False
 
         for pull_request in pull_requests:
             try:
@@ -162,12 +239,38 @@ class GitPRPoller(base.PollingChangeSource, StateMixin):
                          + "/" + pull_request['branch'])
                 revs.update({revkey: pull_request['rev']})
             except Exception:
+                failed = True
+                PR_POLL_ERRORS.inc(repository=self.repourl)
                 log.err(_why="trying to poll branch %s of %s"
                         % (pull_request['branch'], pull_request['repo_url']) )
 
-        # update revs with {'owner/repo/branch': 'rev'}
-        self.lastRevs.update(revs)
-        yield self.setState('lastRevs', self.lastRevs)
+        # update lastRevs with {'owner/repo/branch': 'rev'}
+        if revs:
+            for revkey, rev in revs.items():
+                self._set_head(revkey, rev)
+            yield self.setState('lastRevs', self.lastRevs.items())
+        # only move on once all the pull requests made it, the others are read again next poll
+        if not failed:
+            self.etags.update(etags)
+        if pull_requests and not failed:
+            self.cursor = max([self.cursor] + [pr['timestamp'] for pr in pull_requests])
+            yield self.setState('cursor', self.cursor)
+        PR_POLL_DURATION.observe(time.time() - start, repository=self.repourl)
+
+    def addPullRequest(self, pull_request):
+        """
+        Add the change of a pull request received from the webhook, see
+        pull_request_info for its fields.
+        """
+        return self.lock.run(self._add_pull_request, pull_request)
+
+    @defer.inlineCallbacks
+    def _add_pull_request(self, pull_request):
+        yield self._process_changes(pull_request)
+        revkey = (pull_request['owner'] + "/" + pull_request['repo_name']
+                  + "/" + pull_request['branch'])
+        self._set_head(revkey, pull_request['rev'])
+        yield self.setState('lastRevs', self.lastRevs.items())
 
     @defer.inlineCallbacks
     def _process_changes(self, pull_request):
@@ -183,7 +286,7 @@ class GitPRPoller(base.PollingChangeSource, StateMixin):
 
         # check if rev is new
         
-        if newRev in self.lastRevs.values():
+        if newRev in self.seenRevs:
             # original code had a pass instead
             log.msg("%s found in lastRevs, so skipping %s/%s/%s" 
                 % (pull_request['rev'],
@@ -197,6 +300,9 @@ class GitPRPoller(base.PollingChangeSource, StateMixin):
         year, month, day = [int(i) for i in stamp_date.split('-')]
         hour, minute, second = [int(i) for i in stamp_time[:-1].split(':')] 
         new_stamp = datetime(year, month, day, hour, minute, second)
+        # how long the pull request waited for us, GitHub timestamps are UTC
+        PR_CHANGE_LATENCY.observe(max(time.time() - calendar.timegm(new_stamp.timetuple()), 0),
+                                  repository=self.repourl)
 
         # getting here means the pull request hasn't been built yet
         # needs all values put in or SQLAlchemy throws a fit
@@ -211,22 +317,60 @@ class GitPRPoller(base.PollingChangeSource, StateMixin):
             repository=pull_request['repo_url'],
             src='git')
 
-    def _dovccmd(self, command, args, path=None):
-        d = utils.getProcessOutputAndValue(self.gitbin,
-                                           [command] + args, path=path, env=os.environ)
-
-        def _convert_nonzero_to_failure(res,
-                                        command,
-                                        args,
-                                        path):
-            "utility to handle the result of getProcessOutputAndValue"
-            (stdout, stderr, code) = res
-            if code != 0:
-                raise EnvironmentError('command %s %s in %s on repourl %s failed with exit code %d: %s'
-                                       % (command, args, path, self.repourl, code, stderr))
-            return stdout.strip()
-        d.addCallback(_convert_nonzero_to_failure,
-                      command,
-                      args,
-                      path)
-        return d
+        # an older head of this pull request is not worth building anymore
+        revkey = (pull_request['owner'] + "/" + pull_request['repo_name']
+                  + "/" + pull_request['branch'])
+        if self.lastRevs.get(revkey, newRev) != newRev:
+            self._cancel_superseded(pull_request)
+
+    def _cancel_superseded(self, pull_request):
+        """
+        Stop the running builds of a pull request that are not building
+        its current head. Pending requests are merged by the builders.
+        """
+        for name in self.builderNames:
+            builder = self.master.botmaster.builders.get(name)
+            if builder is None:
+                continue
+            for build in list(builder.building):
+                for ss in build.getAllSourceStamps():
+                    if (ss.repository == pull_request['repo_url'] and
+                            ss.branch == pull_request['branch'] and
+                            ss.revision != pull_request['rev']):
+                        log.msg("stopping build of %s on %s, superseded by %s"
+                                % (ss.revision, name, pull_request['rev']))
+                        build.stopBuild("superseded by %s" % pull_request['rev'])
+                        break
+
+    def _set_head(self, revkey, rev):
+        """
+        Remember the head of a pull request, forgetting the least recently
+        updated pull requests beyond MAX_HEADS.
+        """
+        self._forget_head(revkey)
+        self.lastRevs[revkey] = rev
+        self.seenRevs[rev] = self.seenRevs.get(rev, 0) + 1
+        while len(self.lastRevs) > MAX_HEADS:
+            self._forget_head(next(iter(self.lastRevs)))
+
+    def _forget_head(self, revkey):
+        rev = self.lastRevs.pop(revkey, None)
+        if rev is None:
+            return
+        if self.seenRevs[rev] > 1:
+            self.seenRevs[rev] -= 1
+        else:
+            del self.seenRevs[rev]
+
+
+def pull_request_info(pr):
+    """
+    Get what the poller needs of a pull request, as given by the GitHub API
+    (and in the pull_request events of the webhook).
+    """
+    return {'rev': pr['head']['sha'],
+            'branch': pr['head']['ref'],
+            'repo_name': pr['head']['repo']['name'],
+            'owner': pr['head']['repo']['owner']['login'],
+            'repo_url':  pr['head']['repo']['ssh_url'],
+            'timestamp': pr['updated_at']}
@@ -0,0 +1,235 @@
+import json
+import time
+from collections import OrderedDict
+from StringIO import StringIO
+
+from twisted.internet import defer, reactor
+from twisted.python import log
+from twisted.web.client import Agent, FileBodyProducer, HTTPConnectionPool, readBody
+from twisted.web.http_headers import Headers
+
+from buildbot.process.properties import Interpolate
+from buildbot.status.base import StatusReceiverMultiService
+from buildbot.status.results import SUCCESS, FAILURE
+
+from metrics import GITHUB_RATE_REMAINING, GITHUB_STATUS_QUEUE, GITHUB_STATUSES
+
+## @brief Where the GitHub API is
+GITHUB_API = 'https://api.github.com'
+## @brief Number of statuses sent at once
+CONCURRENCY = 4
+## @brief Seconds to wait after a failed request, doubled for each retry
+RETRY_DELAY = 5
+## @brief Number of times a status is retried before giving up
+RETRIES = 5
+## @brief Seconds to wait when rate limited, if GitHub does not tell
+RATE_LIMIT_DELAY = 60
+
+# GitHub has success, failure, error and pending, any other result is an error
+_STATES = {SUCCESS: 'success', FAILURE: 'failure'}
+
+## @brief Status receiver that reports the builds of pull requests to GitHub as commit statuses
+##
+## One reporter serves all the repositories: statuses are queued, a status that
+## has not been sent yet is replaced by a newer one for the same commit and
+## builder, and they are sent a few at a time over persistent connections.
+## The statuses of a commit and builder are sent one after the other, and a
+## status that failed is only sent again if no newer one was queued since.
+## When GitHub rate limits, sending waits for the limit to reset.
+class GitHubStatusReporter(StatusReceiverMultiService):
+    compare_attrs = ['repositories', 'concurrency', 'baseURL']
+
+    ## @brief Constructor
+    ## @param concurrency Number of statuses sent at once
+    ## @param baseURL Where the GitHub API is
+    def __init__(self, concurrency=CONCURRENCY, baseURL=GITHUB_API):
+        StatusReceiverMultiService.__init__(self)
+        self.concurrency = concurrency
+        self.baseURL = baseURL
+        # builder name -> (token, repository owner, repository name)
+        self.repositories = dict()
+        # (owner, name, sha, context) -> status, oldest first
+        self.queue = OrderedDict()
+        # key -> generation of its latest status, while it is queued or being sent
+        self.generations = dict()
+        # keys with a status being sent
+        self.inflight = set()
+        self.sending = 0
+        self.paused_until = 0
+        self.resume_call = None
+        self.status = None
+        self.pool = HTTPConnectionPool(reactor, persistent=True)
+        self.pool.maxPersistentPerHost = concurrency
+        self.agent = Agent(reactor, pool=self.pool)
+
+    ## @brief Report the builds of a builder
+    ## @param builderName The builder
+    ## @param token OAuth token for the repository
+    ## @param repoOwner Owner of the repository on GitHub
+    ## @param repoName Name of the repository on GitHub
+    def addRepository(self, builderName, token, repoOwner, repoName):
+        self.repositories[builderName] = (token, repoOwner, repoName)
+
+    def startService(self):
+        StatusReceiverMultiService.startService(self)
+        self.status = self.parent.getStatus()
+        self.status.subscribe(self)
+
+    def stopService(self):
+        self.status.unsubscribe(self)
+        if self.resume_call and self.resume_call.active():
+            self.resume_call.cancel()
+        self.resume_call = None
+        d = self.pool.closeCachedConnections()
+        d.addCallback(lambda _: StatusReceiverMultiService.stopService(self))
+        return d
+
+    def builderAdded(self, name, builder):
+        return self
+
+    def buildStarted(self, builderName, build):
+        if builderName in self.repositories:
+            d = self.queueStatus(builderName, build, 'pending', 'Build started.')
+            d.addErrback(log.err, 'while queueing the GitHub status of %s' % builderName)
+
+    def buildFinished(self, builderName, build, results):
+        if builderName in self.repositories:
+            d = self.queueStatus(builderName, build, _STATES.get(results, 'error'), 'Build done.')
+            d.addErrback(log.err, 'while queueing the GitHub status of %s' % builderName)
+
+    ## @brief Queue the status of a build, replacing the one of the same commit and builder not sent yet
+    @defer.inlineCallbacks
+    def queueStatus(self, builderName, build, state, description):
+        sha = yield build.render(Interpolate('%(src::revision)s'))
+        if not sha:
+            log.msg('GitHubStatusReporter: no revision for build %d of %s' % (build.getNumber(), builderName))
+            return
+        token, owner, name = self.repositories[builderName]
+        key = (owner, name, sha, builderName)
+        if key in self.queue:
+            GITHUB_STATUSES.inc(outcome='collapsed')
+        self.generations[key] = self.generations.get(key, 0) + 1
+        self.queue[key] = {'token': token,
+                           'url': '%s/repos/%s/%s/statuses/%s' % (self.baseURL, owner, name, sha),
+                           'state': state,
+                           'target_url': self.status.getURLForThing(build),
+                           'description': description,
+                           'context': builderName,
+                           'generation': self.generations[key],
+                           'attempts': 0}
+        GITHUB_STATUS_QUEUE.set(len(self.queue))
+        self._sendNext()
+
+    def _sendNext(self):
+        if self.paused_until > time.time():
+            if not self.resume_call:
+                self.resume_call = reactor.callLater(self.paused_until - time.time(), self._resume)
+            return
+        for key in list(self.queue):
+            if self.sending >= self.concurrency:
+                break
+            # the previous status of this commit and builder must arrive first
+            if key in self.inflight:
+                continue
+            status = self.queue.pop(key)
+            GITHUB_STATUS_QUEUE.set(len(self.queue))
+            self.sending += 1
+            self.inflight.add(key)
+            d = self._send(key, status)
+            d.addErrback(log.err, 'while sending a GitHub status')
+            d.addBoth(self._sent, key)
+
+    def _sent(self, _, key):
+        self.sending -= 1
+        self.inflight.discard(key)
+        if key not in self.queue:
+            del self.generations[key]
+        self._sendNext()
+
+    def _resume(self):
+        self.resume_call = None
+        self._sendNext()
+
+    ## @brief Stop sending for a while
+    def _pause(self, delay):
+        self.paused_until = max(self.paused_until, time.time() + delay)
+
+    @defer.inlineCallbacks
+    def _send(self, key, status):
+        body = json.dumps(dict((k, status[k]) for k in ['state', 'target_url', 'description', 'context']))
+        headers = Headers({'Authorization': ['token ' + status['token']],
+                           'Accept': ['application/vnd.github.v3+json'],
+                           'Content-Type': ['application/json'],
+                           'User-Agent': ['buildbot-ros']})
+        try:
+            response = yield self.agent.request('POST', status['url'].encode('utf-8'), headers,
+                                                FileBodyProducer(StringIO(body)))
+            # the connection only goes back to the pool once the body is read
+            content = yield readBody(response)
+        except Exception as e:
+            self._retry(key, status, str(e))
+            return
+
+        remaining = response.headers.getRawHeaders('X-RateLimit-Remaining', [None])[0]
+        if remaining is not None and remaining.isdigit():
+            GITHUB_RATE_REMAINING.set(int(remaining))
+        if response.code in (403, 429) and (remaining == '0' or response.headers.hasHeader('Retry-After')):
+            # rate limited, wait until the limit resets and send it again
+            retry_after = response.headers.getRawHeaders('Retry-After', [None])[0]
+            reset = response.headers.getRawHeaders('X-RateLimit-Reset', [None])[0]
+            if retry_after and retry_after.isdigit():
+                delay = int(retry_after)
+            elif reset and reset.isdigit():
+                delay = max(int(reset) - time.time(), 1)
+            else:
+                delay = RATE_LIMIT_DELAY
+            log.msg('GitHubStatusReporter: rate limited, waiting %d seconds' % delay)
+            self._pause(delay)
+            self._requeue(key, status)
+        elif response.code >= 500:
+            self._retry(key, status, 'HTTP %d' % response.code)
+        elif response.code >= 400:
+            GITHUB_STATUSES.inc(outcome='failed')
+            log.msg('GitHubStatusReporter: failed to send status "%s" to %s: HTTP %d %s'
+                    % (status['state'], status['url'], response.code, content[:200]))
+        else:
+            GITHUB_STATUSES.inc(outcome='sent')
+            log.msg('GitHubStatusReporter: status "%s" sent to %s' % (status['state'], status['url']))
+
+    ## @brief Send a status again later, after an error
+    def _retry(self, key, status, why):
+        if self._superseded(key, status):
+            GITHUB_STATUSES.inc(outcome='collapsed')
+            return
+        status['attempts'] += 1
+        if status['attempts'] > RETRIES:
+            GITHUB_STATUSES.inc(outcome='failed')
+            log.msg('GitHubStatusReporter: giving up on status "%s" to %s: %s' % (status['state'], status['url'], why))
+            return
+        GITHUB_STATUSES.inc(outcome='retried')
+        log.msg('GitHubStatusReporter: failed to send status "%s" to %s, retrying: %s'
+                % (status['state'], status['url'], why))
+        # errors are most likely on the side of GitHub or the network, wait before sending anything
+        self._pause(RETRY_DELAY * 2 ** (status['attempts'] - 1))
+        self._requeue(key, status)
+
+    def _requeue(self, key, status):
+        if self._superseded(key, status):
+            GITHUB_STATUSES.inc(outcome='collapsed')
+            return
+        self.queue[key] = status
+        GITHUB_STATUS_QUEUE.set(len(self.queue))
+
+    ## @brief Whether a newer status for the same commit and builder was queued
+    def _superseded(self, key, status):
+        return status['generation'] != self.generations[key]
+
+## @brief Get the GitHub status reporter of a configuration, it is added on first use
+## @param c The Buildmasterconfig
+def github_status_reporter(c):
+    for s in c['status']:
+        if isinstance(s, GitHubStatusReporter):
+            return s
+    reporter = GitHubStatusReporter()
+    c['status'].append(reporter)
+    return reporter
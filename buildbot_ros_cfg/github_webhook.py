@@ -0,0 +1,165 @@
+import hashlib
+import hmac
+import json
+
+from twisted.application import strports
+from twisted.internet import defer
+from twisted.python import log
+from twisted.web import resource, server
+
+from buildbot.changes import base
+from buildbot.changes.gitpoller import GitPoller
+
+from git_pr_poller import GitPRPoller, pull_request_info
+from metrics import WEBHOOK_EVENTS
+
+## @brief Where the webhook listens, GitHub must be able to reach it
+WEBHOOK_PORT = 'tcp:8011'
+## @brief Seconds between the polls of the test builders when the webhook is used,
+##        they only catch the events that were missed
+RECONCILE_INTERVAL = 30*60
+# actions of pull_request events that give a new head to build
+_PR_ACTIONS = ['opened', 'reopened', 'synchronize']
+
+## @brief Get the owner/name of a GitHub repository from its URL
+##
+## Works with git@github.com:owner/name.git, https://github.com/owner/name(.git)
+## and ssh://git@github.com/owner/name.git
+def repository_name(url):
+    path = url.split('github.com', 1)[-1].strip(':/')
+    if path.endswith('.git'):
+        path = path[:-len('.git')]
+    return path.lower()
+
+## @brief Check the signature GitHub sends with an event
+## @param secret The secret of the webhook
+## @param body The body of the request
+## @param signature256 The X-Hub-Signature-256 header, if any
+## @param signature The X-Hub-Signature header (sha1), if any
+def signature_valid(secret, body, signature256, signature):
+    for header, name, digest in [(signature256, 'sha256', hashlib.sha256), (signature, 'sha1', hashlib.sha1)]:
+        if not header:
+            continue
+        kind, _, hexdigest = header.partition('=')
+        if kind != name:
+            return False
+        return hmac.compare_digest(hmac.new(secret, body, digest).hexdigest(), hexdigest)
+    return False
+
+## @brief Change source receiving the push and pull_request events of GitHub
+##
+## Add it to the change sources before the builders are configured:
+## c['change_source'].append(GitHubWebhook(secret)), and point the webhooks of the
+## repositories (content type application/json, same secret) to
+## http://MASTER:8011/github. Events are handed to the pollers of the test builders
+## of the repository: a push makes the NamedGitPoller of its branch poll now, a pull
+## request goes to the GitPRPoller, so changes are the same as when polled. With
+## the webhook, the pollers only poll every RECONCILE_INTERVAL.
+class GitHubWebhook(base.ChangeSource):
+    compare_attrs = ['secret', 'port']
+
+    ## @brief Constructor
+    ## @param secret The secret of the webhooks, events not signed with it are rejected
+    ## @param port strports description of where to listen
+    def __init__(self, secret, port=WEBHOOK_PORT):
+        self.setName('github_webhook')
+        self.secret = secret
+        self.port = port
+        self.listener = None
+
+    def describe(self):
+        return 'GitHubWebhook on %s' % self.port
+
+    def startService(self):
+        base.ChangeSource.startService(self)
+        root = resource.Resource()
+        root.putChild('github', WebhookResource(self))
+        self.listener = strports.listen(self.port, server.Site(root))
+
+    def stopService(self):
+        d = defer.maybeDeferred(self.listener.stopListening)
+        d.addCallback(lambda _: base.ChangeSource.stopService(self))
+        return d
+
+    ## @brief The pollers of the master that watch a repository
+    def pollers(self, kind, name):
+        return [source for source in self.master.change_svc
+                if isinstance(source, kind) and repository_name(source.repourl) == name]
+
+    ## @brief Handle an event
+    ## @param event The kind of event (X-GitHub-Event)
+    ## @param payload The event
+    ## @returns A short description of what was done
+    def handle(self, event, payload):
+        if event == 'ping':
+            return 'pong'
+        if event == 'push':
+            return self.handlePush(payload)
+        if event == 'pull_request':
+            return self.handlePullRequest(payload)
+        WEBHOOK_EVENTS.inc(event=event, outcome='ignored')
+        return 'ignored %s event' % event
+
+    def handlePush(self, payload):
+        ref = payload.get('ref', '')
+        if not ref.startswith('refs/heads/') or payload.get('deleted'):
+            WEBHOOK_EVENTS.inc(event='push', outcome='ignored')
+            return 'ignored push to %s' % ref
+        branch = ref[len('refs/heads/'):]
+        polled = list()
+        for poller in self.pollers(GitPoller, repository_name(payload['repository']['full_name'])):
+            if poller.branches is True or callable(poller.branches) or branch in poller.branches:
+                poller.doPoll()
+                polled.append(poller.project)
+        WEBHOOK_EVENTS.inc(event='push', outcome='accepted' if polled else 'ignored')
+        return 'polling %s' % ', '.join(polled) if polled else 'no builder for %s' % branch
+
+    def handlePullRequest(self, payload):
+        pr = payload['pull_request']
+        if payload.get('action') not in _PR_ACTIONS or not pr['head'].get('repo'):
+            WEBHOOK_EVENTS.inc(event='pull_request', outcome='ignored')
+            return 'ignored %s pull request' % payload.get('action')
+        added = list()
+        for poller in self.pollers(GitPRPoller, repository_name(pr['base']['repo']['full_name'])):
+            if not poller.watches(pr['base']['ref']):
+                continue
+            d = poller.addPullRequest(pull_request_info(pr))
+            d.addErrback(log.err, 'while adding pull request %s of %s' % (payload.get('number'), poller.repourl))
+            added.append(poller.project)
+        WEBHOOK_EVENTS.inc(event='pull_request', outcome='accepted' if added else 'ignored')
+        return 'added to %s' % ', '.join(added) if added else 'no builder for this pull request'
+
+## @brief The /github page, where GitHub posts the events
+class WebhookResource(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, source):
+        resource.Resource.__init__(self)
+        self.source = source
+
+    def render_POST(self, request):
+        body = request.content.read()
+        event = request.getHeader('X-GitHub-Event') or ''
+        if not signature_valid(self.source.secret, body, request.getHeader('X-Hub-Signature-256'),
+                               request.getHeader('X-Hub-Signature')):
+            WEBHOOK_EVENTS.inc(event=event, outcome='rejected')
+            request.setResponseCode(403)
+            return 'bad signature\n'
+        try:
+            payload = json.loads(body)
+            result = self.source.handle(event, payload)
+        except (ValueError, KeyError, TypeError) as e:
+            WEBHOOK_EVENTS.inc(event=event, outcome='rejected')
+            request.setResponseCode(400)
+            return 'bad payload: %s\n' % e
+        log.msg('GitHubWebhook: %s event (%s): %s' % (event, request.getHeader('X-GitHub-Delivery'), result))
+        request.setResponseCode(202)
+        return result.encode('utf-8') + '\n'
+
+## @brief Get the webhook of a configuration, None if it has none
+## @param c The Buildmasterconfig
+def github_webhook(c):
+    for source in c['change_source']:
+        if isinstance(source, GitHubWebhook):
+            return source
+    return None
@@ -2,11 +2,16 @@ from buildbot.config import BuilderConfig
 from buildbot.process.factory import BuildFactory
 from buildbot.process.properties import Interpolate
 from buildbot.steps.shell import ShellCommand
-from buildbot.steps.transfer import FileUpload, FileDownload
+from buildbot.steps.transfer import FileDownload
 from buildbot.steps.trigger import Trigger
 from buildbot.steps.master import MasterShellCommand
 
 from helpers import success
+from artifacts import add_artifact_upload_steps
+from slave_policy import cowbuilder_lock
+from step_metrics import instrument
+from log_policy import reduced_log
+from metrics import publish_step
 
 ## @brief Build a deb, from a source package found on launchpad
 ## @param c The Buildmasterconfig
@@ -42,7 +47,8 @@ def launchpad_debbuild(c, package, version, binaries, url, distro, arch, machine
     # Update the cowbuilder
     f.addStep(
         ShellCommand(
-            command = ['cowbuilder-update.py', distro, arch] + keys,
+            command = reduced_log(['cowbuilder-update.py', distro, arch] + keys),
+            locks = [cowbuilder_lock(distro, arch)],
             hideStepIf = success
         )
     )
@@ -51,33 +57,28 @@ def launchpad_debbuild(c, package, version, binaries, url, distro, arch, machine
         ShellCommand(
             haltOnFailure = True,
             name = package+'-build',
-            command = ['sudo', 'cowbuilder',
-                       '--build', package+'_'+version+'.dsc',
-                       '--distribution', distro, '--architecture', arch,
-                       '--basepath', '/var/cache/pbuilder/base-'+distro+'-'+arch+'.cow',
-                       '--buildresult', Interpolate('%(prop:workdir)s'),
-                       '--hookdir', Interpolate('%(prop:workdir)s/hooks'),
-                       '--othermirror', othermirror,
-                       '--override-config'],
+            command = reduced_log(['sudo', 'cowbuilder',
+                                   '--build', package+'_'+version+'.dsc',
+                                   '--distribution', distro, '--architecture', arch,
+                                   '--basepath', '/var/cache/pbuilder/base-'+distro+'-'+arch+'.cow',
+                                   '--buildresult', Interpolate('%(prop:workdir)s'),
+                                   '--hookdir', Interpolate('%(prop:workdir)s/hooks'),
+                                   '--othermirror', othermirror,
+                                   '--override-config']),
             descriptionDone = ['built binary debs', ]
         )
     )
-    # Upload debs
+    # Upload all debs in one transfer, 'arch: all' debs built for another arch are skipped
+    add_artifact_upload_steps(f, package+'-debs',
+                              [(deb_name+'_'+version+'_'+deb_arch+'.deb', 'binarydebs/'+deb_name)
+                               for deb_arch in binaries.keys() for deb_name in binaries[deb_arch]])
     for deb_arch in binaries.keys():
         for deb_name in binaries[deb_arch]:
             debian_pkg = deb_name+'_'+version+'_'+deb_arch+'.deb'
-            f.addStep(
-                FileUpload(
-                    name = deb_name+'-upload',
-                    slavesrc = Interpolate('%(prop:workdir)s/'+debian_pkg),
-                    masterdest = Interpolate('binarydebs/'+debian_pkg),
-                    hideStepIf = success
-                )
-            )
             # Add the binarydeb using reprepro updater script on master
             f.addStep(
                 MasterShellCommand(
-                    name = deb_name+'-include',
+                    name = publish_step(deb_name+'-include', 'reprepro'),
                     command = ['reprepro-include.bash', deb_name, Interpolate(debian_pkg), distro, deb_arch],
                     descriptionDone = ['updated in apt', debian_pkg]
                 )
@@ -85,6 +86,8 @@ def launchpad_debbuild(c, package, version, binaries, url, distro, arch, machine
     # Trigger if needed
     if trigger_names != None:
         f.addStep( Trigger(schedulerNames = trigger_names, waitForFinish = False) )
+    # Measure the steps
+    instrument(f, Interpolate('%(prop:workdir)s'))
     # Add to builders
     c['builders'].append(
         BuilderConfig(
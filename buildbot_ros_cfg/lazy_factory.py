@@ -0,0 +1,42 @@
+from buildbot.process.factory import BuildFactory
+
+from settings import get_settings
+
+## @brief A BuildFactory that only creates its steps when the first build starts,
+##        so that configuring (and reconfiguring) the master stays cheap.
+class LazyBuildFactory(BuildFactory):
+    compare_attrs = ['populate', 'spec', 'settings']
+
+    ## @brief Constructor
+    ## @param populate Function called as populate(factory, settings, *spec) to add the steps
+    ## @param spec Tuple of arguments for populate, describing the job
+    ## @param settings The Settings read when configuring, the steps are created with them
+    def __init__(self, populate, spec, settings):
+        BuildFactory.__init__(self)
+        self.populate = populate
+        self.spec = spec
+        self.settings = settings
+        self.factory = None
+
+    ## @brief Get the BuildFactory with the steps, creating it if needed
+    def realize(self):
+        if self.factory is None:
+            self.factory = BuildFactory()
+            self.populate(self.factory, self.settings, *self.spec)
+        return self.factory
+
+    def newBuild(self, requests):
+        return self.realize().newBuild(requests)
+
+## @brief Create a factory for a job. The settings are read (and their errors
+##        reported) now, even when the steps are created later.
+## @param populate Function called as populate(factory, settings, *spec) to add the steps
+## @param spec Tuple of arguments for populate
+## @param lazy If True, steps are only created when the first build starts
+def make_factory(populate, spec, lazy=False):
+    settings = get_settings()
+    if lazy:
+        return LazyBuildFactory(populate, spec, settings)
+    f = BuildFactory()
+    populate(f, settings, *spec)
+    return f
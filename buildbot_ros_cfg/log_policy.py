@@ -0,0 +1,19 @@
+from settings import get_settings
+
+## @brief Lines of output sent to the master as they come, unless set in spec.yaml
+LOG_HEAD = 200
+## @brief Last lines of output sent when the command succeeds, unless set in spec.yaml
+LOG_TAIL = 500
+
+## @brief Wrap a command that prints a lot, so that its log is cut down when it succeeds
+##
+## The command runs under scripts/log-policy.py on the slave: the first lines
+## are sent as they come, the others are kept (compressed) on the slave. When the
+## command succeeds only the last lines are sent, when it fails all of them are.
+## @param command The command, as a list
+## @param settings The Settings to use, read from spec.yaml when not given
+def reduced_log(command, settings=None):
+    policy = (settings or get_settings()).log_policy
+    if not policy.get('enabled', True):
+        return command
+    return ['log-policy.py', str(policy.get('head', LOG_HEAD)), str(policy.get('tail', LOG_TAIL))] + command
@@ -0,0 +1,233 @@
+import time
+
+from twisted.application import strports
+from twisted.internet import defer
+from twisted.python import log
+from twisted.web import resource, server
+
+from buildbot.status.base import StatusReceiverMultiService
+from buildbot.status.results import Results, SUCCESS, WARNINGS
+from buildbot.util import datetime2epoch
+
+## @brief Where the metrics are served, only on the master itself by default
+METRICS_PORT = 'tcp:9101:interface=127.0.0.1'
+## @brief Buckets (seconds) of the duration histograms
+DURATION_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600, 7200)
+
+# all the metrics, in the order they are exposed
+_registry = list()
+# step name -> kind of publishing, see publish_step
+_publish_steps = dict()
+
+def _labels(names, values):
+    if not names:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (n, str(v).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+                             for n, v in zip(names, values))
+
+def _value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+## @brief A value per set of labels that only goes up
+class Counter(object):
+    type = 'counter'
+
+    ## @brief Create and register a metric
+    ## @param name Name of the metric
+    ## @param help Description of the metric
+    ## @param labels Names of the labels of the metric
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = dict()
+        _registry.append(self)
+
+    def _key(self, labels):
+        return tuple(labels.get(n, '') for n in self.labels)
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        return [(self.name, _labels(self.labels, key), value) for key, value in sorted(self.values.items())]
+
+## @brief A value per set of labels that goes up and down
+class Gauge(Counter):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        self.values[self._key(labels)] = value
+
+    def clear(self):
+        self.values = dict()
+
+## @brief Counts of observations in buckets, per set of labels
+class Histogram(Counter):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DURATION_BUCKETS):
+        Counter.__init__(self, name, help, labels)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        if key not in self.values:
+            self.values[key] = [[0]*len(self.buckets), 0, 0.0]
+        counts, _, _ = self.values[key]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+        self.values[key][1] += 1
+        self.values[key][2] += value
+
+    def samples(self):
+        samples = list()
+        for key, (counts, count, total) in sorted(self.values.items()):
+            for bound, n in zip(self.buckets, counts):
+                samples.append((self.name+'_bucket', _labels(self.labels+('le',), key+(_value(bound),)), n))
+            samples.append((self.name+'_sum', _labels(self.labels, key), total))
+            samples.append((self.name+'_count', _labels(self.labels, key), count))
+        return samples
+
+## @brief Render all the metrics in the Prometheus text format
+def render():
+    lines = list()
+    for metric in _registry:
+        lines.append('# HELP %s %s' % (metric.name, metric.help))
+        lines.append('# TYPE %s %s' % (metric.name, metric.type))
+        for name, labels, value in metric.samples():
+            lines.append('%s%s %s' % (name, labels, _value(value)))
+    return '\n'.join(lines)+'\n'
+
+## @brief Mark a step as publishing, its duration and failures are then reported per kind
+## @param name Name of the step
+## @param kind What it publishes (for instance, 'reprepro' or 's3')
+## @returns The name of the step
+def publish_step(name, kind):
+    _publish_steps[name] = kind
+    return name
+
+## @brief Get what a step publishes, None if it does not publish
+## @param name Name of the step, buildbot adds a count to repeated names
+def publish_kind(name):
+    if name not in _publish_steps:
+        base, _, count = name.rpartition('_')
+        if count.isdigit():
+            name = base
+    return _publish_steps.get(name)
+
+BUILDS_STARTED = Counter('buildbot_builds_started_total', 'Builds started', ['builder'])
+BUILDS_FINISHED = Counter('buildbot_builds_finished_total', 'Builds finished, by result', ['builder', 'result'])
+BUILD_DURATION = Histogram('buildbot_build_duration_seconds', 'Duration of the builds', ['builder'])
+STEP_DURATION = Histogram('buildbot_step_duration_seconds', 'Duration of the steps', ['builder', 'step'])
+PENDING_REQUESTS = Gauge('buildbot_pending_build_requests', 'Build requests waiting for a slave', ['builder'])
+OLDEST_REQUEST = Gauge('buildbot_oldest_pending_request_seconds', 'Age of the oldest waiting build request', ['builder'])
+RUNNING_BUILDS = Gauge('buildbot_running_builds', 'Builds running', ['builder'])
+PUBLISH_DURATION = Histogram('buildbot_ros_publish_duration_seconds', 'Duration of the publishing steps', ['kind'])
+PUBLISH_FAILURES = Counter('buildbot_ros_publish_failures_total', 'Publishing steps that failed', ['kind'])
+PR_POLL_DURATION = Histogram('buildbot_ros_pr_poll_duration_seconds', 'Duration of the pull request polls',
+                             ['repository'], buckets=(0.1, 0.5, 1, 2, 5, 10, 30, 60))
+PR_POLL_ERRORS = Counter('buildbot_ros_pr_poll_errors_total', 'Pull request polls that failed', ['repository'])
+PR_CHANGE_LATENCY = Histogram('buildbot_ros_pr_change_latency_seconds',
+                              'Time from the update of a pull request to its change', ['repository'])
+WEBHOOK_EVENTS = Counter('buildbot_ros_webhook_events_total',
+                         'GitHub webhook events, by event and outcome (accepted, ignored, rejected)', ['event', 'outcome'])
+GITHUB_STATUSES = Counter('buildbot_ros_github_statuses_total',
+                          'Commit statuses for GitHub, by outcome (sent, collapsed, retried, failed)', ['outcome'])
+GITHUB_STATUS_QUEUE = Gauge('buildbot_ros_github_status_queue', 'Commit statuses waiting to be sent to GitHub')
+GITHUB_RATE_REMAINING = Gauge('buildbot_ros_github_rate_limit_remaining',
+                              'Requests left in the GitHub rate limit, when last seen')
+
+## @brief Status receiver that serves the metrics over HTTP
+##
+## Add it to the status targets: c['status'].append(MetricsService()), and scrape
+## http://127.0.0.1:9101/metrics
+class MetricsService(StatusReceiverMultiService):
+    compare_attrs = ['port']
+
+    ## @brief Constructor
+    ## @param port strports description of where to listen
+    def __init__(self, port=METRICS_PORT):
+        StatusReceiverMultiService.__init__(self)
+        self.port = port
+        self.status = None
+        root = resource.Resource()
+        root.putChild('metrics', MetricsResource(self))
+        strports.service(port, server.Site(root)).setServiceParent(self)
+
+    def startService(self):
+        StatusReceiverMultiService.startService(self)
+        self.status = self.parent.getStatus()
+        self.status.subscribe(self)
+
+    def stopService(self):
+        self.status.unsubscribe(self)
+        return StatusReceiverMultiService.stopService(self)
+
+    def builderAdded(self, name, builder):
+        return self
+
+    def buildStarted(self, builderName, build):
+        BUILDS_STARTED.inc(builder=builderName)
+        return self
+
+    def stepFinished(self, build, step, results):
+        start, end = step.getTimes()
+        if start is None or end is None or step.isSkipped():
+            return
+        result = results[0] if isinstance(results, (tuple, list)) else results
+        STEP_DURATION.observe(end - start, builder=build.getBuilder().getName(), step=step.getName())
+        kind = publish_kind(step.getName())
+        if kind:
+            PUBLISH_DURATION.observe(end - start, kind=kind)
+            if result not in (SUCCESS, WARNINGS):
+                PUBLISH_FAILURES.inc(kind=kind)
+
+    def buildFinished(self, builderName, build, results):
+        BUILDS_FINISHED.inc(builder=builderName, result=Results[results])
+        start, end = build.getTimes()
+        if start is not None and end is not None:
+            BUILD_DURATION.observe(end - start, builder=builderName)
+
+    ## @brief Update the gauges of the queue
+    @defer.inlineCallbacks
+    def collect(self):
+        master = self.parent.master
+        requests = yield master.db.buildrequests.getBuildRequests(claimed=False, complete=False)
+        now = time.time()
+        PENDING_REQUESTS.clear()
+        OLDEST_REQUEST.clear()
+        for name in master.botmaster.builderNames:
+            PENDING_REQUESTS.set(0, builder=name)
+        for br in requests:
+            name = br['buildername']
+            PENDING_REQUESTS.set(PENDING_REQUESTS.values.get((name,), 0) + 1, builder=name)
+            age = now - datetime2epoch(br['submitted_at'])
+            OLDEST_REQUEST.set(max(OLDEST_REQUEST.values.get((name,), 0), age), builder=name)
+        RUNNING_BUILDS.clear()
+        for name, builder in master.botmaster.builders.items():
+            RUNNING_BUILDS.set(len(builder.building), builder=name)
+
+## @brief The /metrics page
+class MetricsResource(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, service):
+        resource.Resource.__init__(self)
+        self.service = service
+
+    def render_GET(self, request):
+        d = self.service.collect()
+        # the other metrics are still worth serving
+        d.addErrback(log.err, 'while collecting the queue metrics')
+
+        def send(_):
+            request.setHeader('content-type', 'text/plain; version=0.0.4')
+            request.write(render())
+            request.finish()
+        d.addCallback(send)
+        return server.NOT_DONE_YET
@@ -0,0 +1,59 @@
+from buildbot.status.results import SUCCESS, WARNINGS
+from buildbot.steps.trigger import Trigger
+
+## @brief Property set on builds that were started to rebuild a reverse dependency
+REBUILD_PROPERTY = 'rebuild_of'
+## @brief Property set by the nightly scheduler, and passed down the chains of
+##        trigger_pkgs, on builds that rebuild every job anyway
+NIGHTLY_PROPERTY = 'nightly'
+
+## @brief Get the name of the Triggerable scheduler of a debbuild job
+def debtrigger_name(job_name, rosdistro, distro, arch):
+    return job_name.replace('_','-')+'-'+rosdistro+'-'+distro+'-'+arch+'-debtrigger'
+
+## @brief doStepIf for steps that must not run in a reverse dependency rebuild,
+##        so that a rebuild does not start rebuilds of its own
+def not_rebuild(step):
+    return not step.build.getProperty(REBUILD_PROPERTY)
+
+## @brief doStepIf for the rebuild triggers, only rebuild after everything was
+##        included in the repository. Nightly builds rebuild nothing, the
+##        nightly scheduler already builds every job.
+def should_rebuild(step):
+    return (step.build.result in (SUCCESS, WARNINGS) and not_rebuild(step) and
+            not step.build.getProperty(NIGHTLY_PROPERTY))
+
+## @brief Trigger step of the rebuilds, the build only waits on the master while it runs
+class RdependsTrigger(Trigger):
+    pass
+
+## @brief Whether a build is waiting for the rebuild of its reverse dependencies
+def waiting_on_rdepends(build):
+    return isinstance(build.currentStep, RdependsTrigger)
+
+## @brief Add the steps that rebuild the reverse dependencies of a job once its
+##        debs are in the APT repository (reprepro-include.bash removes them)
+## @param f The BuildFactory to add steps to
+## @param job_name Name of the job that was rebuilt
+## @param levels List of lists of job names, as returned by RosDistroOracle.getRebuildOrder.
+##        The jobs of a level are started in parallel, once the previous level finished.
+## @param rosdistro ROS distro (for instance, 'groovy')
+## @param distro Ubuntu distro (for instance, 'precise')
+## @param arch Architecture (for instance, 'amd64')
+def add_rdepends_trigger_steps(f, job_name, levels, rosdistro, distro, arch):
+    for i, level in enumerate(levels):
+        f.addStep(
+            RdependsTrigger(
+                name = job_name+'-rdepends-%d' % (i+1),
+                schedulerNames = [debtrigger_name(t, rosdistro, distro, arch) for t in level],
+                waitForFinish = True,
+                alwaysUseLatest = True,
+                set_properties = {REBUILD_PROPERTY: job_name},
+                doStepIf = should_rebuild,
+                # later levels depend on this one, but a failure is not ours
+                haltOnFailure = True,
+                flunkOnFailure = False,
+                warnOnFailure = True,
+                descriptionDone = ['rebuilt', ', '.join(level)]
+            )
+        )
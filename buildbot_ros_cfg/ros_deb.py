@@ -1,15 +1,24 @@
 from buildbot.config import BuilderConfig
-from buildbot.process.factory import BuildFactory
 from buildbot.process.properties import Interpolate
 from buildbot.steps.source.git import Git
 from buildbot.steps.shell import ShellCommand, SetPropertyFromCommand
-from buildbot.steps.transfer import FileUpload, FileDownload
+from buildbot.steps.transfer import FileDownload
 from buildbot.steps.trigger import Trigger
 from buildbot.steps.master import MasterShellCommand
 from buildbot.steps.slave import RemoveDirectory
 from buildbot.schedulers import triggerable
 
 from helpers import success
+from ccache import ccache_setup_step, ccache_stats_step
+from git_mirror import git_mirror_step, mirror_dir
+from artifacts import add_artifact_upload_steps
+from lazy_factory import make_factory
+from coalesce import merge_debbuild_requests
+from slave_policy import add_cost_steps, cowbuilder_lock, slave_chooser
+from step_metrics import instrument
+from log_policy import reduced_log
+from metrics import publish_step
+from rdepends import NIGHTLY_PROPERTY, add_rdepends_trigger_steps, debtrigger_name, not_rebuild
 
 ## @brief Debbuilds are used for building sourcedebs & binaries out of gbps and uploading to an APT repository
 ## @param c The Buildmasterconfig
@@ -24,10 +33,40 @@ from helpers import success
 ## @param othermirror Cowbuilder othermirror parameter
 ## @param keys List of keys that cowbuilder will need
 ## @param trigger_pkgs List of packages names to trigger after our build is done.
-def ros_debbuild(c, job_name, packages, url, distro, arch, rosdistro, version, machines, othermirror, keys, trigger_pkgs = None):
+## @param rdepends List of lists of jobs to rebuild after this one, see add_rdepends_trigger_steps
+## @param lazy If True, the build steps are only created when the first build starts
+def ros_debbuild(c, job_name, packages, url, distro, arch, rosdistro, version, machines, othermirror, keys, trigger_pkgs = None, rdepends = None,
+                 lazy = False):
+    f = make_factory(debbuild_steps,
+                     (job_name, packages, url, distro, arch, rosdistro, othermirror, keys, trigger_pkgs, rdepends),
+                     lazy)
+    # Create trigger
+    c['schedulers'].append(
+        triggerable.Triggerable(
+            name = debtrigger_name(job_name, rosdistro, distro, arch),
+            builderNames = [job_name+'_'+rosdistro+'_'+distro+'_'+arch+'_debbuild',]
+        )
+    )
+    # Add to builders
+    c['builders'].append(
+        BuilderConfig(
+            name = job_name+'_'+rosdistro+'_'+distro+'_'+arch+'_debbuild',
+            properties = {'release_version' : version},
+            slavenames = machines,
+            factory = f,
+            # build pending requests at once, they all use the latest commit
+            mergeRequests = merge_debbuild_requests,
+            nextSlave = slave_chooser(job_name+'_'+rosdistro+'_'+distro+'_'+arch+'_debbuild', distro, arch)
+        )
+    )
+    # return name of builder created
+    return job_name+'_'+rosdistro+'_'+distro+'_'+arch+'_debbuild'
+
+## @brief Add the steps of a debbuild to a factory, settings are the Settings of the config,
+##        the other parameters are those of ros_debbuild
+def debbuild_steps(f, settings, job_name, packages, url, distro, arch, rosdistro, othermirror, keys, trigger_pkgs, rdepends):
     gbp_args = ['-uc', '-us', '--git-ignore-branch', '--git-ignore-new',
                 '--git-verbose', '--git-dist='+distro, '--git-arch='+arch]
-    f = BuildFactory()
     # Remove the build directory.
     f.addStep(
         RemoveDirectory(
@@ -36,22 +75,28 @@ def ros_debbuild(c, job_name, packages, url, distro, arch, rosdistro, version, m
             hideStepIf = success,
         )
     )
+    # Update the local mirror, so the checkout only fetches new objects
+    f.addStep(git_mirror_step(url))
     # Check out the repository master branch, since releases are tagged and not branched
     f.addStep(
         Git(
             repourl = url,
             branch = 'master',
             alwaysUseLatest = True, # this avoids broken builds when schedulers send wrong tag/rev
-            mode = 'full' # clean out old versions
+            mode = 'full', # clean out old versions
+            reference = mirror_dir(url)
         )
     )
     # Update the cowbuilder
     f.addStep(
         ShellCommand(
-            command = ['cowbuilder-update.py', distro, arch] + keys,
+            command = reduced_log(['cowbuilder-update.py', distro, arch] + keys, settings),
+            locks = [cowbuilder_lock(distro, arch)],
             hideStepIf = success
         )
     )
+    # Setup the compiler cache, shared by all builds for this distro/arch
+    f.addStep(ccache_setup_step(distro, arch, Interpolate('%(prop:workdir)s/ccache.pbuilderrc')))
     # Need to build each package in order
     for package in packages:
         debian_pkg = 'ros-'+rosdistro+'-'+package.replace('_','-')  # debian package name (ros-groovy-foo)
@@ -82,20 +127,11 @@ def ros_debbuild(c, job_name, packages, url, distro, arch, rosdistro, version, m
             ShellCommand(
                 haltOnFailure = True,
                 name = package+'-buildsource',
-                command= [Interpolate('%(prop:workdir)s/build_source_deb.py'),
-                    rosdistro, package, Interpolate('%(prop:release_version)s'), Interpolate('%(prop:workdir)s')] + gbp_args,
+                command= reduced_log([Interpolate('%(prop:workdir)s/build_source_deb.py'),
+                    rosdistro, package, Interpolate('%(prop:release_version)s'), Interpolate('%(prop:workdir)s')] + gbp_args, settings),
                 descriptionDone = ['sourcedeb', package]
             )
         )
-        # Upload sourcedeb to master (currently we are not actually syncing these with a public repo)
-        f.addStep(
-            FileUpload(
-                name = package+'-uploadsource',
-                slavesrc = Interpolate('%(prop:workdir)s/'+deb_name+'.dsc'),
-                masterdest = Interpolate('sourcedebs/'+deb_name+'.dsc'),
-                hideStepIf = success
-            )
-        )
         # Stamp the changelog, in a similar fashion to the ROS buildfarm
         f.addStep(
             SetPropertyFromCommand(
@@ -139,27 +175,24 @@ def ros_debbuild(c, job_name, packages, url, distro, arch, rosdistro, version, m
             ShellCommand(
                 haltOnFailure = True,
                 name = package+'-buildbinary',
-                command = [Interpolate('%(prop:workdir)s/build_binary_deb.py'), debian_pkg,
-                    Interpolate('%(prop:release_version)s'), distro, Interpolate('%(prop:workdir)s')] + gbp_args,
+                command = reduced_log([Interpolate('%(prop:workdir)s/build_binary_deb.py'), debian_pkg,
+                    Interpolate('%(prop:release_version)s'), distro, Interpolate('%(prop:workdir)s')] + gbp_args, settings),
                 env = {'DIST': distro,
-                       'GIT_PBUILDER_OPTIONS': Interpolate('--hookdir %(prop:workdir)s/hooks --override-config'),
+                       'GIT_PBUILDER_OPTIONS': Interpolate('--hookdir %(prop:workdir)s/hooks '
+                                                         + '--configfile %(prop:workdir)s/ccache.pbuilderrc --override-config'),
                        'OTHERMIRROR': othermirror },
                 descriptionDone = ['binarydeb', package]
             )
         )
-        # Upload binarydeb to master
-        f.addStep(
-            FileUpload(
-                name = package+'-uploadbinary',
-                slavesrc = Interpolate('%(prop:workdir)s/'+final_name),
-                masterdest = Interpolate('binarydebs/'+final_name),
-                hideStepIf = success
-            )
-        )
+        # Upload sourcedeb and binarydeb to master in one transfer, skipping those it already has
+        # (currently we are not actually syncing sourcedebs with a public repo)
+        add_artifact_upload_steps(f, package+'-debs',
+                                  [(deb_name+'.dsc', 'sourcedebs/'+debian_pkg),
+                                   (final_name, 'binarydebs/'+debian_pkg)])
         # Add the binarydeb using reprepro updater script on master
         f.addStep(
             MasterShellCommand(
-                name = package+'-includedeb',
+                name = publish_step(package+'-includedeb', 'reprepro'),
                 command = ['reprepro-include.bash', debian_pkg, Interpolate(final_name), distro, arch],
                 descriptionDone = ['updated in apt', package]
             )
@@ -171,30 +204,23 @@ def ros_debbuild(c, job_name, packages, url, distro, arch, rosdistro, version, m
                 hideStepIf = success
             )
         )
-    # Trigger if needed
+    # Report compiler cache usage
+    f.addStep(ccache_stats_step(distro, arch))
+    # Rebuild the downstream repositories, which reprepro-include.bash removed
+    if rdepends:
+        add_rdepends_trigger_steps(f, job_name, rdepends, rosdistro, distro, arch)
+    # Trigger if needed (not when rebuilding, that would restart the whole chain)
     if trigger_pkgs != None:
         f.addStep(
             Trigger(
-                schedulerNames = [t.replace('_','-')+'-'+rosdistro+'-'+distro+'-'+arch+'-debtrigger' for t in trigger_pkgs],
+                schedulerNames = [debtrigger_name(t, rosdistro, distro, arch) for t in trigger_pkgs],
                 waitForFinish = False,
+                # the next jobs of a nightly chain are nightly builds too
+                copy_properties = [NIGHTLY_PROPERTY],
+                doStepIf = not_rebuild,
                 alwaysRun=True
             )
         )
-    # Create trigger
-    c['schedulers'].append(
-        triggerable.Triggerable(
-            name = job_name.replace('_','-')+'-'+rosdistro+'-'+distro+'-'+arch+'-debtrigger',
-            builderNames = [job_name+'_'+rosdistro+'_'+distro+'_'+arch+'_debbuild',]
-        )
-    )
-    # Add to builders
-    c['builders'].append(
-        BuilderConfig(
-            name = job_name+'_'+rosdistro+'_'+distro+'_'+arch+'_debbuild',
-            properties = {'release_version' : version},
-            slavenames = machines,
-            factory = f
-        )
-    )
-    # return name of builder created
-    return job_name+'_'+rosdistro+'_'+distro+'_'+arch+'_debbuild'
+    # Measure the steps, and record the resources used to place the next builds
+    instrument(f, Interpolate('%(prop:workdir)s'))
+    add_cost_steps(f)
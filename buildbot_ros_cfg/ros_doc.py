@@ -3,11 +3,18 @@ from buildbot.process.factory import BuildFactory
 from buildbot.process.properties import Interpolate
 from buildbot.steps.source.git import Git
 from buildbot.steps.shell import ShellCommand
-from buildbot.steps.transfer import DirectoryUpload, FileDownload
+from buildbot.steps.transfer import DirectoryUpload, FileDownload, FileUpload
+from buildbot.steps.master import MasterShellCommand
 from buildbot.steps.trigger import Trigger
 from buildbot.schedulers import triggerable
+from buildbot.status.results import SUCCESS, WARNINGS, FAILURE
 
 from helpers import success
+from git_mirror import git_mirror_step, mirror_dir
+from slave_policy import cowbuilder_lock
+from step_metrics import instrument
+from log_policy import reduced_log
+from metrics import publish_step
 
 ## @brief Docbuild jobs build the source documentation. This isn't the whold documentation
 ##        that is on the wiki, like message docs, just the source documentation part.
@@ -22,19 +29,24 @@ from helpers import success
 ## @param othermirror Cowbuilder othermirror parameter
 ## @param keys List of keys that cowbuilder will need
 ## @param trigger_pkgs List of packages names to trigger after our build is done.
-def ros_docbuild(c, job_name, url, branch, distro, arch, rosdistro, machines, othermirror, keys, trigger_pkgs = None):
+## @param incremental Keep the docs of unchanged packages on the slave, and only upload the
+##        docs that changed
+def ros_docbuild(c, job_name, url, branch, distro, arch, rosdistro, machines, othermirror, keys, trigger_pkgs = None,
+                 incremental = False):
 
     # Directory which will be bind-mounted
     binddir = '/tmp/'+job_name+'_'+rosdistro+'_docbuild'
 
     f = BuildFactory()
-    # Remove any old crud in /tmp folder
+    # Remove any old crud in /tmp folder, incremental builds keep the docs and their fingerprints
     f.addStep(
         ShellCommand(
-            command = ['rm', '-rf', binddir],
+            command = ['rm', '-rf', binddir+'/src' if incremental else binddir],
             hideStepIf = success
         )
     )
+    # Update the local mirror, so the checkout only fetches new objects
+    f.addStep(git_mirror_step(url))
     # Check out repository (to /tmp)
     f.addStep(
         Git(
@@ -42,6 +54,7 @@ def ros_docbuild(c, job_name, url, branch, distro, arch, rosdistro, machines, ot
             branch = branch,
             alwaysUseLatest = True,
             mode = 'full',
+            reference = mirror_dir(url),
             workdir = binddir+'/src/'+job_name+'/'
         )
     )
@@ -57,7 +70,8 @@ def ros_docbuild(c, job_name, url, branch, distro, arch, rosdistro, machines, ot
     # Update the cowbuilder
     f.addStep(
         ShellCommand(
-            command = ['cowbuilder-update.py', distro, arch] + keys,
+            command = reduced_log(['cowbuilder-update.py', distro, arch] + keys),
+            locks = [cowbuilder_lock(distro, arch)],
             hideStepIf = success
         )
     )
@@ -66,24 +80,45 @@ def ros_docbuild(c, job_name, url, branch, distro, arch, rosdistro, machines, ot
         ShellCommand(
             haltOnFailure = True,
             name = job_name+'-docbuild',
-            command = ['sudo', 'cowbuilder', '--execute', Interpolate('%(prop:workdir)s/docbuild.py'),
-                       '--distribution', distro, '--architecture', arch,
-                       '--bindmounts', binddir,
-                       '--basepath', '/var/cache/pbuilder/base-'+distro+'-'+arch+'.cow',
-                       '--override-config', '--othermirror', othermirror,
-                       '--', binddir, rosdistro],
+            command = reduced_log(['sudo', 'cowbuilder', '--execute', Interpolate('%(prop:workdir)s/docbuild.py'),
+                                   '--distribution', distro, '--architecture', arch,
+                                   '--bindmounts', binddir,
+                                   '--basepath', '/var/cache/pbuilder/base-'+distro+'-'+arch+'.cow',
+                                   '--override-config', '--othermirror', othermirror,
+                                   '--', binddir, rosdistro] + (['--incremental'] if incremental else [])),
+            # docbuild.py exits with 2 if only some packages failed, upload the rest
+            decodeRC = {0: SUCCESS, 1: FAILURE, 2: WARNINGS},
             descriptionDone = ['built docs', ]
         )
     )
-    # Upload docs to master
-    f.addStep(
-        DirectoryUpload(
-            name = job_name+'-upload',
-            slavesrc = binddir+'/docs',
-            masterdest = 'docs/' + rosdistro,
-            hideStepIf = success
+    if incremental:
+        # Upload the docs that changed, and replace them on the master
+        archive = 'docs/'+rosdistro+'/'+job_name+'-changed.tar.gz'
+        f.addStep(
+            FileUpload(
+                name = job_name+'-upload',
+                slavesrc = binddir+'/docs-changed.tar.gz',
+                masterdest = archive,
+                hideStepIf = success
+            )
+        )
+        f.addStep(
+            MasterShellCommand(
+                name = publish_step(job_name+'-unpack', 'docs'),
+                command = ['docs-unpack.bash', archive, 'docs/'+rosdistro],
+                hideStepIf = success
+            )
+        )
+    else:
+        # Upload docs to master
+        f.addStep(
+            DirectoryUpload(
+                name = publish_step(job_name+'-upload', 'docs'),
+                slavesrc = binddir+'/docs',
+                masterdest = 'docs/' + rosdistro,
+                hideStepIf = success
+            )
         )
-    )
     # Trigger if needed
     if trigger_pkgs != None:
         f.addStep(
@@ -93,6 +128,8 @@ def ros_docbuild(c, job_name, url, branch, distro, arch, rosdistro, machines, ot
                 alwaysRun=True
             )
         )
+    # Measure the steps
+    instrument(f, binddir)
     # Create trigger
     c['schedulers'].append(
         triggerable.Triggerable(
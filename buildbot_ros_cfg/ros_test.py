@@ -1,8 +1,10 @@
+from twisted.internet import defer
+
 from buildbot.config import BuilderConfig
 from buildbot.changes import base
 from buildbot.changes.filter import ChangeFilter
 from buildbot.changes.gitpoller import GitPoller
-from buildbot.plugins import util, status
+from buildbot.plugins import util
 from buildbot.process.factory import BuildFactory
 from buildbot.process.properties import Interpolate
 from buildbot.schedulers import basic
@@ -11,8 +13,16 @@ from buildbot.steps.source.git import Git
 from buildbot.steps.shell import ShellCommand
 from buildbot.steps.transfer import FileDownload
 
+from buildbot_ros_cfg.coalesce import NewestRevisionBuild
+from buildbot_ros_cfg.ccache import ccache_dir, ccache_setup_step, ccache_stats_step
+from buildbot_ros_cfg.git_mirror import git_mirror_step, mirror_dir
 from buildbot_ros_cfg.git_pr_poller import GitPRPoller
+from buildbot_ros_cfg.github_status import github_status_reporter
+from buildbot_ros_cfg.github_webhook import RECONCILE_INTERVAL, github_webhook
 from buildbot_ros_cfg.helpers import success
+from buildbot_ros_cfg.log_policy import reduced_log
+from buildbot_ros_cfg.slave_policy import add_cost_steps, cowbuilder_lock, slave_chooser
+from buildbot_ros_cfg.step_metrics import instrument
 
 
 ## @brief Work around for GitPoller not allowing two instances
@@ -43,6 +53,19 @@ class NamedGitPoller(GitPoller):
         self.changeCount = 0
         self.lastRev = {}
         self.workdir = name+'_gitpoller-work'
+        # polls share the workdir and lastRev, they run one at a time
+        self.lock = defer.DeferredLock()
+        self.next_poll = None
+
+    ## @brief Poll, once the running poll finished. Polls asked for while
+    ##        one is already waiting (pushes from the webhook) are done by it.
+    def poll(self):
+        if not self.lock.waiting:
+            self.next_poll = self.lock.run(GitPoller.poll, self)
+            return self.next_poll
+        d = defer.Deferred()
+        self.next_poll.addBoth(lambda result: d.callback(None) or result)
+        return d
 
 ## @brief Testbuild jobs are used for CI testing of the source repo.
 ## @param c The Buildmasterconfig
@@ -55,25 +78,30 @@ class NamedGitPoller(GitPoller):
 ## @param machines List of machines this can build on.
 ## @param othermirror Cowbuilder othermirror parameter
 ## @param keys List of keys that cowbuilder will need
+## @param token OAuth token, if set a pull request builder is created
+## @param incremental Keep the checkout and build tree between builds of the same branch
 def ros_testbuild(c, job_name, url, branch, distro, arch, rosdistro, machines, 
-                  othermirror, keys, token=None):
+                  othermirror, keys, token=None, incremental=False):
 
     # Change source is either GitPoller or GitPRPoller
     # TODO: make this configurable for svn/etc
     project_name = ''
+    # with the webhook, polling only catches the events that were missed
+    webhook = github_webhook(c)
     if token:
         project_name = '_'.join([job_name, rosdistro, 'prtestbuild'])
         c['change_source'].append(
             GitPRPoller(name=rosdistro+"_pr_poller",
                         repourl=url, # this may pose some problems
+                        branch=branch,
                         project=project_name,
                         token=token,
-                        pollInterval=15))
+                        builderNames=[project_name],
+                        pollInterval=RECONCILE_INTERVAL if webhook else 15))
         # parse repo_url git@github:author/repo.git to repoOwner, repoName
         r_owner, r_name = (url.split(':')[1])[:-4].split('/')
-        c['status'].append(status.GitHubStatus(token=token,
-                                               repoOwner=r_owner,
-                                               repoName=r_name))
+        # one reporter queues the statuses of all the pull request builders
+        github_status_reporter(c).addRepository(project_name, token, r_owner, r_name)
     else:
         project_name = '_'.join([job_name, rosdistro, 'testbuild'])
         c['change_source'].append(
@@ -81,7 +109,8 @@ def ros_testbuild(c, job_name, url, branch, distro, arch, rosdistro, machines,
                 repourl=url,
                 name=rosdistro,
                 branch=branch,
-                project=project_name
+                project=project_name,
+                pollInterval=RECONCILE_INTERVAL if webhook else 10*60
             )
         )
 
@@ -97,20 +126,34 @@ def ros_testbuild(c, job_name, url, branch, distro, arch, rosdistro, machines,
     binddir = '/tmp/'+project_name
 
     f = BuildFactory()
-    # Remove any old crud in /tmp folder
-    f.addStep(
-        ShellCommand(
-            command=['rm', '-rf', binddir],
-            hideStepIf=success
+    # merged requests of a branch or pull request build its newest revision
+    f.buildClass = NewestRevisionBuild
+    if incremental:
+        # Only remove the old results, testbuild.py decides if the build tree can be reused
+        f.addStep(
+            ShellCommand(
+                command=['rm', '-f', binddir+'/testresults', binddir+'/testsummary'],
+                hideStepIf=success
+            )
         )
-    )
-    # Check out repository (to /tmp)
+    else:
+        # Remove any old crud in /tmp folder
+        f.addStep(
+            ShellCommand(
+                command=['rm', '-rf', binddir],
+                hideStepIf=success
+            )
+        )
+    # Update the local mirror, pull requests from forks share most objects with it
+    f.addStep(git_mirror_step(url))
+    # Check out repository (to /tmp), incremental does a fetch+reset of the old checkout
     f.addStep(
         Git(
             repourl=util.Property('repository', default=url),
             branch=util.Property('branch', default=branch),
             alwaysUseLatest=True,
-            mode='full',
+            mode='incremental' if incremental else 'full',
+            reference=mirror_dir(url),
             workdir=binddir+'/src/'+job_name
         )
     )
@@ -126,36 +169,53 @@ def ros_testbuild(c, job_name, url, branch, distro, arch, rosdistro, machines,
     # Update the cowbuilder
     f.addStep(
         ShellCommand(
-            command=['cowbuilder-update.py', distro, arch] + keys,
+            command=reduced_log(['cowbuilder-update.py', distro, arch] + keys),
+            locks=[cowbuilder_lock(distro, arch)],
             hideStepIf=success
         )
     )
+    # Setup the compiler cache, shared by all builds for this distro/arch
+    f.addStep(ccache_setup_step(distro, arch))
+    # Arguments for testbuild.py
+    testbuild_args = [binddir, rosdistro, '--ccache', ccache_dir(distro, arch)]
+    if incremental:
+        testbuild_args += ['--incremental', Interpolate('%(prop:branch:-'+branch+')s')]
     # Make and run tests in a cowbuilder
     f.addStep(
         TestBuild(
             name=job_name+'-build',
-            command=['sudo', 'cowbuilder', '--execute',
-                     Interpolate('%(prop:workdir)s/testbuild.py'),
-                     '--distribution', distro, '--architecture', arch,
-                     '--bindmounts', binddir, '--basepath',
-                     '/var/cache/pbuilder/base-'+distro+'-'+arch+'.cow',
-                     '--override-config', '--othermirror', othermirror,
-                     '--', binddir, rosdistro],
-            logfiles={'tests' : binddir+'/testresults'},
+            command=reduced_log(['sudo', 'cowbuilder', '--execute',
+                                 Interpolate('%(prop:workdir)s/testbuild.py'),
+                                 '--distribution', distro, '--architecture', arch,
+                                 '--bindmounts', binddir+' '+ccache_dir(distro, arch), '--basepath',
+                                 '/var/cache/pbuilder/base-'+distro+'-'+arch+'.cow',
+                                 '--override-config', '--othermirror', othermirror,
+                                 '--'] + testbuild_args),
+            logfiles={'tests' : binddir+'/testresults', 'summary' : binddir+'/testsummary'},
             descriptionDone=['make and test', job_name]
         )
     )
+    # Report compiler cache usage
+    f.addStep(ccache_stats_step(distro, arch))
+    # Measure the steps, and record the resources used to place the next builds
+    instrument(f, binddir)
+    add_cost_steps(f)
     c['builders'].append(
         BuilderConfig(
             name=project_name,
             slavenames=machines,
-            factory=f
+            factory=f,
+            nextSlave=slave_chooser(project_name, distro, arch)
         )
     )
     # return the name of the job created
     return project_name
 
 ## @brief ShellCommand w/overloaded evaluateCommand so that tests can be Warn
+##
+## The tests are evaluated from the small summary log written by testbuild.py,
+## the tests log (with the whole output of the tests) is not read on the master.
+## The counts are set in the tests_passed and tests_failed properties.
 class TestBuild(ShellCommand):
     warnOnWarnings = True
 
@@ -164,10 +224,17 @@ class TestBuild(ShellCommand):
             # build failed
             return results.FAILURE
 
-        l = self.getLog('tests').readlines()
-        if len(l) >= 1:
-            if l[0].find('Passed') > -1:
-                return results.SUCCESS
-            else:
-                # some tests failed
-                return results.WARNINGS
+        counts = dict()
+        for line in self.getLog('summary').getText().splitlines():
+            key, _, value = line.partition('=')
+            if value.strip().isdigit():
+                counts[key.strip()] = int(value)
+        if 'passed' not in counts or 'failed' not in counts:
+            # no summary, the results of the tests are unknown
+            return results.WARNINGS
+        self.setProperty('tests_passed', counts['passed'], 'TestBuild')
+        self.setProperty('tests_failed', counts['failed'], 'TestBuild')
+        if counts['failed'] > 0:
+            # some tests failed
+            return results.WARNINGS
+        return results.SUCCESS
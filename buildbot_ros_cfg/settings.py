@@ -0,0 +1,97 @@
+import os
+import yaml
+
+from buildbot import config
+
+## @brief Default location of the settings file
+SPEC_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'spec.yaml')
+
+## @brief Settings for publishing the APT repository, placing builds and cutting down logs, loaded from spec.yaml
+class Settings(object):
+    # key -> (type, required)
+    SCHEMA = {'sync_s3': (bool, True),
+              'local_repo_path': (basestring, False),
+              's3_bucket': (basestring, False),
+              'slaves': (dict, False),
+              'log_policy': (dict, False)}
+    # resources that can be given for each slave
+    SLAVE_KEYS = ['memory_mb', 'max_heavy']
+    # key -> type, of the log policy (see log_policy.py)
+    LOG_POLICY_KEYS = {'enabled': bool, 'head': int, 'tail': int}
+
+    ## @brief Constructor
+    ## @param values Dictionary loaded from the settings file
+    ## @param path The settings file, for error messages
+    def __init__(self, values, path):
+        self.errors = list()
+        self.reported_to = None
+        if not isinstance(values, dict):
+            self.error('%s: expected a mapping of settings' % path)
+            values = dict()
+        for key, (kind, required) in self.SCHEMA.items():
+            if key not in values:
+                if required:
+                    self.error('%s: missing setting %s' % (path, key))
+                continue
+            if not isinstance(values[key], kind):
+                self.error('%s: %s should be a %s' % (path, key, kind.__name__))
+        for key in values:
+            if key not in self.SCHEMA:
+                self.error('%s: unknown setting %s' % (path, key))
+        if values.get('sync_s3'):
+            for key in ['local_repo_path', 's3_bucket']:
+                if not values.get(key):
+                    self.error('%s: %s is needed when sync_s3 is set' % (path, key))
+        for slave, limits in (values.get('slaves') or dict()).items():
+            if not isinstance(limits, dict):
+                self.error('%s: slaves: %s should be a mapping' % (path, slave))
+                continue
+            for key, value in limits.items():
+                if key not in self.SLAVE_KEYS or not is_number(value):
+                    self.error('%s: slaves: %s: %s should be one of %s, with a number'
+                               % (path, slave, key, ', '.join(self.SLAVE_KEYS)))
+        log_policy = values.get('log_policy') if isinstance(values.get('log_policy'), dict) else dict()
+        for key, value in log_policy.items():
+            kind = self.LOG_POLICY_KEYS.get(key)
+            if kind is None or not isinstance(value, kind) or (kind is int and (not is_number(value) or value < 0)):
+                self.error('%s: log_policy: %s should be one of %s, with a number of lines (enabled: true or false)'
+                           % (path, key, ', '.join(sorted(self.LOG_POLICY_KEYS))))
+        self.sync_s3 = bool(values.get('sync_s3', False))
+        self.local_repo_path = values.get('local_repo_path')
+        self.s3_bucket = values.get('s3_bucket')
+        self.slaves = values.get('slaves') or dict()
+        self.log_policy = log_policy
+
+    ## @brief Record an error in the settings, see report()
+    def error(self, message):
+        self.errors.append(message)
+
+    ## @brief Report the errors to the config being loaded, once per load. Nothing
+    ##        is reported outside of a load, when builds use the settings.
+    def report(self):
+        # buildbot collects the errors of a load in config._errors, it is None between loads
+        errors = config._errors
+        if errors is None or errors is self.reported_to:
+            return
+        self.reported_to = errors
+        for message in self.errors:
+            config.error(message)
+
+## @brief Whether a setting is a number, YAML booleans are ints for Python
+def is_number(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+# path -> (mtime, Settings)
+_cache = dict()
+
+## @brief Get the settings, the file is only parsed again when it changes.
+##        Their errors are reported once to each reconfig, see Settings.report().
+## @param path The settings file
+def get_settings(path=SPEC_FILE):
+    mtime = os.path.getmtime(path)
+    if path not in _cache or _cache[path][0] != mtime:
+        with open(path) as f:
+            _cache[path] = (mtime, Settings(yaml.safe_load(f), path))
+    settings = _cache[path][1]
+    settings.report()
+    return settings
@@ -0,0 +1,144 @@
+import json
+import os
+
+from buildbot import locks
+from buildbot.process.properties import renderer
+from buildbot.status.results import SUCCESS, WARNINGS
+from buildbot.steps.master import MasterShellCommand
+
+from helpers import success
+from rdepends import waiting_on_rdepends
+from settings import get_settings
+from step_metrics import USAGE_KEYS
+
+## @brief Costs recorded by scripts/builder-cost.py, relative to the master directory
+COSTS_FILE = 'builder-costs.json'
+## @brief Builds using more memory or CPU time than this are heavy
+HEAVY_MAXRSS_KB = 2*1024*1024
+HEAVY_CPU_S = 30*60
+## @brief Number of heavy builds a slave runs at once, unless set in spec.yaml
+MAX_HEAVY = 1
+
+# builder name -> (distro, arch) of the builders using slave_chooser
+_targets = dict()
+# path -> (mtime, costs)
+_costs = dict()
+# lock name -> SlaveLock, buildbot wants one instance per name
+_locks = dict()
+
+## @brief Get the recorded costs, the file is only read again when it changes
+## @returns Dictionary of builder name -> dictionary of COST_KEYS
+def get_costs(path=COSTS_FILE):
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return dict()
+    if path not in _costs or _costs[path][0] != mtime:
+        try:
+            with open(path) as f:
+                _costs[path] = (mtime, json.load(f))
+        except (IOError, ValueError):
+            return dict()
+    return _costs[path][1]
+
+## @brief Whether a builder with this cost is heavy
+def is_heavy(cost):
+    return bool(cost) and (cost.get('maxrss_kb', 0) >= HEAVY_MAXRSS_KB or
+                           cost.get('cpu_s', 0) >= HEAVY_CPU_S)
+
+## @brief Get the lock that keeps two builds of a slave from updating the same cowbuilder
+## @param distro Ubuntu distro (for instance, 'precise')
+## @param arch Architecture (for instance, 'amd64')
+def cowbuilder_lock(distro, arch):
+    name = 'cowbuilder-'+distro+'-'+arch
+    if name not in _locks:
+        _locks[name] = locks.SlaveLock(name)
+    return _locks[name].access('exclusive')
+
+@renderer
+def _record_command(props):
+    command = ['builder-cost.py', COSTS_FILE, props.getProperty('buildername')]
+    for key in USAGE_KEYS:
+        if props.hasProperty('cost_'+key):
+            command.append('%s=%d' % (key, props.getProperty('cost_'+key)))
+    return command
+
+def _should_record(step):
+    # failed builds usually stop early, they would make the builder look cheap
+    return (step.build.result in (SUCCESS, WARNINGS) and
+            step.build.getProperties().hasProperty('cost_cpu_s'))
+
+## @brief Add the step that records the usage of the build on the master, it uses
+##        the cost_* properties so it goes after the steps added by instrument()
+## @param f The BuildFactory to add steps to
+def add_cost_steps(f):
+    f.addStep(
+        MasterShellCommand(
+            name = 'record-cost',
+            command = _record_command,
+            doStepIf = _should_record,
+            flunkOnFailure = False,
+            hideStepIf = success
+        )
+    )
+
+## @brief Get a nextSlave function that places the builds of a builder using its recorded cost
+## @param builder_name Name of the builder
+## @param distro Ubuntu distro of the builder (for instance, 'precise')
+## @param arch Architecture of the builder (for instance, 'amd64')
+def slave_chooser(builder_name, distro, arch):
+    _targets[builder_name] = (distro, arch)
+    # the settings of this config, spec.yaml is not read again while placing builds
+    settings = get_settings()
+    def next_slave(builder, slavebuilders):
+        return choose_slave(builder, slavebuilders, distro, arch, settings)
+    return next_slave
+
+## @brief Choose the slave for a build, or None to wait for another one
+##
+## Heavy builds are limited per slave (max_heavy). When the memory of the slaves
+## is known (memory_mb), a build only goes where its peak memory fits next to the
+## running builds, taking the tightest fit so big slaves stay free for big builds.
+## Slaves running a build for the same distro/arch (and cowbuilder) come last.
+## Builds waiting for the rebuild of their reverse dependencies are not counted,
+## the rebuilds they wait for would otherwise never get a slave.
+def choose_slave(builder, slavebuilders, distro, arch, settings):
+    costs = get_costs()
+    capacities = settings.slaves
+    cost = costs.get(builder.name) or dict()
+    need_kb = cost.get('maxrss_kb', 0)
+    heavy = is_heavy(cost)
+    # a build too big for a slave waits, unless no slave could ever fit it
+    largest_kb = max([capacities.get(sb.slave.slavename, {}).get('memory_mb', 0)*1024
+                      for sb in slavebuilders] or [0])
+
+    running = dict()
+    for b in builder.botmaster.builders.values():
+        for build in b.building:
+            if waiting_on_rdepends(build):
+                continue
+            running.setdefault(build.getSlaveName(), []).append(b.name)
+
+    best = None
+    for sb in slavebuilders:
+        name = sb.slave.slavename
+        builds = running.get(name, [])
+        limits = capacities.get(name, dict())
+        if heavy and len([b for b in builds if is_heavy(costs.get(b))]) >= limits.get('max_heavy', MAX_HEAVY):
+            continue
+        slack = 0
+        if 'memory_mb' in limits:
+            free_kb = limits['memory_mb']*1024 - sum((costs.get(b) or {}).get('maxrss_kb', 0) for b in builds)
+            if need_kb > limits['memory_mb']*1024 and largest_kb >= need_kb:
+                continue
+            if builds and need_kb > free_kb:
+                continue
+            if need_kb:
+                slack = free_kb - need_kb
+        same_chroot = len([b for b in builds if _targets.get(b) == (distro, arch)])
+        key = (same_chroot, slack, len(builds), name)
+        if best is None or key < best[0]:
+            best = (key, sb)
+    if best is None:
+        return None
+    return best[1]
@@ -0,0 +1,264 @@
+import json
+import math
+import os
+import time
+
+from twisted.internet import defer
+
+from buildbot.process.buildstep import BuildStep, _BuildStepFactory
+from buildbot.process.properties import Interpolate
+from buildbot.status.results import SUCCESS
+from buildbot.status.web.base import HtmlResource
+from buildbot.steps.master import MasterShellCommand
+from buildbot.steps.shell import ShellCommand, SetPropertyFromCommand
+
+from helpers import success
+
+## @brief Directory on the master holding the time series of the step metrics, one file per builder
+METRICS_DIR = 'step-metrics'
+## @brief Where the slave accumulates the usage of the steps of a build
+USAGE_REPORT = '%(prop:workdir)s/resource-usage.json'
+## @brief Where the master accumulates the usage of its own steps of a build
+MASTER_REPORT = METRICS_DIR+'/%(prop:buildername)s-%(prop:buildnumber)s.json'
+## @brief Usage reported by scripts/resource-usage.py
+USAGE_KEYS = ['cpu_s', 'maxrss_kb', 'disk_kb', 'wall_s']
+## @brief Number of builds kept in the time series of a builder
+HISTORY = 200
+
+## @brief Wrap a command so that its resource usage is measured
+## @param command The command, as a list
+## @param step Name of the step, the usage is also reported per step
+## @param report The report accumulating the usage of the build
+def measured(command, step, report=USAGE_REPORT):
+    return ['resource-usage.py', 'run', Interpolate(report), step] + command
+
+## @brief Convert the output of 'resource-usage.py summary' to build properties
+##
+## The usage of the whole build goes in cost_* properties, the usage of each
+## step in the step_usage property (step name -> usage).
+def usage_properties(rc, stdout, stderr):
+    props = dict()
+    if rc != 0:
+        return props
+    steps = dict()
+    for line in stdout.splitlines():
+        key, _, value = line.strip().partition('=')
+        try:
+            value = float(value)
+        except ValueError:
+            continue
+        if key.startswith('step.'):
+            step, _, key = key[len('step.'):].rpartition('.')
+            steps.setdefault(step, dict())[key] = value
+        elif key in USAGE_KEYS:
+            props['cost_'+key] = int(value)
+    props['step_usage'] = steps
+    return props
+
+## @brief Measure the steps of a factory, and record their metrics at the end of each build
+##
+## Call this once all the steps are added. Every shell command (on the slave or the
+## master) given as a list is run under scripts/resource-usage.py, and the wall time
+## of every step is taken from the build status.
+## @param f The BuildFactory
+## @param path If set, directory whose disk usage is reported (the build tree)
+def instrument(f, path=None):
+    names = dict()
+    for i, step in enumerate(f.steps):
+        name = _step_name(names, step.kwargs.get('name', getattr(step.factory, 'name', None)))
+        command = step.kwargs.get('command')
+        if step.args or not isinstance(command, list) or command[:1] == ['resource-usage.py']:
+            continue
+        if issubclass(step.factory, MasterShellCommand):
+            report = MASTER_REPORT
+        elif issubclass(step.factory, ShellCommand):
+            report = USAGE_REPORT
+        else:
+            continue
+        kwargs = dict(step.kwargs)
+        kwargs['command'] = measured(command, name, report)
+        f.steps[i] = _BuildStepFactory(step.factory, **kwargs)
+    command = ['resource-usage.py', 'summary', Interpolate(USAGE_REPORT)]
+    if path:
+        command.append(path)
+    f.addStep(
+        SetPropertyFromCommand(
+            name = 'resource-usage',
+            command = command,
+            extract_fn = usage_properties,
+            alwaysRun = True,
+            flunkOnFailure = False,
+            hideStepIf = success
+        )
+    )
+    f.addStep(
+        RecordStepMetrics(
+            alwaysRun = True,
+            flunkOnFailure = False,
+            hideStepIf = success
+        )
+    )
+
+# the name buildbot gives the step, it adds a count to repeated names
+def _step_name(names, name):
+    if name in names:
+        names[name] += 1
+        return '%s_%d' % (name, names[name])
+    names[name] = 0
+    return name
+
+## @brief Step on the master that collects the metrics of the steps of the build, stores
+##        them in the step_metrics property and appends them to the time series of the builder
+class RecordStepMetrics(BuildStep):
+    name = 'step-metrics'
+
+    def __init__(self, metrics_dir=METRICS_DIR, **kwargs):
+        BuildStep.__init__(self, **kwargs)
+        self.metrics_dir = metrics_dir
+
+    def run(self):
+        props = self.build.getProperties()
+        usage = dict(props.getProperty('step_usage') or {})
+        master_report = MASTER_REPORT % {'prop:buildername': props.getProperty('buildername'),
+                                         'prop:buildnumber': props.getProperty('buildnumber')}
+        usage.update(_read_report(master_report).get('steps', {}))
+
+        metrics = dict()
+        order = list()
+        for step in self.build.build_status.getSteps():
+            start, end = step.getTimes()
+            if step.getName() == self.name or start is None or end is None or step.isSkipped():
+                continue
+            entry = dict((key, round(value, 1)) for key, value in usage.get(step.getName(), {}).items())
+            entry['wall_s'] = round(end - start, 1)
+            metrics[step.getName()] = entry
+            order.append(step.getName())
+        self.setProperty('step_metrics', metrics, 'RecordStepMetrics')
+
+        record = {'build': props.getProperty('buildnumber'),
+                  'time': int(time.time()),
+                  'result': self.build.result,
+                  'order': order,
+                  'steps': metrics}
+        try:
+            append_history(os.path.join(self.metrics_dir, props.getProperty('buildername')+'.jsonl'), record)
+        except (IOError, OSError) as e:
+            self.addCompleteLog('error', str(e))
+        return defer.succeed(SUCCESS)
+
+def _read_report(report):
+    try:
+        with open(report) as f:
+            usage = json.load(f)
+    except (IOError, ValueError):
+        return dict()
+    os.remove(report)
+    return usage
+
+## @brief Append the metrics of a build to a time series, keeping the last HISTORY builds
+def append_history(path, record, history=HISTORY):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'a') as f:
+        f.write(json.dumps(record, sort_keys=True)+'\n')
+    # trim now and then, rather than rewriting the file after each build
+    records = read_history(path)
+    if len(records) > 2*history:
+        with open(path+'.tmp', 'w') as f:
+            for r in records[-history:]:
+                f.write(json.dumps(r, sort_keys=True)+'\n')
+        os.rename(path+'.tmp', path)
+
+## @brief Read the time series of a builder
+## @returns List of records, oldest first
+def read_history(path):
+    records = list()
+    try:
+        with open(path) as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    pass
+    except IOError:
+        pass
+    return records
+
+## @brief Get the p-th percentile (nearest rank) of a list of values
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[max(int(math.ceil(p/100.0*len(values)))-1, 0)]
+
+## @brief Get the percentiles of the metrics of each step of a builder
+## @param records Records of read_history
+## @param keys The metrics to report
+## @returns List of (step name, number of builds, {key: (p50, p95)}), in the order of the last build
+def step_breakdown(records, keys=('wall_s', 'cpu_s', 'maxrss_kb')):
+    values = dict()
+    order = list()
+    for record in records:
+        for name in record.get('order', []):
+            if name not in order:
+                order.append(name)
+        for name, entry in record.get('steps', {}).items():
+            for key, value in entry.items():
+                values.setdefault(name, dict()).setdefault(key, list()).append(value)
+    if records:
+        # steps of the last build first, then those that are gone
+        last = records[-1].get('order', [])
+        order = last + [name for name in order if name not in last]
+    breakdown = list()
+    for name in order:
+        if name not in values:
+            continue
+        count = max(len(v) for v in values[name].values())
+        breakdown.append((name, count,
+                          dict((key, (percentile(values[name].get(key, []), 50),
+                                      percentile(values[name].get(key, []), 95))) for key in keys)))
+    return breakdown
+
+## @brief Web status page with the p50/p95 of the step metrics of each builder
+##
+## Add it to the WebStatus with: web.putChild('step-metrics', StepMetricsResource())
+class StepMetricsResource(HtmlResource):
+    pageTitle = 'Step Metrics'
+
+    def __init__(self, metrics_dir=METRICS_DIR):
+        HtmlResource.__init__(self)
+        self.metrics_dir = metrics_dir
+
+    def builders(self):
+        try:
+            return sorted(n[:-len('.jsonl')] for n in os.listdir(self.metrics_dir) if n.endswith('.jsonl'))
+        except OSError:
+            return list()
+
+    def body(self, req):
+        builder = req.args.get('builder', [None])[0]
+        if builder not in self.builders():
+            html = '<h1>Step Metrics</h1>\n<ul>\n'
+            for name in self.builders():
+                html += '<li><a href="?builder=%s">%s</a></li>\n' % (_escape(name), _escape(name))
+            return html + '</ul>\n'
+        records = read_history(os.path.join(self.metrics_dir, builder+'.jsonl'))
+        html = '<h1>%s</h1>\n<p>%d builds</p>\n' % (_escape(builder), len(records))
+        html += '<table class="info">\n<tr><th>step</th><th>builds</th>'
+        html += '<th>wall p50</th><th>wall p95</th><th>cpu p50</th><th>cpu p95</th>'
+        html += '<th>peak rss p50</th><th>peak rss p95</th></tr>\n'
+        for name, count, p in step_breakdown(records):
+            html += '<tr><td>%s</td><td>%d</td>' % (_escape(name), count)
+            html += ''.join('<td>%s</td>' % _format(key, v) for key in ('wall_s', 'cpu_s', 'maxrss_kb') for v in p[key])
+            html += '</tr>\n'
+        return html + '</table>\n'
+
+def _escape(text):
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').replace('"', '&quot;')
+
+def _format(key, value):
+    if value is None:
+        return ''
+    if key == 'maxrss_kb':
+        return '%d MB' % (value/1024)
+    return '%.1f s' % value
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+
+# This is used on the master to remove old builds from binarydebs/ and
+# sourcedebs/, keeping the most recent ones and anything reprepro still uses
+
+from __future__ import print_function
+import os
+import re
+import time
+import fcntl
+import subprocess
+import argparse
+
+# Lock of the artifact store, artifact-store.py holds it shared while it runs
+LOCK_FILE = '.lock'
+
+# Distro suffix of a version, as stamped by the debbuilders ('1.2.3-0xenial')
+DISTRO_SUFFIX = re.compile('[0-9]([a-z]+)$')
+
+## @brief Split a deb or dsc filename into the key it is retained under
+## @returns (package, distro, arch) or None if not a package file
+def retention_key(filename):
+    if filename.endswith('.deb'):
+        parts = filename[:-len('.deb')].split('_')
+        if len(parts) != 3:
+            return None
+        name, version, arch = parts
+    elif filename.endswith('.dsc'):
+        parts = filename[:-len('.dsc')].split('_')
+        if len(parts) != 2:
+            return None
+        name, version = parts
+        arch = 'source'
+    else:
+        return None
+    m = DISTRO_SUFFIX.search(version)
+    return (name, m.group(1) if m else '', arch)
+
+## @brief Get the filenames of all packages referenced by reprepro
+## @param repo_dir The reprepro base directory
+def referenced_files(repo_dir):
+    if not os.path.isdir(repo_dir):
+        return set()
+    output = subprocess.check_output(['sudo', 'reprepro', '-b', repo_dir, 'dumpreferences'])
+    return set(os.path.basename(line.split()[-1]) for line in output.decode('utf8').splitlines() if line.strip())
+
+## @brief Move files directly in directory into per-package subdirectories
+##        (the layout used by the debbuilders, see reprepro-include.bash)
+def shard(directory, dry_run):
+    for filename in os.listdir(directory):
+        path = os.path.join(directory, filename)
+        key = retention_key(filename)
+        if key is None or not os.path.isfile(path):
+            continue
+        dest = os.path.join(directory, key[0], filename)
+        print('moving %s to %s' % (path, dest))
+        if not dry_run:
+            if not os.path.isdir(os.path.dirname(dest)):
+                os.makedirs(os.path.dirname(dest))
+            os.rename(path, dest)
+
+## @brief Remove all but the newest builds of each package/distro/arch
+## @param directory The directory to clean (searched recursively)
+## @param keep Number of builds to keep per package/distro/arch
+## @param referenced Set of filenames that must be kept
+## @returns (number of files removed, bytes reclaimed)
+def collect(directory, keep, referenced, dry_run):
+    groups = dict()
+    for root, dirs, files in os.walk(directory):
+        for filename in files:
+            key = retention_key(filename)
+            if key is None:
+                continue
+            path = os.path.join(root, filename)
+            groups.setdefault(key, []).append((os.path.getmtime(path), path))
+    removed = 0
+    reclaimed = 0
+    for key, builds in groups.items():
+        builds.sort(reverse=True)
+        for mtime, path in builds[keep:]:
+            if os.path.basename(path) in referenced:
+                continue
+            st = os.stat(path)
+            print('removing %s' % path)
+            removed += 1
+            # if the artifact store still has a link, space is reclaimed when it is swept
+            if st.st_nlink == 1:
+                reclaimed += st.st_size
+            if not dry_run:
+                os.remove(path)
+    return removed, reclaimed
+
+## @brief Remove blobs from the artifact store that are no longer linked anywhere
+##
+## Blobs modified in the last grace_s seconds are kept: a build that found a blob
+## in the store (which touches it) links it a few steps later.
+## @param grace_s Age, in seconds, of the blobs that can be removed
+## @returns (number of blobs removed, bytes reclaimed)
+def sweep_store(store, grace_s, dry_run):
+    removed = 0
+    reclaimed = 0
+    if not os.path.isdir(store):
+        return removed, reclaimed
+    with open(os.path.join(store, LOCK_FILE), 'a') as lock:
+        # wait for the builds storing artifacts, their blobs are not linked yet
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        cutoff = time.time() - grace_s
+        for root, dirs, files in os.walk(store):
+            dirs[:] = [d for d in dirs if d != 'incoming']
+            for filename in files:
+                # temporary files of artifact-store.py are still being written
+                if filename == LOCK_FILE or filename.startswith('tmp'):
+                    continue
+                path = os.path.join(root, filename)
+                st = os.stat(path)
+                if st.st_nlink == 1 and st.st_mtime < cutoff:
+                    removed += 1
+                    reclaimed += st.st_size
+                    if not dry_run:
+                        os.remove(path)
+    return removed, reclaimed
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description='Remove old builds from binarydebs/ and sourcedebs/')
+    parser.add_argument('basedir', help='buildbot master directory')
+    parser.add_argument('--keep', type=int, default=3,
+                        help='builds to keep per package/distro/arch (default: 3)')
+    parser.add_argument('--repo', default='/var/www/building/ubuntu',
+                        help='reprepro repository, files it references are always kept')
+    parser.add_argument('--grace-days', type=float, default=1,
+                        help='keep unlinked artifacts stored or used this recently (default: 1)')
+    parser.add_argument('--dry-run', action='store_true', help='only print what would be removed')
+    args = parser.parse_args()
+
+    referenced = referenced_files(args.repo)
+    print('%d files referenced by reprepro' % len(referenced))
+    total_files = 0
+    total_bytes = 0
+    for d in ['binarydebs', 'sourcedebs']:
+        directory = os.path.join(args.basedir, d)
+        if not os.path.isdir(directory):
+            continue
+        shard(directory, args.dry_run)
+        files, reclaimed = collect(directory, args.keep, referenced, args.dry_run)
+        print('%s: removed %d files, reclaimed %d bytes' % (d, files, reclaimed))
+        total_files += files
+        total_bytes += reclaimed
+    blobs, reclaimed = sweep_store(os.path.join(args.basedir, 'artifacts'), args.grace_days*24*3600, args.dry_run)
+    print('artifacts: removed %d blobs, reclaimed %d bytes' % (blobs, reclaimed))
+    total_bytes += reclaimed
+    print('Total: removed %d files, reclaimed %.1f MB' % (total_files + blobs, total_bytes / 1048576.0))
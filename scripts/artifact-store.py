@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+# This is used on the master to store uploaded artifacts by content (sha256)
+# and hardlink them into sourcedebs/, binarydebs/, etc.
+
+from __future__ import print_function
+import os
+import fcntl
+import hashlib
+import tarfile
+import tempfile
+import argparse
+
+## @brief Lock of the store, held shared while storing so artifact-gc.py does not sweep
+LOCK_FILE = '.lock'
+
+## @brief Get the path of a blob in the store
+## @param store The store directory
+## @param sha256 The checksum of the blob
+def blob_path(store, sha256):
+    return os.path.join(store, sha256[:2], sha256)
+
+## @brief Move the members of an uploaded archive into the store
+## @param store The store directory
+## @param archive Path of the tar archive
+## @returns Dictionary of member name -> sha256
+def ingest(store, archive):
+    sums = dict()
+    tar = tarfile.open(archive)
+    try:
+        for member in tar:
+            if not member.isfile():
+                continue
+            h = hashlib.sha256()
+            src = tar.extractfile(member)
+            fd, tmp = tempfile.mkstemp(dir=store)
+            with os.fdopen(fd, 'wb') as out:
+                for chunk in iter(lambda: src.read(65536), b''):
+                    h.update(chunk)
+                    out.write(chunk)
+            sha256 = h.hexdigest()
+            path = blob_path(store, sha256)
+            if os.path.exists(path):
+                os.remove(tmp)
+                # recently used, artifact-gc.py keeps it for a while
+                os.utime(path, None)
+            else:
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                os.chmod(tmp, 0o644)
+                os.rename(tmp, path)
+            sums[os.path.basename(member.name)] = sha256
+            print('stored %s as %s' % (member.name, sha256))
+    finally:
+        tar.close()
+    os.remove(archive)
+    return sums
+
+## @brief Hardlink a blob to its destination
+## @param store The store directory
+## @param sha256 The checksum of the blob
+## @param dest The destination path
+def link(store, sha256, dest):
+    path = blob_path(store, sha256)
+    if not os.path.exists(path):
+        print('ERROR: %s is not in the artifact store' % sha256)
+        exit(1)
+    if not os.path.isdir(os.path.dirname(dest)):
+        os.makedirs(os.path.dirname(dest))
+    if os.path.lexists(dest):
+        os.remove(dest)
+    os.link(path, dest)
+    print('linked %s -> %s' % (dest, sha256))
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description='Store artifacts by content and link them in place')
+    parser.add_argument('--store', default='artifacts', help='directory of the store')
+    parser.add_argument('--archive', help='uploaded tar archive of new artifacts')
+    parser.add_argument('links', nargs='*', metavar='SHA256:DEST',
+                        help='link the blob with this checksum to DEST')
+    args = parser.parse_args()
+    if not os.path.isdir(args.store):
+        os.makedirs(args.store)
+    lock = open(os.path.join(args.store, LOCK_FILE), 'a')
+    fcntl.flock(lock, fcntl.LOCK_SH)
+    if args.archive:
+        ingest(args.store, args.archive)
+    for l in args.links:
+        sha256, dest = l.split(':', 1)
+        link(args.store, sha256, dest)
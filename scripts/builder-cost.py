@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+
+# This is used on the master to record the resources used by the last
+# builds of each builder, which the slave policy uses to place builds
+
+from __future__ import print_function
+import sys
+import os
+import json
+import fcntl
+
+# Weight of the newest build in the recorded cost
+ALPHA = 0.5
+
+## @brief Record the cost of a build
+## @param costs The costs file (JSON, builder -> cost)
+## @param builder The name of the builder
+## @param usage Dictionary of cpu_s, maxrss_kb and disk_kb of the build
+def record(costs, builder, usage):
+    with open(costs+'.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            with open(costs) as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            data = dict()
+        old = data.get(builder)
+        new = dict()
+        for key, value in usage.items():
+            if old is None or key not in old:
+                new[key] = value
+            else:
+                # a moving average, so one odd build does not move a builder around
+                new[key] = int(ALPHA * value + (1 - ALPHA) * old[key])
+        new['builds'] = (old or {}).get('builds', 0) + 1
+        data[builder] = new
+        with open(costs+'.tmp', 'w') as f:
+            json.dump(data, f, indent=1, sort_keys=True)
+        os.rename(costs+'.tmp', costs)
+    print('%s: %s' % (builder, ', '.join('%s=%s' % (k, new[k]) for k in sorted(new))))
+
+if __name__=="__main__":
+    if len(sys.argv) < 4:
+        print('')
+        print('Usage: builder-cost.py <costs.json> <builder> <key=value>...')
+        print('')
+        exit(-1)
+    usage = dict()
+    for arg in sys.argv[3:]:
+        key, _, value = arg.partition('=')
+        try:
+            usage[key] = int(value)
+        except ValueError:
+            print('Ignoring %s, not a number' % arg)
+    record(sys.argv[1], sys.argv[2], usage)
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+
+# This is used to setup the persistent compiler cache shared by all
+# chroot sessions for a given distro/arch on this slave
+
+from __future__ import print_function
+import sys
+import os
+import subprocess
+
+# A bit hacky, but do this rather than redefine the function.
+# Has to be in testbuild, as we only copy testbuild to pbuilder.
+from testbuild import call
+
+## @brief Returns the ccache directory on this slave
+## @param distro The UBUNTU distribution (for instance, 'precise')
+## @param arch The architecture (for instance, 'amd64')
+def ccachepath(distro, arch):
+    return '/var/cache/pbuilder/ccache-'+distro+'-'+arch
+
+## @brief Create the cache directory (if needed) and bound its size
+## @param distro The UBUNTU distribution (for instance, 'precise')
+## @param arch The architecture (for instance, 'amd64')
+## @param max_size Maximum size of the cache (for instance, '4G')
+## @param pbuilderrc If set, write a pbuilder config file enabling the cache
+def setup_ccache(distro, arch, max_size, pbuilderrc=None):
+    path = ccachepath(distro, arch)
+    call(['sudo', 'mkdir', '-p', path])
+    # chroots write to the cache as root or the pbuilder user
+    call(['sudo', 'chmod', '-R', 'a+rwX', path])
+    with open(os.path.join(path, 'ccache.conf'), 'w') as f:
+        f.write('max_size = %s\n' % max_size)
+        f.write('umask = 000\n')
+    print('ccache for %s-%s in %s, limited to %s' % (distro, arch, path, max_size))
+    if pbuilderrc:
+        # pbuilder bind-mounts CCACHEDIR and puts /usr/lib/ccache in the PATH
+        with open(pbuilderrc, 'w') as f:
+            f.write('CCACHEDIR=%s\n' % path)
+
+## @brief Print the statistics of the cache
+def print_stats(distro, arch):
+    env = dict(os.environ)
+    env['CCACHE_DIR'] = ccachepath(distro, arch)
+    try:
+        print(subprocess.check_output(['ccache', '-s'], env=env))
+    except (OSError, subprocess.CalledProcessError) as e:
+        print('Unable to get ccache stats: %s' % e)
+        exit(1)
+
+if __name__=="__main__":
+    if len(sys.argv) < 4:
+        print('')
+        print('Usage: ccache-setup.py <distro> <arch> <max_size> [pbuilderrc]')
+        print('       ccache-setup.py --stats <distro> <arch>')
+        print('')
+        exit(-1)
+    if sys.argv[1] == '--stats':
+        print_stats(sys.argv[2], sys.argv[3])
+    else:
+        setup_ccache(sys.argv[1], sys.argv[2], sys.argv[3],
+                     sys.argv[4] if len(sys.argv) > 4 else None)
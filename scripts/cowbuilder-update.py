@@ -106,14 +106,19 @@ def make_cowbuilder(distro, arch, keys):
                #'--othermirror', defaultmirrors(distro)]
     print('Executing command "%s"' % ' '.join(command))
     cowbuilder = subprocess.Popen(command, stdout=subprocess.PIPE, stdin=subprocess.PIPE, stderr=subprocess.STDOUT)
-    output = cowbuilder.communicate(input="""echo "Installing python"
+    cowbuilder.stdin.write("""echo "Installing python"
 apt-get install python -y
 echo "Installing wget"
 apt-get install wget -y
 """+getKeyCommands(keys)+"""echo "exiting"
 exit
 """)
-    print(output[0])
+    cowbuilder.stdin.close()
+    # print the session as it goes, rather than all of it once it is over
+    for line in iter(cowbuilder.stdout.readline, ''):
+        sys.stdout.write(line)
+        sys.stdout.flush()
+    cowbuilder.wait()
     if cowbuilder.returncode != 0:
         exit(cowbuilder.returncode)
 
@@ -3,12 +3,29 @@
 # This file is the actual docbuild that is run
 
 from __future__ import print_function
-import sys, os, shutil, subprocess
+import sys, os, shutil, subprocess, time, argparse, multiprocessing, hashlib, tarfile
+
+# Directories that never contain packages we want to document
+SKIP_DIRS = ['build', 'devel', 'install', '.git']
+
+# Exit code when some packages failed, the docs that were
+# generated are still uploaded
+PARTIAL_FAILURE = 2
+
+# Packages whose version is part of the documentation fingerprint (with rosdoc_lite)
+DOC_TOOLS = ['doxygen', 'python-epydoc', 'python-sphinx']
+
+# Archive of the documentation that changed, relative to the workspace
+CHANGED_ARCHIVE = 'docs-changed.tar.gz'
 
 ## @brief Build the docs (using doxygen/epydoc/etc)
 ## @param workspace A bind-mounted directory to build from/in
 ## @param rosdistro The rosdistro to build for (for instance, 'groovy')
-def run_docbuild(workspace, rosdistro):
+## @param jobs Number of packages to document in parallel
+## @param incremental If True, keep the docs of packages whose fingerprint did not
+##        change, and archive the docs that did change in CHANGED_ARCHIVE
+## @returns (List of packages for which documentation failed, number of packages documented)
+def run_docbuild(workspace, rosdistro, jobs=1, incremental=False):
     # Install depends
     call(['apt-get', 'update'])
     call(['apt-get', 'install', '--yes',
@@ -19,45 +36,190 @@ def run_docbuild(workspace, rosdistro):
           'python-sphinx',
           'graphviz'])
 
-    if os.path.exists(os.path.join(workspace, 'docs')):
+    if os.path.exists(os.path.join(workspace, 'docs')) and not incremental:
         shutil.rmtree(os.path.join(workspace, 'docs'))
 
     ros_env = get_ros_env('/opt/ros/%s/setup.bash' % rosdistro)
 
     # Generate a dictionary of package name -> source path
     package_path = dict()
-    for f in os.listdir( os.path.join(workspace, 'src') ):
-        search_for_packages(f, os.path.join(workspace, 'src'), package_path)
+    search_for_packages(os.path.join(workspace, 'src'), package_path)
+
+    # Skip packages whose sources and doc tools did not change
+    fingerprints = dict()
+    if incremental:
+        versions = tool_versions(['ros-%s-rosdoc-lite' % rosdistro] + DOC_TOOLS)
+        for package, path in package_path.items():
+            fingerprints[package] = package_fingerprint(path, versions)
+        unchanged = [p for p in package_path.keys()
+                     if read_stamp(workspace, p) == fingerprints[p] and
+                        os.path.isdir(os.path.join(workspace, 'docs', p))]
+        if unchanged:
+            print('Reusing docs for: ' + ' '.join(sorted(unchanged)))
+        for package in unchanged:
+            del package_path[package]
+        for package in package_path.keys():
+            # old output might contain files rosdoc_lite no longer generates
+            if os.path.exists(os.path.join(workspace, 'docs', package)):
+                shutil.rmtree(os.path.join(workspace, 'docs', package))
     print('Generating docs for: ' + ' '.join(package_path.keys()))
 
-    # For each package, call rosdoc_lite
-    for package, path in package_path.iteritems():
-        call([ 'rosdoc_lite',
-               os.path.join(workspace, 'src', path),
-               '-o', os.path.join(workspace, 'docs', package) ],
-             ros_env)
+    # For each package, call rosdoc_lite, each writes its own log
+    log_dir = os.path.join(workspace, 'doclogs')
+    if os.path.exists(log_dir):
+        shutil.rmtree(log_dir)
+    os.makedirs(log_dir)
+    tasks = [(package, path, os.path.join(workspace, 'docs', package),
+              os.path.join(log_dir, package+'.log'), dict(ros_env))
+             for package, path in sorted(package_path.items())]
+    results = None
+    if jobs > 1 and len(tasks) > 1:
+        try:
+            pool = multiprocessing.Pool(min(jobs, len(tasks)))
+        except OSError as e:
+            # no /dev/shm in some chroots
+            print('Unable to create process pool (%s), documenting serially' % e)
+        else:
+            try:
+                results = pool.map(build_package_docs, tasks, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+    if results is None:
+        results = [build_package_docs(task) for task in tasks]
+
+    # Output logs in package order, then a summary
+    failed = list()
+    for (package, returncode, duration), task in zip(results, tasks):
+        print('=' * 70)
+        print('rosdoc_lite %s (%.1fs)' % (package, duration))
+        print('=' * 70)
+        with open(task[3]) as f:
+            sys.stdout.write(f.read())
+        if returncode != 0:
+            failed.append(package)
+            if incremental:
+                write_stamp(workspace, package, None)
+        elif incremental:
+            write_stamp(workspace, package, fingerprints[package])
+    print('')
+    print('Summary:')
+    for package, returncode, duration in results:
+        print('  %-40s %-8s %7.1fs' % (package, 'FAILED' if returncode else 'ok', duration))
+
+    if incremental:
+        archive_docs(workspace, [p for p in package_path.keys() if p not in failed])
 
     # Hack so the buildbot can delete this directory later
-    call(['chmod', '-R', '777', os.path.join(workspace, 'docs')])
+    if os.path.exists(os.path.join(workspace, 'docs')):
+        call(['chmod', '-R', '777', os.path.join(workspace, 'docs')])
+    return failed, len(tasks)
+
+## @brief Get the installed versions of some debian packages
+## @param packages List of debian package names
+## @returns A string describing the versions
+def tool_versions(packages):
+    # dpkg-query fails if any package is missing, but still lists the others
+    try:
+        proc = subprocess.Popen(['dpkg-query', '-W', '-f=${Package} ${Version}\\n'] + packages,
+                                stdout=subprocess.PIPE)
+        output = proc.communicate()[0]
+    except OSError as e:
+        print('Unable to get versions of %s: %s' % (' '.join(packages), e))
+        output = b''
+    return output.decode('utf8', 'replace')
+
+## @brief Compute the fingerprint of a package's documentation
+## @param path The source directory of the package
+## @param versions Versions of the tools used to build docs
+def package_fingerprint(path, versions):
+    h = hashlib.sha1()
+    h.update(versions.encode('utf8'))
+    for root, dirs, files in os.walk(path):
+        dirs[:] = sorted(d for d in dirs if d not in SKIP_DIRS)
+        for name in sorted(files):
+            filename = os.path.join(root, name)
+            h.update(os.path.relpath(filename, path).encode('utf8'))
+            if os.path.islink(filename):
+                h.update(os.readlink(filename).encode('utf8'))
+                continue
+            with open(filename, 'rb') as f:
+                for chunk in iter(lambda: f.read(65536), b''):
+                    h.update(chunk)
+    return h.hexdigest()
+
+## @brief Get the fingerprint of the docs last generated for a package
+def read_stamp(workspace, package):
+    try:
+        with open(os.path.join(workspace, 'docstamps', package)) as f:
+            return f.read().strip()
+    except IOError:
+        return None
+
+## @brief Record (or clear, if fingerprint is None) the fingerprint of a package's docs
+def write_stamp(workspace, package, fingerprint):
+    stamp = os.path.join(workspace, 'docstamps', package)
+    if fingerprint is None:
+        if os.path.exists(stamp):
+            os.remove(stamp)
+        return
+    if not os.path.isdir(os.path.dirname(stamp)):
+        os.makedirs(os.path.dirname(stamp))
+    with open(stamp, 'w') as f:
+        f.write(fingerprint)
+
+## @brief Archive the docs of the given packages, to be unpacked in place on the master
+def archive_docs(workspace, packages):
+    archive = os.path.join(workspace, CHANGED_ARCHIVE)
+    tar = tarfile.open(archive, 'w:gz')
+    try:
+        for package in sorted(packages):
+            tar.add(os.path.join(workspace, 'docs', package), arcname=package)
+    finally:
+        tar.close()
+    print('Archived docs for %d changed packages in %s (%d bytes)'
+          % (len(packages), archive, os.path.getsize(archive)))
+    call(['chmod', '666', archive])
+
+## @brief Run rosdoc_lite for one package, safe to call from a process pool
+## @param task Tuple of (package, source path, output path, log file, environment)
+## @returns Tuple of (package, return code, duration in seconds)
+def build_package_docs(task):
+    package, path, output, log_file, envir = task
+    start = time.time()
+    with open(log_file, 'w') as log:
+        command = ['rosdoc_lite', path, '-o', output]
+        log.write('Executing command "%s"\n' % ' '.join(command))
+        log.flush()
+        try:
+            returncode = subprocess.call(command, stdout=log, stderr=subprocess.STDOUT,
+                                         close_fds=True, env=envir)
+        except OSError as e:
+            log.write('Failed to execute rosdoc_lite: %s\n' % e)
+            returncode = -1
+    return (package, returncode, time.time() - start)
 
 ## @brief Helper function for recursively finding packages
-## @param directory The name of this directory. Also the name of the package if
-##        this directory contains a package.xml
-## @param path The path leading to this directory.
+## @param path The directory to search. If it contains a package.xml, its
+##        name is the name of the package and subdirectories are not searched.
 ## @param package_path The dictionary of package:path data to add to
-def search_for_packages(directory, path, package_path):
-    # is this a directory?
-    if not os.path.isdir( os.path.join(path, directory) ):
+def search_for_packages(path, package_path):
+    if os.path.exists(os.path.join(path, 'package.xml')):
+        print('... found package in ' + path)
+        package_path[os.path.basename(path)] = path
         return
-    print('Considering ' + os.path.join(path, directory))
-    # does this directory have a package.xml?
-    if os.path.exists( os.path.join(path, directory, 'package.xml') ):
-        print('... found package')
-        package_path[directory] = os.path.join(path, directory)
-    else:
-        # Search subdirectories for package.xml
-        for f in os.listdir( os.path.join(path, directory) ):
-            search_for_packages(f, os.path.join(path, directory), package_path)
+    # Search subdirectories for package.xml
+    for name in list_subdirectories(path):
+        if name in SKIP_DIRS:
+            continue
+        search_for_packages(os.path.join(path, name), package_path)
+
+## @brief Get the names of the subdirectories of a directory
+def list_subdirectories(path):
+    if hasattr(os, 'scandir'):
+        return [e.name for e in os.scandir(path) if e.is_dir()]
+    # python 2 has no scandir
+    return [f for f in os.listdir(path) if os.path.isdir(os.path.join(path, f))]
 
 ## @brief Call a command
 ## @param command Should be a list
@@ -99,10 +261,17 @@ class BuildException(Exception):
         self.msg = msg
 
 if __name__=="__main__":
-    if len(sys.argv) < 3:
-        print('')
-        print('Usage: docbuild.py <workspace> <rosdistro>')
-        print('')
-        exit(-1)
-    workspace = sys.argv[1] # for cleanup
-    run_docbuild(sys.argv[1], sys.argv[2])
+    parser = argparse.ArgumentParser(description='Build the documentation of a workspace')
+    parser.add_argument('workspace', help='bind-mounted workspace, with code checked out to src/')
+    parser.add_argument('rosdistro', help='name of the ROS distro to build for')
+    parser.add_argument('--jobs', type=int, default=multiprocessing.cpu_count(),
+                        help='number of packages to document in parallel')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only rebuild docs of changed packages, and archive them in '+CHANGED_ARCHIVE)
+    args = parser.parse_args()
+    workspace = args.workspace # for cleanup
+    failed, documented = run_docbuild(args.workspace, args.rosdistro, args.jobs, args.incremental)
+    if failed:
+        print('Documentation failed for: ' + ' '.join(failed))
+        # nothing was documented, this is not a partial failure
+        exit(1 if len(failed) == documented else PARTIAL_FAILURE)
@@ -0,0 +1,25 @@
+#!/bin/bash
+
+# This script will unpack an archive of changed package docs into the
+# docs directory on the master, replacing the old docs of those packages
+
+if [[ ${#} -lt 2 ]]; then
+    echo "Usage: ${0} <archive.tar.gz> <docs_dir>"
+    exit -1
+fi
+export ARCHIVE=${1}
+export DEST=${2}
+
+mkdir -p "$DEST" || exit 1
+
+# remove the old docs of each package in the archive
+tar tzf "$ARCHIVE" | cut -d/ -f1 | sort -u | while read -r PKG
+do
+    if [[ -n "$PKG" && "$PKG" != "." && "$PKG" != ".." ]]; then
+        echo "Replacing docs for $PKG"
+        rm -rf "$DEST/$PKG"
+    fi
+done
+
+tar xzf "$ARCHIVE" -C "$DEST" || exit 1
+rm -f "$ARCHIVE"
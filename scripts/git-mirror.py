@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+
+# This is used to keep a bare mirror of a repository on the slave, which
+# checkouts then use as a reference so only new objects hit the network
+
+from __future__ import print_function
+import sys
+import os
+import fcntl
+import time
+
+# A bit hacky, but do this rather than redefine the function.
+# Has to be in testbuild, as we only copy testbuild to pbuilder.
+from testbuild import call
+
+## @brief Create or update a bare mirror of a repository
+## @param url The URL of the repository
+## @param path Path of the bare mirror
+def update_mirror(url, path):
+    parent = os.path.dirname(path)
+    if not os.path.exists(parent):
+        os.makedirs(parent)
+    # only one build may touch a given mirror at a time
+    with open(path+'.lock', 'w') as lock:
+        print('(' + str(time.time()) +')Getting lock on ' + path)
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        print('(' + str(time.time()) +')Got lock!')
+        if not os.path.exists(os.path.join(path, 'HEAD')):
+            call(['git', 'clone', '--mirror', url, path])
+            # checkouts borrow objects from here, they must never be pruned
+            call(['git', '--git-dir', path, 'config', 'gc.pruneExpire', 'never'])
+        else:
+            call(['git', '--git-dir', path, 'remote', 'set-url', 'origin', url])
+            call(['git', '--git-dir', path, 'fetch', '--prune', 'origin'])
+
+if __name__=="__main__":
+    if len(sys.argv) < 3:
+        print('')
+        print('Usage: git-mirror.py <url> <mirror_path>')
+        print('')
+        exit(-1)
+    update_mirror(sys.argv[1], sys.argv[2])
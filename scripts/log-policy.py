@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+# This is used on the slaves to cut down the logs of the steps that print a
+# lot (compilers, apt, the tests): the first lines of output are sent to the
+# master as they come, and the rest is kept on the slave. When the command
+# succeeds only its last lines are sent, when it fails all of them are.
+
+from __future__ import print_function
+import sys
+import gzip
+import tempfile
+import threading
+import subprocess
+from collections import deque
+
+## @brief Seconds between two notes that output is held back, buildbot kills
+##        commands that print nothing for too long
+HEARTBEAT = 60
+
+## @brief Run a command, sending its output according to the policy
+## @param command The command to run, as a list
+## @param head Number of lines sent as they come
+## @param tail Number of last lines sent when the command succeeds
+## @returns The return code of the command
+def run(command, head, tail):
+    try:
+        proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, bufsize=-1)
+    except OSError as e:
+        print('Failed to execute command "%s": %s' % (' '.join(command), e))
+        return 127
+
+    # output is bytes, written as is (python 3 needs the binary stream of stdout)
+    out = getattr(sys.stdout, 'buffer', sys.stdout)
+    # the output after the head, compressed, to send it all if the command fails
+    spool = tempfile.TemporaryFile(mode='w+b')
+    held = gzip.GzipFile(fileobj=spool, mode='wb', compresslevel=1)
+    last = deque(maxlen=tail)
+    counts = {'lines': 0, 'bytes': 0, 'held': 0, 'sent': 0}
+    lock = threading.Lock()
+
+    def send(line):
+        out.write(line)
+        counts['sent'] += len(line)
+
+    def note(text):
+        out.write(('[log-policy] '+text+'\n').encode('utf8'))
+        out.flush()
+
+    done = threading.Event()
+    def heartbeat():
+        while not done.wait(HEARTBEAT):
+            with lock:
+                if counts['held']:
+                    note('%d lines held back so far' % counts['held'])
+    thread = threading.Thread(target=heartbeat)
+    thread.daemon = True
+    thread.start()
+
+    for line in iter(proc.stdout.readline, b''):
+        with lock:
+            counts['lines'] += 1
+            counts['bytes'] += len(line)
+            if counts['lines'] <= head:
+                send(line)
+                out.flush()
+            else:
+                held.write(line)
+                last.append(line)
+                counts['held'] += 1
+    proc.wait()
+    done.set()
+    thread.join()
+    held.close()
+
+    if counts['held'] > len(last) and proc.returncode == 0:
+        note('%d lines not shown, the whole output is only kept when the command fails'
+             % (counts['held'] - len(last)))
+        for line in last:
+            send(line)
+    else:
+        spool.seek(0)
+        for line in gzip.GzipFile(fileobj=spool, mode='rb'):
+            send(line)
+    spool.close()
+    note('sent %d of %d bytes of output' % (counts['sent'], counts['bytes']))
+    return proc.returncode
+
+if __name__=="__main__":
+    if len(sys.argv) < 4 or not sys.argv[1].isdigit() or not sys.argv[2].isdigit():
+        print('')
+        print('Usage: log-policy.py <head> <tail> <command...>')
+        print('')
+        exit(-1)
+    exit(run(sys.argv[3:], int(sys.argv[1]), int(sys.argv[2])))
@@ -24,4 +24,10 @@ sudo reprepro -V -b $REPO_DIR removefilter $DISTRO "Package (==$PKG), Architectu
 
 sudo reprepro -V -b $REPO_DIR deleteunreferenced
 
-sudo reprepro -V -b $REPO_DIR includedeb $DISTRO $BUILD_DIR/binarydebs/$NAME
+# debs are stored in a directory per package, older uploads are at the top level
+DEB=$BUILD_DIR/binarydebs/$PKG/$NAME
+if [ ! -f "$DEB" ]; then
+    DEB=$BUILD_DIR/binarydebs/$NAME
+fi
+
+sudo reprepro -V -b $REPO_DIR includedeb $DISTRO $DEB
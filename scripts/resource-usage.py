@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+# This is used on the slaves (and the master) to measure the resources used
+# by each step of a build (CPU time, peak memory) and the disk it takes, so
+# the master can place builds on the slave that fits them best and report
+# where the time of a build goes
+
+from __future__ import print_function
+import sys
+import os
+import json
+import time
+import resource
+import subprocess
+
+## @brief Run a command and add its resource usage to a report
+## @param report The report file (JSON), created if needed
+## @param step The name of the step running the command
+## @param command The command to run, as a list
+## @returns The return code of the command
+def run(report, step, command):
+    start = time.time()
+    before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    try:
+        returncode = subprocess.call(command)
+    except OSError as e:
+        print('Failed to execute command "%s": %s' % (' '.join(command), e))
+        returncode = 127
+    after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    # sudo, cowbuilder and the compilers are all waited for, so they are in RUSAGE_CHILDREN
+    cpu_s = (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime)
+    wall_s = time.time() - start
+    usage = read_report(report)
+    steps = usage.setdefault('steps', dict())
+    for totals in [usage, steps.setdefault(step, dict())]:
+        totals['cpu_s'] = totals.get('cpu_s', 0) + cpu_s
+        totals['maxrss_kb'] = max(totals.get('maxrss_kb', 0), after.ru_maxrss)
+        totals['wall_s'] = totals.get('wall_s', 0) + wall_s
+    if os.path.dirname(report) and not os.path.isdir(os.path.dirname(report)):
+        os.makedirs(os.path.dirname(report))
+    with open(report, 'w') as f:
+        json.dump(usage, f)
+    return returncode
+
+## @brief Read a report, empty if there is none
+def read_report(report):
+    try:
+        with open(report) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return dict()
+
+## @brief Get the disk usage of a directory, in kilobytes
+def disk_usage(path):
+    # some files were created by root in the cowbuilder, errors are not fatal
+    proc = subprocess.Popen(['du', '-sk', path], stdout=subprocess.PIPE)
+    output = proc.communicate()[0].decode('utf8', 'replace')
+    try:
+        return int(output.split()[0])
+    except (IndexError, ValueError):
+        return 0
+
+## @brief Print the totals of a report and remove it, so the next build starts over
+## @param report The report file
+## @param path If set, the directory whose disk usage is reported
+def summary(report, path=None):
+    usage = read_report(report)
+    steps = usage.pop('steps', dict())
+    if path:
+        usage['disk_kb'] = disk_usage(path)
+    for key in sorted(usage.keys()):
+        print('%s=%s' % (key, int(round(usage[key]))))
+    # most steps take less than a second
+    for step in sorted(steps.keys()):
+        for key in sorted(steps[step].keys()):
+            print('step.%s.%s=%s' % (step, key, round(steps[step][key], 1)))
+    if os.path.exists(report):
+        os.remove(report)
+
+if __name__=="__main__":
+    if len(sys.argv) < 3 or sys.argv[1] not in ['run', 'summary'] or \
+       (sys.argv[1] == 'run' and len(sys.argv) < 5):
+        print('')
+        print('Usage: resource-usage.py run <report> <step> <command...>')
+        print('       resource-usage.py summary <report> [directory]')
+        print('')
+        exit(-1)
+    if sys.argv[1] == 'run':
+        exit(run(sys.argv[2], sys.argv[3], sys.argv[4:]))
+    summary(sys.argv[2], sys.argv[3] if len(sys.argv) > 3 else None)
@@ -3,7 +3,7 @@
 # This file is the actual buildtest that is run
 
 from __future__ import print_function
-import sys, os, subprocess, shutil
+import sys, os, subprocess, shutil, hashlib, argparse
 
 GTESTPASS = '[       OK ]'
 GTESTFAIL = '[  FAILED  ]'
@@ -14,11 +14,22 @@ ROSTESTPASS = ' * TESTS: '
 ROSTESTFAIL = ' * FAILURES: '
 ROSTESTERROR = ' * ERRORS: '
 
+# File in the build directory recording what it was configured against
+BUILDKEY = '.buildbot_key'
+
 ## @brief Run the build and test for a repository of catkin packages
 ## @param workspace Directory to do work in (typically bind-mounted,
 ##        code needs to be already checked out to workspace/src/*)
 ## @param rosdistro Name of the distro to build for, for instance, 'groovy'
-def run_build_and_test(workspace, rosdistro):
+## @param ccache_dir Bind-mounted compiler cache directory, or None
+## @param incremental If set, the name of the branch being built; the build
+##        directory is kept between builds of the same branch
+def run_build_and_test(workspace, rosdistro, ccache_dir=None, incremental=None):
+
+    # fingerprint the chroot before we install anything into it
+    if incremental:
+        with open('/var/lib/dpkg/status') as f:
+            chroot_hash = hashlib.sha1(f.read()).hexdigest()
 
     # need to install dependencies, hack python path, import stuff
     call(['apt-get', 'update'])
@@ -49,26 +60,38 @@ def run_build_and_test(workspace, rosdistro):
     apt_get_install(rosdep.to_aptlist(build_depends))
     pip_install(rosdep.to_piplist(build_depends))
 
+    # Use the persistent compiler cache, if we have one
+    if ccache_dir:
+        apt_get_install(['ccache'])
+        os.environ['CCACHE_DIR'] = ccache_dir
+        os.environ['PATH'] = '/usr/lib/ccache:' + os.environ['PATH']
+
     # Get environment
     ros_env = get_ros_env('/opt/ros/%s/setup.bash' % rosdistro)
 
-    os.makedirs(workspace+'/build')
+    reused = False
+    if incremental:
+        key = build_key(incremental, chroot_hash, build_depends)
+        reused = reuse_build(workspace, key)
+    else:
+        key = None
+        os.makedirs(workspace+'/build')
     if os.path.exists(workspace+'/test'):
         shutil.rmtree(workspace+'/test')
     os.makedirs(workspace+'/test')
-    os.chdir(workspace+'/build')
 
-    print('catkin_init_workspace')
-    call(['catkin_init_workspace', '../src'], ros_env)
-    # Workaround for nosetest 1.3.1 issue with non-absolute paths on Trusty
-    #  (https://github.com/nose-devs/nose/issues/779)
-    test_dir = os.path.realpath('../test')
-    call(['cmake', '../src', '-DCATKIN_TEST_RESULTS_DIR='+test_dir], ros_env)
-    
-    print('make')
-    call(['make'], ros_env)
-    print('make tests')
-    call(['make', 'tests'], ros_env)
+    try:
+        build(workspace, ros_env, key)
+    except BuildException:
+        if not reused:
+            raise
+        # the old build tree may be broken, fall back to a clean build
+        print('Incremental build failed, retrying with a clean build directory')
+        for d in ['/build', '/test']:
+            if os.path.exists(workspace+d):
+                shutil.rmtree(workspace+d)
+            os.makedirs(workspace+d)
+        build(workspace, ros_env, key)
 
     # now install the run depends
     print('Examining run dependencies.')
@@ -86,9 +109,24 @@ def run_build_and_test(workspace, rosdistro):
     ros_env = get_ros_env('./devel/setup.bash')
     test_results = call(['make', 'run_tests'], ros_env, return_output = True)
 
-    # Output test results to a file
-    f = open(workspace + '/testresults', 'w')
+    # Output test results to a file, and the counts to a small one for buildbot to evaluate
+    results = parse_test_output(test_results.split('\n'))
+    with open(workspace + '/testresults', 'w') as f:
+        write_test_results(f, results, test_results)
+    with open(workspace + '/testsummary', 'w') as f:
+        write_test_summary(f, results)
+
+    # Hack so the buildbot can delete this later
+    call(['chmod', '777', workspace+'/testresults', workspace+'/testsummary'])
+    if incremental:
+        call(['chmod', '-R', 'a+rwX', workspace+'/build'])
+    cleanup()
 
+## @brief Find the results of the tests in the output of 'make run_tests'
+## @param lines The lines of the output
+## @returns Dictionary of gtest_pass, gtest_fail and pnose_fail (lists of names),
+##          and pnose_total, rostest_pass, rostest_fail and rostest_err (counts)
+def parse_test_output(lines):
     # Metrics from tests
     gtest_pass = list()
     gtest_fail = list()
@@ -98,7 +136,7 @@ def run_build_and_test(workspace, rosdistro):
     rostest_fail = 0
     rostest_err = 0
 
-    for line in test_results.split('\n'):
+    for line in lines:
         # Is this a gtest pass?
         if line.find(GTESTPASS) > -1:
             name = line[line.find(GTESTPASS)+len(GTESTPASS)+1:].split(' ')[0]
@@ -144,14 +182,30 @@ def run_build_and_test(workspace, rosdistro):
                     # Might have formatting attached, remove 1 character at time
                     l = l[0:-1]
 
-
+    return {'gtest_pass': gtest_pass, 'gtest_fail': gtest_fail,
+            'pnose_fail': pnose_fail, 'pnose_total': pnose_total,
+            'rostest_pass': rostest_pass, 'rostest_fail': rostest_fail,
+            'rostest_err': rostest_err}
+
+## @brief Count the tests that passed and failed
+## @param results The results of parse_test_output
+## @returns (passed, failed)
+def count_tests(results):
+    passed = len(results['gtest_pass']) + results['pnose_total'] - len(results['pnose_fail']) + results['rostest_pass']
+    failed = len(results['gtest_fail']) + len(results['pnose_fail']) + results['rostest_fail'] + results['rostest_err']
+    return passed, failed
+
+## @brief Write the testresults file, the first line tells if the tests passed
+## @param f The file to write to
+## @param results The results of parse_test_output
+## @param test_results The output of 'make run_tests', appended after the summary
+def write_test_results(f, results, test_results):
     # determine if we failed
-    passed = len(gtest_pass) + pnose_total - len(pnose_fail) + rostest_pass
-    failed = len(gtest_fail) + len(pnose_fail) + rostest_fail + rostest_err
+    passed, failed = count_tests(results)
     if failed > 0:
         f.write('*'*70 + '\n')
         f.write('Failed '+str(failed)+' of '+str(passed+failed)+' tests.\n')
-        for test in gtest_fail + pnose_fail:
+        for test in results['gtest_fail'] + results['pnose_fail']:
             f.write('  failed: '+test+'\n')
         f.write('See details below\n')
         f.write('*'*70 + '\n')
@@ -160,11 +214,66 @@ def run_build_and_test(workspace, rosdistro):
 
     f.write('\n')
     f.write(test_results)
-    f.close()
 
-    # Hack so the buildbot can delete this later
-    call(['chmod', '777', workspace+'/testresults'])
-    cleanup()
+## @brief Write the testsummary file, buildbot evaluates the tests from it
+## @param f The file to write to
+## @param results The results of parse_test_output
+def write_test_summary(f, results):
+    passed, failed = count_tests(results)
+    f.write('passed='+str(passed)+'\n')
+    f.write('failed='+str(failed)+'\n')
+
+## @brief Configure and build the workspace, including tests
+## @param workspace Directory to do work in
+## @param ros_env Environment to build with
+## @param key If set, stored in the build directory once configured
+def build(workspace, ros_env, key=None):
+    os.chdir(workspace+'/build')
+
+    # An incremental checkout keeps the toplevel CMakeLists.txt around
+    if not os.path.exists('../src/CMakeLists.txt'):
+        print('catkin_init_workspace')
+        call(['catkin_init_workspace', '../src'], ros_env)
+    # Workaround for nosetest 1.3.1 issue with non-absolute paths on Trusty
+    #  (https://github.com/nose-devs/nose/issues/779)
+    test_dir = os.path.realpath('../test')
+    call(['cmake', '../src', '-DCATKIN_TEST_RESULTS_DIR='+test_dir], ros_env)
+    if key:
+        with open(BUILDKEY, 'w') as f:
+            f.write(key)
+
+    print('make')
+    call(['make'], ros_env)
+    print('make tests')
+    call(['make', 'tests'], ros_env)
+
+## @brief Compute the key under which a build directory can be reused
+## @param branch The branch being built
+## @param chroot_hash Hash of the package state of the chroot
+## @param depends List of build dependencies
+def build_key(branch, chroot_hash, depends):
+    h = hashlib.sha1()
+    h.update(branch.encode('utf8'))
+    h.update(chroot_hash.encode('utf8'))
+    h.update(' '.join(sorted(depends)).encode('utf8'))
+    return h.hexdigest()
+
+## @brief Keep the build directory if it was configured with the same key
+## @returns True if a previous build directory is being reused
+def reuse_build(workspace, key):
+    build_dir = workspace+'/build'
+    try:
+        with open(os.path.join(build_dir, BUILDKEY)) as f:
+            if f.read().strip() == key:
+                print('Reusing build directory (key %s)' % key)
+                return True
+    except IOError:
+        pass
+    print('Starting with a clean build directory (key %s)' % key)
+    if os.path.exists(build_dir):
+        shutil.rmtree(build_dir)
+    os.makedirs(build_dir)
+    return False
 
 ## @brief Call a command
 ## @param command Should be a list
@@ -299,25 +408,42 @@ class BuildException(Exception):
 ## @brief Do some cleanup
 def cleanup():
     try:
-        if os.path.exists(workspace+'/build'):
-            shutil.rmtree(workspace+'/build')
         if os.path.exists(workspace+'/test'):
             shutil.rmtree(workspace+'/test')
+        if incremental:
+            # keep the checkout and build tree for the next build
+            return
+        if os.path.exists(workspace+'/build'):
+            shutil.rmtree(workspace+'/build')
         if os.path.exists(workspace+'/src'):
             shutil.rmtree(workspace+'/src')
     except:
         # Workspace variable probably didn't exist; do nothing
         pass
 
+## @brief Remove the build directory, so that the next build starts clean
+def invalidate_build():
+    if os.path.exists(workspace+'/build'):
+        shutil.rmtree(workspace+'/build', ignore_errors=True)
+
+# set in main, used for cleanup
+workspace = None
+incremental = None
+
 if __name__=="__main__":
-    if len(sys.argv) < 3:
-        print('')
-        print('Usage: testbuild.py <workspace> <rosdistro>')
-        print('')
-        exit(-1)
-    workspace = sys.argv[1] # for cleanup
+    parser = argparse.ArgumentParser(description='Build and test a catkin workspace')
+    parser.add_argument('workspace', help='bind-mounted workspace, with code checked out to src/')
+    parser.add_argument('rosdistro', help='name of the ROS distro to build for')
+    parser.add_argument('--ccache', metavar='DIR', help='bind-mounted compiler cache')
+    parser.add_argument('--incremental', metavar='BRANCH',
+                        help='keep the build directory between builds of this branch')
+    args = parser.parse_args()
+    workspace = args.workspace # for cleanup
+    incremental = args.incremental
     try:
-        run_build_and_test(sys.argv[1], sys.argv[2])
+        run_build_and_test(args.workspace, args.rosdistro, args.ccache, args.incremental)
     except Exception as e:
+        if incremental:
+            invalidate_build()
         cleanup()
         raise BuildException(str(e))
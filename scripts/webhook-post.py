@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+
+# This is used to test the GitHub webhook of the master: it posts a recorded
+# event (see documentation/webhooks), signed like GitHub does
+
+from __future__ import print_function
+import sys
+import os
+import hmac
+import uuid
+import hashlib
+import urllib2
+
+## @brief Post an event to the webhook
+## @param url The webhook (for instance, http://localhost:8011/github)
+## @param secret The secret of the webhook
+## @param event The kind of event (push, pull_request, ping)
+## @param body The event, as JSON
+## @returns (HTTP code, response)
+def post(url, secret, event, body):
+    headers = {'Content-Type': 'application/json',
+               'User-Agent': 'GitHub-Hookshot/webhook-post',
+               'X-GitHub-Event': event,
+               'X-GitHub-Delivery': str(uuid.uuid4()),
+               'X-Hub-Signature': 'sha1='+hmac.new(secret, body, hashlib.sha1).hexdigest(),
+               'X-Hub-Signature-256': 'sha256='+hmac.new(secret, body, hashlib.sha256).hexdigest()}
+    try:
+        response = urllib2.urlopen(urllib2.Request(url, body, headers))
+        return response.getcode(), response.read()
+    except urllib2.HTTPError as e:
+        return e.code, e.read()
+
+if __name__=="__main__":
+    if len(sys.argv) < 4:
+        print('')
+        print('Usage: webhook-post.py <url> <secret> <payload.json> [event]')
+        print('')
+        print('  The event defaults to the name of the payload file (push.json is a push event)')
+        print('')
+        exit(-1)
+    with open(sys.argv[3]) as f:
+        body = f.read()
+    event = sys.argv[4] if len(sys.argv) > 4 else os.path.splitext(os.path.basename(sys.argv[3]))[0]
+    code, response = post(sys.argv[1], sys.argv[2], event, body)
+    print('%d %s' % (code, response.strip()))
+    exit(0 if code < 300 else 1)